@@ -0,0 +1,99 @@
+''' Benchmark of bytes on the wire vs. CPU time of response compression
+
+For task list bodies of several sizes, rendered like GET /todo/api/v1.0/tasks,
+compares identity, gzip and, when the brotli package is installed, br at a
+few levels:
+
+  * bytes: encoded body size and ratio to the JSON body
+  * ms: compression CPU time per response
+  * wire ms: ms plus the time to send the bytes at --bandwidth Mbit/s, the
+    level with the lowest total is the one worth serving at that bandwidth
+
+--streamed compresses the body in one chunk per task like a streamed
+response instead of in one call.
+'''
+
+import argparse
+import decimal
+import os
+import time
+
+os.environ.setdefault('SAMPLETODO_CONFIG_ENV', 'TestLocalRunConfig')
+
+import flask
+
+from sampletodo import app
+from sampletodo.views import json_response
+import sampletodo.common.compression as compression
+
+def fake_tasks(items):
+  ''' Tasks as the DynamoDB resource returns them '''
+  return [{'id': '%032d' % idx, 'title': 'task %s' % idx, 'done': bool(idx % 2),
+           'task_status': 'done' if idx % 2 else 'pending',
+           'createdat': decimal.Decimal(1500000000 + idx),
+           'updatedat': decimal.Decimal(1500000000 + idx)}
+          for idx in range(items)]
+
+def render(items):
+  ''' JSON body of a page of items '''
+  with app.test_request_context('/todo/api/v1.0/tasks'):
+    flask.g.request_id = 'benchmark-request-id'
+    return json_response({'tasks': fake_tasks(items), 'next_cursor': None}).get_data()
+
+def chunked(body, items):
+  ''' body split in about one chunk per task '''
+  size = max(1, len(body) // max(1, items))
+  return [body[idx:idx + size] for idx in range(0, len(body), size)]
+
+def run(body, items, encoding, level, iterations, streamed):
+  ''' Time the compression, returns (seconds per response, encoded bytes) '''
+  if encoding == 'identity':
+    return 0.0, len(body)
+
+  chunks = chunked(body, items)
+  start = time.time()
+  for _ in range(iterations):
+    if streamed:
+      data = b''.join(compression.compress_iter(chunks, encoding, level))
+    else:
+      data = compression.compress(body, encoding, level)
+  return (time.time() - start) / iterations, len(data)
+
+def codecs(gzip_levels, brotli_levels):
+  result = [('identity', 0)]
+  result += [('gzip', level) for level in gzip_levels]
+  if compression.brotli is not None:
+    result += [('br', level) for level in brotli_levels]
+  return result
+
+def int_list(value):
+  return [int(v) for v in value.split(',')]
+
+def main():
+  ''' Main function for the module '''
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--sizes', type=int_list, default=[10, 100, 1000, 10000],
+                      help='comma separated tasks per body')
+  parser.add_argument('--gzip-levels', type=int_list, default=[1, 6, 9])
+  parser.add_argument('--brotli-levels', type=int_list, default=[1, 4, 11])
+  parser.add_argument('--bandwidth', type=float, default=100, help='Mbit/s')
+  parser.add_argument('--iterations', type=int, default=20)
+  parser.add_argument('--streamed', action='store_true')
+  args = parser.parse_args()
+
+  if compression.brotli is None:
+    print('brotli is not installed, only comparing gzip')
+
+  print('%8s %-10s %6s %12s %8s %10s %10s' % ('items', 'encoding', 'level', 'bytes',
+                                               'ratio', 'ms', 'wire ms'))
+  for items in args.sizes:
+    body = render(items)
+    for encoding, level in codecs(args.gzip_levels, args.brotli_levels):
+      seconds, size = run(body, items, encoding, level, args.iterations, args.streamed)
+      wire = seconds + size * 8 / (args.bandwidth * 1000 * 1000)
+      print('%8d %-10s %6s %12d %8.3f %10.3f %10.3f' % (items, encoding, level or '-', size,
+                                                        float(size) / len(body),
+                                                        seconds * 1000, wire * 1000))
+
+if __name__ == '__main__':
+  main()
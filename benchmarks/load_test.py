@@ -0,0 +1,398 @@
+''' Load test of the todo api with a configurable mix of endpoints
+
+Drives create, get, list, status, update and delete requests either from a
+fixed number of closed loop clients (--concurrency) or at a fixed arrival
+rate (--rate, open loop). Latency is measured from when a request was due,
+so a saturated server shows up as queueing time instead of a lower request
+rate.
+
+Targets:
+
+  * inprocess (default): the flask app through its test client, the storage
+    backend comes from SAMPLETODO_BACKEND (memory with TestLocalRunConfig,
+    dynamodb for moto)
+  * a base url such as http://127.0.0.1:8080: a running server, backed by
+    DynamoDB Local or a live stack, with SAMPLETODO_USERNAME/PASSWORD
+
+Results are printed per endpoint and, with --output, saved as JSON.
+--compare takes an earlier results file and fails when a latency
+percentile or the throughput regressed by more than --threshold percent.
+'''
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+import requests
+import structlog
+
+os.environ.setdefault('SAMPLETODO_CONFIG_ENV', 'TestLocalRunConfig')
+os.environ.setdefault('SAMPLETODO_USERNAME', 'benchmark')
+os.environ.setdefault('SAMPLETODO_PASSWORD', 'benchmark')
+
+# TestLocalRunConfig leaves structlog printing every request to stdout, route
+# it to the disabled root logger before the views bind their logger
+structlog.configure(logger_factory=structlog.stdlib.LoggerFactory())
+
+from sampletodo.version import __version__
+
+API = '/todo/api/v1.0'
+OPERATIONS = ['create', 'get', 'list', 'status', 'update', 'delete']
+DEFAULT_MIX = 'create=2,get=5,list=2,status=2,update=2,delete=1'
+PERCENTILES = [50, 95, 99]
+
+class InProcessTarget(object):
+  ''' The flask app through one test client per thread '''
+  name = 'inprocess'
+
+  def __init__(self):
+    from sampletodo import app
+
+    self.app = app
+    self.auth = {'Authorization': 'Basic ' + _basic_auth()}
+    self._local = threading.local()
+
+  def request(self, method, path, body=None):
+    ''' Send a request, returns (status code, parsed body) '''
+    client = getattr(self._local, 'client', None)
+    if client is None:
+      client = self._local.client = self.app.test_client()
+    kwargs = {'method': method, 'headers': self.auth}
+    if body is not None:
+      kwargs['data'] = json.dumps(body)
+      kwargs['content_type'] = 'application/json'
+    response = client.open(path, **kwargs)
+    return response.status_code, json.loads(response.data)
+
+  def describe(self):
+    return {'target': self.name, 'backend': self.app.config['SAMPLETODO_BACKEND'],
+            'config_env': os.environ['SAMPLETODO_CONFIG_ENV']}
+
+class HttpTarget(object):
+  ''' A running server, one keep-alive session per thread '''
+
+  def __init__(self, base_url, timeout):
+    self.base_url = base_url.rstrip('/')
+    self.timeout = timeout
+    self.auth = (os.environ['SAMPLETODO_USERNAME'], os.environ['SAMPLETODO_PASSWORD'])
+    self._local = threading.local()
+
+  def request(self, method, path, body=None):
+    ''' Send a request, returns (status code, parsed body) '''
+    session = getattr(self._local, 'session', None)
+    if session is None:
+      session = self._local.session = requests.Session()
+    response = session.request(method, self.base_url + path, json=body, auth=self.auth,
+                                timeout=self.timeout)
+    return response.status_code, response.json()
+
+  def describe(self):
+    return {'target': self.base_url}
+
+def _basic_auth():
+  import base64
+  credentials = '%s:%s' % (os.environ['SAMPLETODO_USERNAME'], os.environ['SAMPLETODO_PASSWORD'])
+  return base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+
+class TaskPool(object):
+  ''' Ids of tasks that exist, shared by the workers '''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._ids = []
+
+  def add(self, task_id):
+    with self._lock:
+      self._ids.append(task_id)
+
+  def pick(self):
+    with self._lock:
+      return random.choice(self._ids) if self._ids else None
+
+  def take(self):
+    ''' Remove and return a random id, so two deletes never race for one task '''
+    with self._lock:
+      if not self._ids:
+        return None
+      idx = random.randrange(len(self._ids))
+      self._ids[idx], self._ids[-1] = self._ids[-1], self._ids[idx]
+      return self._ids.pop()
+
+  def __len__(self):
+    return len(self._ids)
+
+class Workload(object):
+  ''' Turns an operation name into a request against the target '''
+
+  def __init__(self, target, pool, page_limit):
+    self.target = target
+    self.pool = pool
+    self.page_limit = page_limit
+    self._counter = 0
+
+  def _title(self):
+    self._counter += 1
+    return 'load test task %s' % self._counter
+
+  def create(self):
+    status, body = self.target.request('POST', API + '/tasks', {'title': self._title()})
+    # 202 when write-behind queued the task, it is readable once written
+    if status in (201, 202):
+      self.pool.add(body['task']['id'])
+    return status
+
+  def get(self):
+    task_id = self.pool.pick() or 'missing'
+    return self.target.request('GET', API + '/tasks/%s' % task_id)[0]
+
+  def list(self):
+    return self.target.request('GET', API + '/tasks?limit=%s' % self.page_limit)[0]
+
+  def status(self):
+    task_status = random.choice(['pending', 'done'])
+    return self.target.request('GET', API + '/tasks/status/%s?limit=%s' %
+                               (task_status, self.page_limit))[0]
+
+  def update(self):
+    task_id = self.pool.pick()
+    if task_id is None:
+      return self.create()
+    return self.target.request('PUT', API + '/tasks/%s' % task_id,
+                               {'done': random.random() < 0.5})[0]
+
+  def delete(self):
+    task_id = self.pool.take()
+    if task_id is None:
+      return self.create()
+    return self.target.request('DELETE', API + '/tasks/%s' % task_id)[0]
+
+class Recorder(object):
+  ''' Latencies and errors per operation '''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.latencies = dict((operation, []) for operation in OPERATIONS)
+    self.errors = dict((operation, 0) for operation in OPERATIONS)
+
+  def record(self, operation, latency, ok):
+    with self._lock:
+      self.latencies[operation].append(latency)
+      if not ok:
+        self.errors[operation] += 1
+
+def parse_mix(mix):
+  ''' "create=2,get=5" -> [(operation, weight)] '''
+  weights = []
+  for entry in mix.split(','):
+    operation, _, weight = entry.partition('=')
+    if operation not in OPERATIONS:
+      raise SystemExit('Unknown operation in --mix - %s' % operation)
+    weights.append((operation, float(weight or 1)))
+  return weights
+
+def choose(weights):
+  ''' Weighted random operation '''
+  point = random.uniform(0, sum(weight for _, weight in weights))
+  for operation, weight in weights:
+    point -= weight
+    if point <= 0:
+      return operation
+  return weights[-1][0]
+
+def percentile(values, pct):
+  ''' Nearest rank percentile of sorted values '''
+  if not values:
+    return None
+  rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+  return values[min(max(rank, 0), len(values) - 1)]
+
+def execute(workload, recorder, operation, due):
+  ''' Run one operation, latency counts from when it was due '''
+  try:
+    status = getattr(workload, operation)()
+    ok = 200 <= status < 300
+  except Exception:
+    ok = False
+  recorder.record(operation, time.time() - due, ok)
+
+def run_closed_loop(workload, recorder, weights, concurrency, deadline):
+  ''' concurrency clients, each sending its next request when the last one is done '''
+  def client():
+    while time.time() < deadline:
+      execute(workload, recorder, choose(weights), time.time())
+
+  threads = [threading.Thread(target=client) for _ in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+def run_open_loop(workload, recorder, weights, rate, concurrency, deadline):
+  ''' Requests due every 1/rate seconds, served by up to concurrency threads '''
+  from concurrent.futures import ThreadPoolExecutor
+
+  executor = ThreadPoolExecutor(max_workers=concurrency)
+  try:
+    start = time.time()
+    sent = 0
+    while True:
+      due = start + sent / float(rate)
+      if due >= deadline:
+        break
+      delay = due - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      executor.submit(execute, workload, recorder, choose(weights), due)
+      sent += 1
+  finally:
+    executor.shutdown(wait=True)
+
+def summarize(recorder, elapsed):
+  ''' Throughput and latency percentiles in milliseconds per operation '''
+  results = {}
+  total = 0
+  for operation in OPERATIONS:
+    latencies = sorted(recorder.latencies[operation])
+    if not latencies:
+      continue
+    total += len(latencies)
+    summary = {
+      'requests': len(latencies),
+      'errors': recorder.errors[operation],
+      'throughput_rps': round(len(latencies) / elapsed, 2),
+      'mean_ms': round(1000 * sum(latencies) / len(latencies), 3),
+      'max_ms': round(1000 * latencies[-1], 3),
+    }
+    for pct in PERCENTILES:
+      summary['p%s_ms' % pct] = round(1000 * percentile(latencies, pct), 3)
+    results[operation] = summary
+
+  results['all'] = {
+    'requests': total,
+    'errors': sum(recorder.errors.values()),
+    'throughput_rps': round(total / elapsed, 2),
+  }
+  return results
+
+def print_results(results):
+  header = '%-8s %9s %7s %10s %10s %10s %10s' % ('endpoint', 'requests', 'errors', 'req/s',
+                                                  'p50 ms', 'p95 ms', 'p99 ms')
+  print(header)
+  for operation in OPERATIONS + ['all']:
+    if operation not in results:
+      continue
+    summary = results[operation]
+    print('%-8s %9s %7s %10.1f %10s %10s %10s' % (
+      operation, summary['requests'], summary['errors'], summary['throughput_rps'],
+      summary.get('p50_ms', '-'), summary.get('p95_ms', '-'), summary.get('p99_ms', '-')))
+
+def compare(run, baseline, threshold):
+  ''' Print changes against a baseline run, returns the regressions '''
+  regressions = []
+  for setting in ['mode', 'rate', 'concurrency', 'mix']:
+    if run['settings'][setting] != baseline['settings'].get(setting):
+      print('warning: %s differs from the baseline - %s vs %s' %
+            (setting, run['settings'][setting], baseline['settings'].get(setting)))
+  metrics = ['p%s_ms' % pct for pct in PERCENTILES]
+  if run['settings']['mode'] == 'closed':
+    # with a fixed arrival rate throughput only follows the rate
+    metrics.insert(0, 'throughput_rps')
+
+  print('\n%-8s %-15s %12s %12s %9s' % ('endpoint', 'metric', 'baseline', 'current', 'change'))
+  for operation, summary in sorted(run['results'].items()):
+    before = baseline['results'].get(operation)
+    if before is None:
+      continue
+    for metric in metrics:
+      if metric not in summary or not before.get(metric):
+        continue
+      change = 100.0 * (summary[metric] - before[metric]) / before[metric]
+      # lower throughput and higher latency are the regressions
+      worse = -change if metric == 'throughput_rps' else change
+      flag = ''
+      if worse > threshold:
+        flag = ' !'
+        regressions.append((operation, metric, round(change, 1)))
+      print('%-8s %-15s %12s %12s %+8.1f%%%s' % (operation, metric, before[metric],
+                                                 summary[metric], change, flag))
+  return regressions
+
+def main():
+  ''' Main function for the module '''
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--target', default='inprocess',
+                      help='inprocess or the base url of a running server')
+  parser.add_argument('--mix', default=DEFAULT_MIX,
+                      help='operation weights, default %s' % DEFAULT_MIX)
+  parser.add_argument('--concurrency', type=int, default=8,
+                      help='closed loop clients, or the thread cap with --rate')
+  parser.add_argument('--rate', type=float,
+                      help='requests per second, switches to an open loop')
+  parser.add_argument('--duration', type=float, default=10)
+  parser.add_argument('--seed-tasks', type=int, default=100,
+                      help='tasks created before measuring')
+  parser.add_argument('--page-limit', type=int, default=25)
+  parser.add_argument('--timeout', type=float, default=10)
+  parser.add_argument('--output', help='write the results as JSON to this file')
+  parser.add_argument('--compare', help='results JSON of an earlier run')
+  parser.add_argument('--threshold', type=float, default=10,
+                      help='percent change in --compare that counts as a regression')
+  args = parser.parse_args()
+
+  if args.target == 'inprocess':
+    target = InProcessTarget()
+  else:
+    target = HttpTarget(args.target, args.timeout)
+
+  weights = parse_mix(args.mix)
+  pool = TaskPool()
+  workload = Workload(target, pool, args.page_limit)
+  for _ in range(args.seed_tasks):
+    workload.create()
+
+  recorder = Recorder()
+  start = time.time()
+  deadline = start + args.duration
+  if args.rate:
+    run_open_loop(workload, recorder, weights, args.rate, args.concurrency, deadline)
+  else:
+    run_closed_loop(workload, recorder, weights, args.concurrency, deadline)
+  elapsed = time.time() - start
+
+  results = summarize(recorder, elapsed)
+  print_results(results)
+
+  run = {
+    'build_version': __version__,
+    'timestamp': int(start),
+    'python': sys.version.split()[0],
+    'settings': {
+      'mix': dict(weights),
+      'mode': 'open' if args.rate else 'closed',
+      'rate': args.rate,
+      'concurrency': args.concurrency,
+      'duration': args.duration,
+      'seed_tasks': args.seed_tasks,
+      'page_limit': args.page_limit,
+    },
+    'target': target.describe(),
+    'elapsed_seconds': round(elapsed, 3),
+    'results': results,
+  }
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(run, f, indent=2, sort_keys=True)
+
+  if args.compare:
+    with open(args.compare) as f:
+      regressions = compare(run, json.load(f), args.threshold)
+    if regressions:
+      sys.exit('%s regression(s) above %s%%' % (len(regressions), args.threshold))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,109 @@
+''' Micro-benchmark of the per-request logging overhead
+
+Emits the log events of one GET /todo/api/v1.0/tasks request (request line,
+model call, response line) inside a flask request context:
+
+  * legacy: stack introspection for event names, the full DynamoDB result and
+    all response headers in the log line (the behaviour before the production
+    logging mode existed)
+  * summary: static event names and result summaries
+
+each under the development (synchronous) and production (sampled, rendered on
+a QueueListener thread) logging setups. Log output goes to /dev/null.
+'''
+
+import argparse
+import logging
+import os
+import sys
+import time
+import traceback
+
+os.environ.setdefault('SAMPLETODO_CONFIG_ENV', 'TestLocalRunConfig')
+os.environ.setdefault('SAMPLETODO_TTY', 'False')
+
+import structlog
+
+from sampletodo import app
+import sampletodo.common.utils as utils
+from sampletodo.models.dynamodb import summarize_result
+
+def legacy_func_name():
+  ''' Event name lookup used by the models before static names '''
+  return traceback.extract_stack(None, 2)[0][2]
+
+def fake_result(items):
+  ''' A scan result shaped like the ones TasksTable logs '''
+  return {
+    'Items': [{'id': '%032d' % idx, 'title': 'task %s' % idx, 'done': False,
+               'createdat': 1500000000, 'updatedat': 1500000000}
+              for idx in range(items)],
+    'Count': items,
+    'ScannedCount': items,
+    'ResponseMetadata': {'HTTPStatusCode': 200, 'RetryAttempts': 0},
+  }
+
+HEADERS = {'Content-Type': 'application/json', 'Content-Length': '12345'}
+
+def legacy_request(log, result):
+  ''' Log calls of one request before the change '''
+  log.info('request', request_method='GET', request_full_path='/todo/api/v1.0/tasks')
+  log.info(legacy_func_name(), result=result)
+  log.info('response', response_status='success', response_headers=HEADERS,
+           response_status_code=200)
+
+def summary_request(log, result):
+  ''' Log calls of one request with the low overhead model logging '''
+  log.info('request', request_method='GET', request_full_path='/todo/api/v1.0/tasks')
+  log.debug('list_items', result=result)
+  log.info('list_items', **summarize_result(result))
+  log.debug('response_headers', response_headers=HEADERS)
+  log.info('response', response_status='success', response_content_length=12345,
+           response_status_code=200)
+
+def run(style, production, sample_rate, iterations, result):
+  ''' Time one combination, returns microseconds per request '''
+  stderr = sys.stderr
+  sys.stderr = open(os.devnull, 'w')
+  try:
+    utils.setup_structlog(False, logging.INFO, production, sample_rate)
+    logging.getLogger().disabled = False
+    log = structlog.get_logger().new()
+    emit = legacy_request if style == 'legacy' else summary_request
+
+    with app.test_request_context('/todo/api/v1.0/tasks'):
+      start = time.time()
+      for _ in range(iterations):
+        emit(log, result)
+      request_thread = time.time() - start
+
+    # include the time the background writer needs to drain the queue
+    utils.stop_queue_listener()
+    total = time.time() - start
+  finally:
+    sys.stderr.close()
+    sys.stderr = stderr
+
+  return request_thread * 1e6 / iterations, total * 1e6 / iterations
+
+def main():
+  ''' Main function for the module '''
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--iterations', type=int, default=2000)
+  parser.add_argument('--items', type=int, default=100,
+                      help='items in the logged scan result')
+  parser.add_argument('--sample-rate', type=float, default=0.1,
+                      help='success log sample rate for the production setup')
+  args = parser.parse_args()
+
+  result = fake_result(args.items)
+  print('%-10s %-12s %18s %18s' % ('style', 'setup', 'request us/req', 'total us/req'))
+  for style in ['legacy', 'summary']:
+    for production in [False, True]:
+      setup = 'production' if production else 'development'
+      request_us, total_us = run(style, production, args.sample_rate,
+                                 args.iterations, result)
+      print('%-10s %-12s %18.1f %18.1f' % (style, setup, request_us, total_us))
+
+if __name__ == '__main__':
+  main()
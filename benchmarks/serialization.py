@@ -0,0 +1,68 @@
+''' Benchmark of GET /todo/api/v1.0/tasks response serialization
+
+Compares, for a page of tasks shaped like DynamoDB results (Decimal numbers):
+
+  * legacy: flask jsonify followed by the old after_request pass that parsed
+    the rendered body, added the request id and encoded it again
+  * single_pass: json_response, which adds the request id to the envelope and
+    encodes once with simplejson
+'''
+
+import argparse
+import decimal
+import json
+import os
+import time
+
+os.environ.setdefault('SAMPLETODO_CONFIG_ENV', 'TestLocalRunConfig')
+
+import flask
+
+from sampletodo import app
+from sampletodo.views import json_response
+
+def fake_tasks(items):
+  ''' Tasks as the DynamoDB resource returns them '''
+  return [{'id': '%032d' % idx, 'title': 'task %s' % idx, 'done': bool(idx % 2),
+           'task_status': 'done' if idx % 2 else 'pending',
+           'createdat': decimal.Decimal(1500000000 + idx),
+           'updatedat': decimal.Decimal(1500000000 + idx)}
+          for idx in range(items)]
+
+def legacy(tasks):
+  ''' Render, parse and re-render like the old after_request did '''
+  response = flask.jsonify({'tasks': tasks})
+  response_data = json.loads(response.get_data())
+  response_data['request_id'] = flask.g.request_id
+  response.set_data(json.dumps(response_data))
+  return response
+
+def single_pass(tasks):
+  ''' Render once with the request id in the envelope '''
+  return json_response({'tasks': tasks})
+
+def run(func, tasks, iterations):
+  ''' Time func, returns (seconds per response, body bytes) '''
+  with app.test_request_context('/todo/api/v1.0/tasks'):
+    flask.g.request_id = 'benchmark-request-id'
+    start = time.time()
+    for _ in range(iterations):
+      response = func(tasks)
+    elapsed = time.time() - start
+  return elapsed / iterations, len(response.get_data())
+
+def main():
+  ''' Main function for the module '''
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--items', type=int, default=10000)
+  parser.add_argument('--iterations', type=int, default=20)
+  args = parser.parse_args()
+
+  tasks = fake_tasks(args.items)
+  print('%-12s %14s %14s %14s' % ('path', 'ms/response', 'items/s', 'bytes'))
+  for name, func in [('legacy', legacy), ('single_pass', single_pass)]:
+    seconds, size = run(func, tasks, args.iterations)
+    print('%-12s %14.2f %14.0f %14d' % (name, seconds * 1000, args.items / seconds, size))
+
+if __name__ == '__main__':
+  main()
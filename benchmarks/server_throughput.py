@@ -0,0 +1,100 @@
+''' Requests per second of the development server vs. the production server
+
+Starts the api with each server on a local port, then drives
+GET /todo/api/v1.0/health (no DB) and GET /todo/api/v1.0/tasks (DB) from a
+pool of client threads for a fixed duration. The DynamoDB endpoint comes from
+SAMPLETODO_CONFIG_ENV (LocalRunConfig expects DynamoDB Local on port 8000).
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+ENDPOINTS = ['/todo/api/v1.0/health', '/todo/api/v1.0/tasks']
+
+def wait_until_up(base_url, timeout=30):
+  ''' Poll the health endpoint until the server answers '''
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    try:
+      requests.get(base_url + ENDPOINTS[0], timeout=1)
+      return
+    except requests.ConnectionError:
+      time.sleep(0.2)
+  raise RuntimeError('server did not start')
+
+def drive(url, concurrency, duration, auth):
+  ''' Hit url from concurrency threads for duration seconds, returns (rps, errors) '''
+  counts = []
+  errors = []
+  deadline = time.time() + duration
+
+  def client():
+    session = requests.Session()
+    done = 0
+    failed = 0
+    while time.time() < deadline:
+      try:
+        response = session.get(url, auth=auth, timeout=10)
+        if response.status_code != 200:
+          failed += 1
+      except requests.RequestException:
+        failed += 1
+      done += 1
+    counts.append(done)
+    errors.append(failed)
+
+  threads = [threading.Thread(target=client) for _ in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return sum(counts) / float(duration), sum(errors)
+
+def main():
+  ''' Main function for the module '''
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--port', type=int, default=8089)
+  parser.add_argument('--concurrency', type=int, default=32)
+  parser.add_argument('--duration', type=float, default=10)
+  parser.add_argument('--workers', type=int, default=0,
+                      help='production workers, 0 means one per core')
+  parser.add_argument('--threads', type=int, default=4,
+                      help='production threads per worker')
+  args = parser.parse_args()
+
+  env = dict(os.environ)
+  env.setdefault('SAMPLETODO_CONFIG_ENV', 'LocalRunConfig')
+  env.update({
+    'SAMPLETODO_HOST': '127.0.0.1',
+    'SAMPLETODO_PORT': str(args.port),
+    'SAMPLETODO_DEBUG': 'False',
+    'SAMPLETODO_USERNAME': 'benchmark',
+    'SAMPLETODO_PASSWORD': 'benchmark',
+    'SAMPLETODO_LOG_MODE': 'production',
+    'SAMPLETODO_WORKERS': str(args.workers),
+    'SAMPLETODO_THREADS': str(args.threads),
+  })
+  base_url = 'http://127.0.0.1:%s' % args.port
+  auth = ('benchmark', 'benchmark')
+
+  print('%-12s %-26s %12s %8s' % ('server', 'endpoint', 'req/s', 'errors'))
+  for server in ['development', 'production']:
+    process = subprocess.Popen([sys.executable, '-m', 'sampletodo.run', '--server', server],
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+      wait_until_up(base_url)
+      for endpoint in ENDPOINTS:
+        rps, errors = drive(base_url + endpoint, args.concurrency, args.duration, auth)
+        print('%-12s %-26s %12.1f %8d' % (server, endpoint, rps, errors))
+    finally:
+      process.terminate()
+      process.wait()
+
+if __name__ == '__main__':
+  main()
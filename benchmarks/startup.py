@@ -0,0 +1,65 @@
+''' Startup benchmark: package import time and first request latency
+
+Every sample runs in a fresh interpreter, like a new or recycled worker:
+
+  * import: time to import sampletodo (app, config, logging and views)
+  * first_health: first GET /todo/api/v1.0/health, no DB access
+  * first_tasks: first GET /todo/api/v1.0/tasks, which connects to DynamoDB
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SAMPLE = r"""
+import json, time
+start = time.time()
+from sampletodo import app
+import sampletodo.views
+imported = time.time()
+
+@sampletodo.auth.verify_password
+def verify_password(user, password):
+  return True
+
+client = app.test_client()
+client.get('/todo/api/v1.0/health')
+health = time.time()
+client.get('/todo/api/v1.0/tasks')
+tasks = time.time()
+print(json.dumps({'import': imported - start,
+                  'first_health': health - imported,
+                  'first_tasks': tasks - health}))
+"""
+
+def sample():
+  ''' Run one fresh interpreter and return its timings '''
+  env = dict(os.environ)
+  env.setdefault('SAMPLETODO_CONFIG_ENV', 'TestLocalRunConfig')
+  output = subprocess.check_output([sys.executable, '-c', SAMPLE], env=env)
+  return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def median(values):
+  ''' Median of a list of numbers '''
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+def main():
+  ''' Main function for the module '''
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--runs', type=int, default=10)
+  args = parser.parse_args()
+
+  samples = [sample() for _ in range(args.runs)]
+  print('%-14s %12s %12s %12s' % ('phase', 'median ms', 'min ms', 'max ms'))
+  for phase in ['import', 'first_health', 'first_tasks']:
+    values = [entry[phase] * 1000 for entry in samples]
+    print('%-14s %12.1f %12.1f %12.1f' % (phase, median(values), min(values), max(values)))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,92 @@
+''' Benchmark of the DynamoDB round trips of single task writes
+
+For put_item, update_item and delete_item of TasksTable, counts the DynamoDB
+calls per write and times them:
+
+  * read_then_write: a get_item_by_id before every update and delete, how
+    updates worked before they became one conditional UpdateItem
+  * current: the write plus the change version and counter UpdateItem
+  * no_counters: the write alone, what the counters cost
+
+ms/write is measured against the configured DynamoDB (moto in-process with
+TestLocalRunConfig, DynamoDB Local with LocalRunConfig). Round trips
+dominate against a real endpoint, the rtt column estimates ms/write at
+--rtt-ms per call.
+'''
+
+import argparse
+import os
+import time
+
+os.environ.setdefault('SAMPLETODO_CONFIG_ENV', 'TestLocalRunConfig')
+
+import structlog
+
+# keep the models' info logging off stdout while timing
+structlog.configure(logger_factory=structlog.stdlib.LoggerFactory())
+
+from sampletodo import app
+from sampletodo.models.dynamodb import TasksTable
+import sampletodo.common.metrics as metrics
+
+def dynamodb_calls():
+  ''' DynamoDB calls made so far, from the call latency histogram '''
+  return sum(sum(sample[1]) for sample in metrics.DYNAMODB_CALL_DURATION.samples())
+
+def open_table():
+  ''' TasksTable without the item cache in front, which would hide the reads '''
+  kwargs = dict((param, value) for param, value in app.config.items()
+                if param.startswith('DYNAMODB') or param.startswith('AWS'))
+  return TasksTable(**kwargs)
+
+def writes(table, variant):
+  ''' {operation: function of one task id} for the variant '''
+  def read_first(func):
+    def wrapper(item_id):
+      table.get_item_by_id(item_id)
+      return func(item_id)
+    return wrapper
+
+  operations = {
+    'put_item': lambda item_id: table.put_item({'title': 'benchmark task'}),
+    'update_item': lambda item_id: table.update_item(item_id, {'done': True}),
+    'delete_item': table.delete_item,
+  }
+  if variant == 'read_then_write':
+    operations['update_item'] = read_first(operations['update_item'])
+    operations['delete_item'] = read_first(operations['delete_item'])
+  return operations
+
+def run(table, variant, iterations):
+  ''' [(operation, calls per write, seconds per write)] '''
+  ids = [table.put_item({'title': 'benchmark task'})['id'] for _ in range(iterations)]
+  operations = writes(table, variant)
+  results = []
+  for operation in ('put_item', 'update_item', 'delete_item'):
+    calls = dynamodb_calls()
+    start = time.time()
+    for item_id in ids:
+      operations[operation](item_id)
+    elapsed = time.time() - start
+    results.append((operation, (dynamodb_calls() - calls) / float(len(ids)), elapsed / len(ids)))
+  return results
+
+def main():
+  ''' Main function for the module '''
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--iterations', type=int, default=200)
+  parser.add_argument('--rtt-ms', type=float, default=2.0)
+  args = parser.parse_args()
+
+  table = open_table()
+  print('%-16s %-12s %10s %10s %12s' % ('variant', 'write', 'calls', 'ms/write',
+                                       'rtt ms/write'))
+  for variant in ('read_then_write', 'current', 'no_counters'):
+    if variant == 'no_counters':
+      table._bump_version = lambda deltas=None: None
+    for operation, calls, seconds in run(table, variant, args.iterations):
+      print('%-16s %-12s %10.1f %10.2f %12.1f' % (variant, operation, calls, seconds * 1000,
+                                                 calls * args.rtt_ms))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,18 @@
+#!/bin/bash -e
+
+if [[ $# -lt 1 ]]; then
+  echo "Invalid usage"
+  echo "usage: $0 task_name [task_name ...]"
+  exit 1
+fi
+
+echo "$0 $@"
+
+CREATES=$(printf '{"title":"%s"},' "$@")
+
+set -x
+curl -v -u $SAMPLETODO_USERNAME:$SAMPLETODO_PASSWORD \
+    -H "X-Request-Id: $(uuidgen | tr '[:upper:]' '[:lower:]')" \
+    -H "Content-Type: application/json" -X POST \
+    -d "{\"create\":[${CREATES%,}]}" http://$SAMPLETODO_HOST:$SAMPLETODO_PORT/todo/api/v1.0/tasks/batch
+set +x
@@ -36,6 +36,10 @@ echo "#########################"
 
 echo "#########################"
 
+./batch_tasks.sh 'Write a book' 'Write another book'
+
+echo "#########################"
+
 echo "./get_all_tasks.sh" # can't echo program name inside file because it's output is parsed by ./get_all_uuids.sh
 
 ./get_all_tasks.sh
@@ -48,6 +52,10 @@ echo "#########################"
 
 ./get_task_by_id.sh $(./get_all_uuids.sh | tail -1)
 
+echo "#########################"
+
+./search_tasks_by_title.sh 'read'
+
 
 echo "#########################"
 
@@ -0,0 +1,16 @@
+#!/bin/bash -e
+
+if [[ $# -ne 1 ]]; then
+  echo "Invalid usage"
+  echo "usage: $0 title_prefix"
+  exit 1
+fi
+
+echo "$0 $1"
+
+set -x
+curl -v -u $SAMPLETODO_USERNAME:$SAMPLETODO_PASSWORD \
+     -H "X-Request-Id: $(uuidgen | tr '[:upper:]' '[:lower:]')" \
+     -G --data-urlencode "title=$1" \
+     http://$SAMPLETODO_HOST:$SAMPLETODO_PORT/todo/api/v1.0/tasks/search
+set +x
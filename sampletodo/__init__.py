@@ -9,12 +9,17 @@ import argparse
 import datetime
 
 from sampletodo.version import __version__ 
+import sampletodo.common.metrics as metrics
 import sampletodo.common.utils as utils
 
 from flask import Flask
 from flask_httpauth import HTTPBasicAuth
 
 import sampletodo.models.dynamodb as dynamodb
+import sampletodo.models.memory as memory
+import sampletodo.models.sqlite as sqlite
+import sampletodo.models.cache as cache
+import sampletodo.models.write_behind as write_behind
 
 CONFIG_ENV = os.environ.get('SAMPLETODO_CONFIG_ENV', 'LocalRunConfig')
 
@@ -24,13 +29,50 @@ def create_app():
   obj.config.from_object('sampletodo.config.%s' % CONFIG_ENV)
   return obj
 
-def create_db(_app_obj):
-  ''' Create DB object '''
-  dynamodb_args = {}
-  for param, value in _app_obj.config.iteritems():
-    if param.startswith('DYNAMODB') or param.startswith('AWS'):
-      dynamodb_args[param] = value
-  obj = dynamodb.TasksTable(**dynamodb_args)
+def create_db(_app_obj, backend=None, cached=None):
+  ''' Create DB object for the configured storage backend, or the one given
+
+  cached puts the item cache in front of it or leaves it out, None follows
+  DYNAMODB_CACHE_ENABLED.
+  '''
+  backend_args = {}
+  for param, value in _app_obj.config.items():
+    if param.startswith('DYNAMODB') or param.startswith('AWS') or param.startswith('SQLITE'):
+      backend_args[param] = value
+
+  backend = backend or _app_obj.config['SAMPLETODO_BACKEND']
+  if backend == 'memory':
+    obj = memory.MemoryTasksTable(**backend_args)
+  elif backend == 'sqlite':
+    obj = sqlite.SqliteTasksTable(**backend_args)
+  elif backend == 'dynamodb':
+    obj = dynamodb.TasksTable(**backend_args)
+  else:
+    raise ValueError('Unknown SAMPLETODO_BACKEND - %s' % backend)
+
+  if cached is None:
+    cached = backend_args.get('DYNAMODB_CACHE_ENABLED')
+  if cached:
+    item_cache = cache.ItemCache(max_entries=backend_args['DYNAMODB_CACHE_MAX_ENTRIES'],
+                                 max_bytes=backend_args['DYNAMODB_CACHE_MAX_BYTES'],
+                                 ttl=backend_args['DYNAMODB_CACHE_TTL'])
+    obj = cache.CachedTasksTable(obj, item_cache)
+
+  if _app_obj.config['SAMPLETODO_METRICS_ENABLED']:
+    obj = metrics.InstrumentedTable(obj, backend)
+
+  config = _app_obj.config
+  if config['SAMPLETODO_WRITE_BEHIND_ENABLED']:
+    # outermost, so the flusher's put_items calls are the ones timed and attributed
+    obj = write_behind.WriteBehindTable(
+      obj, config['SAMPLETODO_WRITE_BEHIND_DIR'],
+      queue_size=config['SAMPLETODO_WRITE_BEHIND_QUEUE_SIZE'],
+      batch_size=config['SAMPLETODO_WRITE_BEHIND_BATCH_SIZE'],
+      flush_interval=config['SAMPLETODO_WRITE_BEHIND_FLUSH_INTERVAL'],
+      enqueue_timeout=config['SAMPLETODO_WRITE_BEHIND_ENQUEUE_TIMEOUT'],
+      max_attempts=config['SAMPLETODO_WRITE_BEHIND_MAX_ATTEMPTS'],
+      fsync=config['SAMPLETODO_WRITE_BEHIND_FSYNC'],
+      status_entries=config['SAMPLETODO_WRITE_BEHIND_STATUS_ENTRIES'])
   return obj
 
 def create_auth():
@@ -45,7 +87,10 @@ else:
   utils.setup_structlog_wrapper()
 
 app = create_app()
-db = create_db(app)
+metrics.REGISTRY.configure(app.config['SAMPLETODO_METRICS_DIR'],
+                           app.config['SAMPLETODO_METRICS_FLUSH_INTERVAL'])
+# connects on first use, once per process, so imports and forks stay cheap
+db = utils.ProcessLocalProxy(lambda: create_db(app))
 auth = create_auth()
 
 from sampletodo import views
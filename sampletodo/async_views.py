@@ -0,0 +1,382 @@
+''' Todo api on an asyncio event loop
+
+The same /todo/api/v1.0 routes and response bodies as views.py, served by
+aiohttp on top of AsyncTasksTable. A request waiting on DynamoDB does not
+hold a thread, so one process keeps as many DynamoDB calls in flight as the
+client connection pool allows. Python 3 only, run it with
+"sampletodo --server async".
+'''
+
+import base64
+import binascii
+import os
+import traceback
+
+import structlog
+from aiohttp import web
+
+from sampletodo.models.async_dynamodb import AsyncTasksTable
+from sampletodo.models.dynamodb import ModelsException, fields_projection, parse_fields
+from sampletodo.version import __version__
+import sampletodo.common.utils as utils
+
+log = structlog.get_logger().new(build_version=__version__)
+
+DB_KEY = 'db'
+CONFIG_KEY = 'config'
+VERIFY_PASSWORD_KEY = 'verify_password'
+
+routes = web.RouteTableDef()
+
+def json_response(request, data, http_code=200):
+  ''' Encode a response body exactly once, with the request id in the envelope '''
+  request_id = request.get('request_id')
+  if request_id and isinstance(data, dict):
+    # a copy, callers may hand in dicts they keep using
+    data = dict(data, request_id=request_id)
+  return web.Response(text=utils.dumps_json(data), status=http_code,
+                      content_type='application/json')
+
+def bad_request(request, err):
+  ''' 400 response '''
+  http_code = 400
+  log.error('bad_request', error=str(err), http_code=http_code)
+  return json_response(request, {'http_code': http_code, 'text': str(err)}, http_code)
+
+def verify_password(username, password):
+  ''' Same credentials as views.get_password '''
+  if 'SAMPLETODO_USERNAME' not in os.environ or \
+     'SAMPLETODO_PASSWORD' not in os.environ:
+    return False
+  return username == os.environ.get('SAMPLETODO_USERNAME') and \
+         password == os.environ.get('SAMPLETODO_PASSWORD')
+
+def login_required(handler):
+  ''' Check HTTP basic auth, like flask_httpauth's login_required '''
+  async def wrapper(request):
+    username = password = None
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Basic '):
+      try:
+        username, _, password = base64.b64decode(header[6:]).decode('utf-8').partition(':')
+      except (binascii.Error, UnicodeDecodeError):
+        pass
+
+    if username is None or not request.app[VERIFY_PASSWORD_KEY](username, password):
+      # 403 instead of 401, like views.unauthorized
+      err = 'unauthorized_access'
+      log.error(err)
+      return json_response(request, {'error': err}, 403)
+    return await handler(request)
+
+  wrapper.__name__ = handler.__name__
+  wrapper.__doc__ = handler.__doc__
+  return wrapper
+
+def etag_matches(if_none_match, etag):
+  ''' Weak comparison of an If-None-Match header with an unquoted etag '''
+  for tag in if_none_match.split(','):
+    tag = tag.strip()
+    if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == '"%s"' % etag:
+      return True
+  return False
+
+def conditional(handler):
+  ''' ETags from the table change version, like views.conditional '''
+  async def wrapper(request):
+    etag = 'v%s' % await request.app[DB_KEY].change_version()
+    if etag_matches(request.headers.get('If-None-Match', ''), etag):
+      response = web.Response(status=304)
+    else:
+      response = await handler(request)
+      if response.status != 200:
+        return response
+    response.headers['ETag'] = 'W/"%s"' % etag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+  wrapper.__name__ = handler.__name__
+  wrapper.__doc__ = handler.__doc__
+  return wrapper
+
+async def request_json(request):
+  ''' Parsed JSON body or None, like flask's request.json '''
+  if request.content_type != 'application/json':
+    return None
+  try:
+    return await request.json()
+  except ValueError:
+    return None
+
+def pagination_args(request):
+  ''' Parse the limit and cursor query parameters '''
+  config = request.app[CONFIG_KEY]
+  limit = request.query.get('limit', config['SAMPLETODO_PAGE_LIMIT'])
+  try:
+    limit = int(limit)
+  except ValueError:
+    raise ModelsException('Invalid limit - %s' % limit)
+
+  if limit < 1 or limit > config['SAMPLETODO_MAX_PAGE_LIMIT']:
+    raise ModelsException('Invalid limit - %s' % limit)
+
+  return limit, request.query.get('cursor')
+
+def fields_arg(request):
+  ''' Parse the fields query parameter into a projection, None for every attribute '''
+  return parse_fields(request.query.get('fields'))
+
+@web.middleware
+async def request_middleware(request, handler):
+  ''' Request id, request/response logging and error handling '''
+  request['request_id'] = utils.generate_request_id(request.headers.get('X-Request-Id'))
+  log.info('request', request_id=request['request_id'],
+           request_remote_addr=request.remote,
+           request_method=request.method,
+           request_scheme=request.scheme,
+           request_full_path=request.path_qs)
+
+  try:
+    response = await handler(request)
+  except web.HTTPNotFound as ex:
+    response = json_response(request, {'http_code': 404, 'text': str(ex)}, 404)
+  except web.HTTPException:
+    raise
+  except Exception:
+    log.error('exception', traceback=traceback.format_exc())
+    response = json_response(request, {'error': 'internal_server_error'}, 500)
+
+  response_status = 'success' if response.status < 400 else 'error'
+  (log.info if response_status == 'success' else log.error)(
+    'response', request_id=request['request_id'], response_status=response_status,
+    response_content_length=response.content_length,
+    response_status_code=response.status)
+  response.headers['X-Request-Id'] = request['request_id']
+  return response
+
+@routes.post('/todo/api/v1.0/reconnect-db')
+@login_required
+async def reconnect_db(request):
+  ''' Replace the DynamoDB client '''
+  log.info('recreating_db_connection')
+  await request.app[DB_KEY].refresh_aws_connection()
+  return json_response(request, {'status': 'done'})
+
+@routes.get('/todo/api/v1.0/tasks')
+@login_required
+@conditional
+async def get_tasks(request):
+  ''' Get a page of tasks '''
+  try:
+    limit, cursor = pagination_args(request)
+    result = await request.app[DB_KEY].list_items(limit=limit, cursor=cursor,
+                                                  projection=fields_arg(request))
+  except ModelsException as ex:
+    return bad_request(request, ex)
+
+  return json_response(request, {'tasks': result.get('Items', []),
+                                 'next_cursor': result.get('NextCursor')})
+
+@routes.get('/todo/api/v1.0/tasks/status/{task_status}')
+@login_required
+@conditional
+async def get_tasks_by_status(request):
+  ''' Get tasks by done status '''
+  task_status = request.match_info['task_status']
+  if task_status != 'pending' and task_status != 'done':
+    return bad_request(request, 'Invalid task status - %s' % task_status)
+
+  try:
+    limit, cursor = pagination_args(request)
+    result = await request.app[DB_KEY].get_items_by_status(task_status == 'done',
+                                                           limit=limit, cursor=cursor,
+                                                           projection=fields_arg(request))
+  except ModelsException as ex:
+    return bad_request(request, ex)
+
+  return json_response(request, {'tasks': result.get('Items', []),
+                                 'next_cursor': result.get('NextCursor')})
+
+@routes.get('/todo/api/v1.0/tasks/search')
+@login_required
+@conditional
+async def search_tasks(request):
+  ''' Get tasks by title prefix '''
+  title = request.query.get('title')
+  if not title:
+    return bad_request(request, 'Title prefix not provided')
+
+  try:
+    limit, cursor = pagination_args(request)
+    result = await request.app[DB_KEY].get_item_by_title(title, limit=limit, cursor=cursor,
+                                                         projection=fields_arg(request))
+  except ModelsException as ex:
+    return bad_request(request, ex)
+
+  return json_response(request, {'tasks': result.get('Items', []),
+                                 'next_cursor': result.get('NextCursor')})
+
+@routes.get('/todo/api/v1.0/tasks/stats')
+@login_required
+@conditional
+async def task_stats(request):
+  ''' Task counts per status from the counters, no task is read '''
+  counts = await request.app[DB_KEY].task_counts()
+  return json_response(request, {'stats': dict(counts, total=sum(counts.values()))})
+
+@routes.post('/todo/api/v1.0/tasks/lookup')
+@login_required
+async def lookup_tasks(request):
+  ''' Get many tasks by id in one request '''
+  body = await request_json(request)
+  if not body:
+    return bad_request(request, 'Request body must be JSON')
+
+  task_ids = body.get('ids')
+  fields = body.get('fields')
+
+  if not isinstance(task_ids, list) or \
+     not all(isinstance(task_id, utils.string_types) and task_id for task_id in task_ids):
+    return bad_request(request, 'ids must be a list of task ids')
+
+  if fields is not None and \
+     (not isinstance(fields, list) or
+      not all(isinstance(field, utils.string_types) and field for field in fields)):
+    return bad_request(request, 'fields must be a list of attribute names')
+
+  try:
+    # the same names and limit as the fields query parameter
+    projection = None if fields is None else fields_projection(fields)
+  except ModelsException as ex:
+    return bad_request(request, ex)
+
+  max_items = request.app[CONFIG_KEY]['SAMPLETODO_BATCH_MAX_ITEMS']
+  if len(task_ids) > max_items:
+    return bad_request(request, 'Lookup is limited to %s tasks' % max_items)
+
+  result = await request.app[DB_KEY].get_items_by_ids(task_ids, projection=projection)
+  return json_response(request, {'tasks': result['Items'],
+                                 'missing': result['MissingIds'],
+                                 'unprocessed': result['UnprocessedIds']})
+
+@routes.get('/todo/api/v1.0/tasks/{task_id}')
+@login_required
+@conditional
+async def get_task(request):
+  ''' Return task from todo list '''
+  try:
+    result = await request.app[DB_KEY].get_item_by_id(request.match_info['task_id'],
+                                                      projection=fields_arg(request))
+  except ModelsException as ex:
+    return bad_request(request, ex)
+  return json_response(request, {'task': result.get('Item', {})})
+
+@routes.post('/todo/api/v1.0/tasks')
+@login_required
+async def create_task(request):
+  ''' Add task to todo list '''
+  body = await request_json(request)
+  if not body:
+    return bad_request(request, 'Request body must be JSON')
+
+  try:
+    result = await request.app[DB_KEY].put_item(body)
+  except ModelsException as ex:
+    return bad_request(request, ex)
+
+  return json_response(request, {'task': result}, 201)
+
+@routes.post('/todo/api/v1.0/tasks/batch')
+@login_required
+async def batch_tasks(request):
+  ''' Create and delete tasks in bulk '''
+  body = await request_json(request)
+  if not body:
+    return bad_request(request, 'Request body must be JSON')
+
+  creates = body.get('create', [])
+  deletes = body.get('delete', [])
+  if not isinstance(creates, list) or not isinstance(deletes, list):
+    return bad_request(request, 'create and delete must be lists')
+
+  max_items = request.app[CONFIG_KEY]['SAMPLETODO_BATCH_MAX_ITEMS']
+  if len(creates) + len(deletes) > max_items:
+    return bad_request(request, 'Batch is limited to %s tasks' % max_items)
+
+  result = await request.app[DB_KEY].batch_write_items(creates, deletes)
+  return json_response(request, result)
+
+@routes.put('/todo/api/v1.0/tasks/{task_id}')
+@login_required
+async def update_task(request):
+  ''' Update task from todo list '''
+  body = await request_json(request)
+  if not body:
+    return bad_request(request, 'Request body must be JSON')
+
+  try:
+    result = await request.app[DB_KEY].update_item(request.match_info['task_id'], body)
+  except ModelsException as ex:
+    return bad_request(request, ex)
+
+  return json_response(request, {'task': result['Attributes']})
+
+@routes.delete('/todo/api/v1.0/tasks/{task_id}')
+@login_required
+async def delete_task(request):
+  ''' Delete task '''
+  task_id = request.match_info['task_id']
+  await request.app[DB_KEY].delete_item(task_id)
+  return json_response(request, {'id': task_id, 'deleted': True})
+
+@routes.delete('/todo/api/v1.0/tasks')
+@login_required
+async def delete_all_tasks(request):
+  ''' Delete all tasks '''
+  result = await request.app[DB_KEY].delete_all_items()
+  return json_response(request, dict(result, deleted=True))
+
+@routes.get('/todo/api/v1.0/health')
+async def health(request):
+  ''' Basic health test '''
+  return json_response(request, {'status': 'good'})
+
+@routes.get('/todo/api/v1.0/health/db')
+async def health_db(request):
+  ''' Table health from cached metadata '''
+  info = await request.app[DB_KEY].table_info()
+  if info.get('status') != 'ACTIVE':
+    return json_response(request, {'status': 'bad', 'table_status': info.get('status')}, 503)
+  return json_response(request, {'status': 'good', 'table_status': info['status']})
+
+@routes.get('/todo/api/v1.0/table')
+@login_required
+async def table_info(request):
+  ''' Table status, size and indexes '''
+  return json_response(request, {'table': await request.app[DB_KEY].table_info()})
+
+@routes.get('/todo/api/v1.0/build_version')
+async def build_version(request):
+  ''' Return build_version '''
+  return json_response(request, {'build_version': '%s' % __version__})
+
+def create_async_db(config):
+  ''' Create the async DB object from the same settings as create_db '''
+  dynamodb_args = dict((param, value) for param, value in config.items()
+                       if param.startswith('DYNAMODB') or param.startswith('AWS'))
+  return AsyncTasksTable(**dynamodb_args)
+
+def create_async_app(config, verify=verify_password):
+  ''' Create the aiohttp app, the DB connects on startup and closes on cleanup '''
+  obj = web.Application(middlewares=[request_middleware])
+  obj[CONFIG_KEY] = config
+  obj[VERIFY_PASSWORD_KEY] = verify
+  obj.add_routes(routes)
+
+  async def db_context(app_obj):
+    app_obj[DB_KEY] = create_async_db(config)
+    async with app_obj[DB_KEY]:
+      yield
+
+  obj.cleanup_ctx.append(db_context)
+  return obj
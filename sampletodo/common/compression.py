@@ -0,0 +1,113 @@
+''' Content negotiated gzip and brotli response compression '''
+
+import zlib
+import itertools
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+# in order of preference when the client accepts both equally,
+# br is only offered when the optional brotli package is installed
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+COMPRESSIBLE_TYPES = ['application/json', 'text/plain']
+
+def compressor(encoding, level):
+  ''' (compress, finish) functions of an incremental compressor '''
+  if encoding == 'gzip':
+    # wbits 16 + MAX_WBITS writes the gzip header and trailer
+    obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return obj.compress, obj.flush
+  if encoding == 'br' and brotli is not None:
+    obj = brotli.Compressor(quality=level)
+    return obj.process, obj.finish
+  raise ValueError('Unsupported encoding - %s' % encoding)
+
+def compress(data, encoding, level):
+  ''' Compress a whole body '''
+  process, finish = compressor(encoding, level)
+  return process(data) + finish()
+
+def compress_iter(chunks, encoding, level, close=None):
+  ''' Compress chunks as they are produced, nothing is buffered beyond the compressor window '''
+  process, finish = compressor(encoding, level)
+  try:
+    for chunk in chunks:
+      if not isinstance(chunk, bytes):
+        chunk = chunk.encode('utf-8')
+      data = process(chunk)
+      # the compressor holds small chunks back, skip the empty writes
+      if data:
+        yield data
+    yield finish()
+  finally:
+    if close is not None:
+      close()
+
+def compressible(response):
+  ''' Successful, not yet encoded bodies of the text types we serve '''
+  return 200 <= response.status_code < 300 and response.status_code != 204 and \
+         response.mimetype in COMPRESSIBLE_TYPES and \
+         'Content-Encoding' not in response.headers and \
+         not response.direct_passthrough
+
+def _level(encoding, config):
+  if encoding == 'br':
+    return config['SAMPLETODO_BROTLI_LEVEL']
+  return config['SAMPLETODO_GZIP_LEVEL']
+
+def compress_response(response, accept_encodings, config):
+  ''' Compress response in place with the best encoding the client accepts
+
+  Bodies below SAMPLETODO_COMPRESSION_MIN_SIZE are sent as they are.
+  Streamed bodies are compressed chunk by chunk while they are sent,
+  only the first SAMPLETODO_COMPRESSION_MIN_SIZE bytes are read ahead
+  to decide whether they are worth it.
+  '''
+  if not config['SAMPLETODO_COMPRESSION_ENABLED'] or not compressible(response):
+    return response
+
+  # the body depends on the header whether or not this one gets compressed
+  response.vary.add('Accept-Encoding')
+  encoding = accept_encodings.best_match(ENCODINGS)
+  if encoding is None:
+    return response
+
+  level = _level(encoding, config)
+  min_size = config['SAMPLETODO_COMPRESSION_MIN_SIZE']
+
+  if response.is_streamed:
+    source = response.response
+    chunks = iter(source)
+    head = []
+    size = 0
+    for chunk in chunks:
+      if not isinstance(chunk, bytes):
+        chunk = chunk.encode('utf-8')
+      head.append(chunk)
+      size += len(chunk)
+      if size >= min_size:
+        break
+    else:
+      # the whole stream was shorter than the threshold
+      if hasattr(source, 'close'):
+        source.close()
+      response.set_data(b''.join(head))
+      return response
+    response.response = compress_iter(itertools.chain(head, chunks), encoding, level,
+                                      close=getattr(source, 'close', None))
+    response.headers.pop('Content-Length', None)
+  else:
+    data = response.get_data()
+    if len(data) < min_size:
+      return response
+    response.set_data(compress(data, encoding, level))
+
+  response.headers['Content-Encoding'] = encoding
+  # strong validators are byte for byte, the encoded body needs its own
+  etag, weak = response.get_etag()
+  if etag and not weak:
+    response.set_etag('%s-%s' % (etag, encoding))
+  return response
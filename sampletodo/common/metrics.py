@@ -0,0 +1,449 @@
+''' In-process metrics with Prometheus text exposition '''
+
+import bisect
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import types
+import uuid
+from collections import OrderedDict
+
+# counters and histograms of every worker that exited, summed into one snapshot
+EXITED_SNAPSHOT = 'metrics-exited.json'
+
+# seconds, from a cached DynamoDB read to a slow scan
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metric(object):
+  ''' Values per label combination, label values are passed positionally '''
+  kind = None
+
+  def __init__(self, name, doc, labels=()):
+    self.name = name
+    self.doc = doc
+    self.labels = tuple(labels)
+    self._lock = threading.Lock()
+    self._values = {}
+
+  def reset(self):
+    with self._lock:
+      self._values = {}
+
+  def samples(self):
+    ''' [[label values, value]] '''
+    with self._lock:
+      return [[list(key), value] for key, value in self._values.items()]
+
+class Counter(Metric):
+  kind = 'counter'
+
+  def __init__(self, name, doc, labels=()):
+    super(Counter, self).__init__(name, doc, labels)
+    # last total seen by inc_to per label combination
+    self._totals = {}
+
+  def inc(self, amount=1, *label_values):
+    with self._lock:
+      self._values[label_values] = self._values.get(label_values, 0) + amount
+
+  def inc_to(self, total, *label_values):
+    ''' Add what a total something else keeps grew by since the last call
+
+    A total that went down started over, all of it is new.
+    '''
+    with self._lock:
+      last = self._totals.get(label_values, 0)
+      self._totals[label_values] = total
+      amount = total - last if total >= last else total
+      self._values[label_values] = self._values.get(label_values, 0) + amount
+
+  def reset(self):
+    with self._lock:
+      self._values = {}
+      self._totals = {}
+
+class Gauge(Metric):
+  ''' Point in time values, dropped from the merge once their worker exits '''
+  kind = 'gauge'
+
+  def set(self, value, *label_values):
+    ''' Replace the value '''
+    with self._lock:
+      self._values[label_values] = value
+
+class Histogram(Metric):
+  kind = 'histogram'
+
+  def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+    super(Histogram, self).__init__(name, doc, labels)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value, *label_values):
+    ''' Count value in its bucket, the exposition makes the buckets cumulative '''
+    index = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      entry = self._values.get(label_values)
+      if entry is None:
+        # one count per bucket plus +Inf, then the sum
+        entry = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+      entry[index] += 1
+      entry[-1] += value
+
+  def samples(self):
+    ''' [[label values, bucket counts, sum]] '''
+    with self._lock:
+      return [[list(key), entry[:-1], entry[-1]] for key, entry in self._values.items()]
+
+_local = threading.local()
+
+def current_method():
+  ''' Model method running on this thread, for attributing DynamoDB calls '''
+  return getattr(_local, 'method', None) or 'other'
+
+def propagate(func):
+  ''' Run func with the calling thread's model method, for executor threads '''
+  method = getattr(_local, 'method', None)
+
+  def wrapper(*args, **kwargs):
+    previous = getattr(_local, 'method', None)
+    _local.method = method
+    try:
+      return func(*args, **kwargs)
+    finally:
+      _local.method = previous
+  return wrapper
+
+def _pid_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError:
+    return False
+  return True
+
+def _snapshot_pid(filename):
+  ''' pid of a metrics-<pid>-<token>.json snapshot, None for other files '''
+  if not (filename.startswith('metrics-') and filename.endswith('.json')):
+    return None
+  try:
+    return int(filename[len('metrics-'):-len('.json')].split('-')[0])
+  except ValueError:
+    return None
+
+def _merge(merged, snapshot, alive=True):
+  ''' Add the samples of snapshot to merged, samples keyed by their label values '''
+  for name, entry in snapshot.items():
+    if entry['kind'] == 'gauge' and not alive:
+      continue
+    target = merged.setdefault(name, dict(entry, samples=OrderedDict()))
+    for sample in entry['samples']:
+      key = tuple(sample[0])
+      if entry['kind'] == 'histogram':
+        counts, total = target['samples'].get(key, ([0] * len(sample[1]), 0.0))
+        target['samples'][key] = ([a + b for a, b in zip(counts, sample[1])],
+                                  total + sample[2])
+      else:
+        target['samples'][key] = target['samples'].get(key, 0) + sample[1]
+  return merged
+
+def _unmerge(merged):
+  ''' merged values back in the snapshot layout '''
+  snapshot = OrderedDict()
+  for name, entry in merged.items():
+    if entry['kind'] == 'histogram':
+      samples = [[list(key), counts, total] for key, (counts, total) in entry['samples'].items()]
+    else:
+      samples = [[list(key), value] for key, value in entry['samples'].items()]
+    snapshot[name] = dict(entry, samples=samples)
+  return snapshot
+
+class Registry(object):
+  ''' Metrics of one process, merged with the other workers' through snapshot files
+
+  Without a directory only this process is reported. With one, every
+  process writes its snapshot to <directory>/metrics-<pid>-<token>.json at
+  most every flush_interval seconds and before rendering, and rendering sums
+  the snapshots. The token tells apart processes that got the same pid.
+  Counters and histograms of exited workers are folded into one
+  metrics-exited.json snapshot, so totals never go backwards; their gauges
+  are dropped.
+  '''
+
+  def __init__(self):
+    self._metrics = OrderedDict()
+    self._collectors = []
+    self.directory = None
+    self.flush_interval = 5
+    self._last_flush = 0
+    self._token = uuid.uuid4().hex[:8]
+
+  def _add(self, metric):
+    self._metrics[metric.name] = metric
+    return metric
+
+  def counter(self, name, doc, labels=()):
+    return self._add(Counter(name, doc, labels))
+
+  def gauge(self, name, doc, labels=()):
+    return self._add(Gauge(name, doc, labels))
+
+  def histogram(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+    return self._add(Histogram(name, doc, labels, buckets))
+
+  def add_collector(self, collector):
+    ''' collector() is called before every snapshot to set gauges from other stats '''
+    self._collectors.append(collector)
+
+  def configure(self, directory=None, flush_interval=None):
+    self.directory = directory
+    if flush_interval is not None:
+      self.flush_interval = flush_interval
+
+  def reset(self):
+    ''' Forget every value, forked children start from zero '''
+    for metric in self._metrics.values():
+      metric.reset()
+    self._last_flush = 0
+    self._token = uuid.uuid4().hex[:8]
+
+  def snapshot(self):
+    ''' JSON serializable values of this process '''
+    for collector in self._collectors:
+      collector()
+
+    data = OrderedDict()
+    for name, metric in self._metrics.items():
+      entry = {'kind': metric.kind, 'doc': metric.doc, 'labels': list(metric.labels),
+               'samples': metric.samples()}
+      if metric.kind == 'histogram':
+        entry['buckets'] = list(metric.buckets)
+      data[name] = entry
+    return data
+
+  def _path(self, filename):
+    return os.path.join(self.directory, filename)
+
+  def _read(self, filename):
+    try:
+      with open(self._path(filename)) as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError):
+      # replaced or removed while reading, the next scrape gets it
+      return None
+
+  def _write(self, filename, snapshot):
+    fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.metrics-')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(snapshot, f)
+    # rename is atomic, readers never see a partial snapshot
+    os.rename(tmp_path, self._path(filename))
+
+  def flush(self):
+    ''' Write this process' snapshot for the other workers to merge '''
+    if not self.directory:
+      return
+    self._last_flush = time.time()
+    self._write('metrics-%s-%s.json' % (os.getpid(), self._token), self.snapshot())
+
+  def maybe_flush(self):
+    ''' flush at most every flush_interval seconds, cheap enough for every request '''
+    if self.directory and time.time() - self._last_flush >= self.flush_interval:
+      self.flush()
+
+  def _fold_exited(self, filenames):
+    ''' Add the snapshots of exited workers to the exited snapshot and remove them '''
+    # scrapes served by different workers must not fold the same file twice
+    with open(self._path('.metrics-exited.lock'), 'a') as lock:
+      fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+      merged = _merge(OrderedDict(), self._read(EXITED_SNAPSHOT) or {}, alive=False)
+      folded = []
+      for filename in filenames:
+        snapshot = self._read(filename)
+        if snapshot is not None:
+          _merge(merged, snapshot, alive=False)
+          folded.append(filename)
+      if not folded:
+        return
+      self._write(EXITED_SNAPSHOT, _unmerge(merged))
+      for filename in folded:
+        os.remove(self._path(filename))
+
+  def _snapshots(self):
+    ''' (alive, snapshot) of every running process and of the exited ones together '''
+    if not self.directory:
+      return [(True, self.snapshot())]
+
+    self.flush()
+    snapshots = []
+    exited = []
+    for filename in os.listdir(self.directory):
+      pid = _snapshot_pid(filename)
+      if pid is None:
+        continue
+      if not _pid_alive(pid):
+        exited.append(filename)
+        continue
+      snapshot = self._read(filename)
+      if snapshot is not None:
+        snapshots.append((True, snapshot))
+
+    if exited:
+      self._fold_exited(exited)
+    snapshot = self._read(EXITED_SNAPSHOT)
+    if snapshot is not None:
+      snapshots.append((False, snapshot))
+    return snapshots
+
+  def collect(self):
+    ''' Values summed across processes '''
+    merged = OrderedDict()
+    for alive, snapshot in self._snapshots():
+      _merge(merged, snapshot, alive)
+    return merged
+
+  def render(self):
+    ''' Prometheus text exposition format 0.0.4 '''
+    lines = []
+    for name, entry in self.collect().items():
+      lines.append('# HELP %s %s' % (name, entry['doc']))
+      lines.append('# TYPE %s %s' % (name, entry['kind']))
+      for key, value in sorted(entry['samples'].items()):
+        labels = list(zip(entry['labels'], key))
+        if entry['kind'] != 'histogram':
+          lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+          continue
+
+        counts, total = value
+        cumulative = 0
+        for bound, count in zip(list(entry['buckets']) + ['+Inf'], counts):
+          cumulative += count
+          le = bound if bound == '+Inf' else _number(bound)
+          lines.append('%s_bucket%s %s' % (name, _labels(labels + [('le', le)]), cumulative))
+        lines.append('%s_sum%s %s' % (name, _labels(labels), _number(total)))
+        lines.append('%s_count%s %s' % (name, _labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+def _number(value):
+  return repr(float(value))
+
+def _labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, ('%s' % value).replace('\\', r'\\')
+                                                                .replace('"', r'\"')
+                                                                .replace('\n', r'\n'))
+                           for name, value in labels)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = Registry()
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=REGISTRY.reset)
+
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+  'sampletodo_http_request_duration_seconds', 'HTTP request latency',
+  ['route', 'method', 'status'])
+
+BACKEND_METHOD_DURATION = REGISTRY.histogram(
+  'sampletodo_backend_method_duration_seconds', 'Storage backend method latency',
+  ['backend', 'method'])
+BACKEND_METHOD_ERRORS = REGISTRY.counter(
+  'sampletodo_backend_method_errors_total', 'Storage backend methods that raised',
+  ['backend', 'method', 'error'])
+
+DYNAMODB_CALL_DURATION = REGISTRY.histogram(
+  'sampletodo_dynamodb_call_duration_seconds', 'DynamoDB API call latency including retries',
+  ['method', 'operation'])
+DYNAMODB_ERRORS = REGISTRY.counter(
+  'sampletodo_dynamodb_errors_total', 'DynamoDB API calls that failed after retries',
+  ['method', 'operation', 'code'])
+DYNAMODB_RETRIES = REGISTRY.counter(
+  'sampletodo_dynamodb_retries_total', 'DynamoDB API call attempts retried by botocore',
+  ['method', 'operation'])
+DYNAMODB_THROTTLES = REGISTRY.counter(
+  'sampletodo_dynamodb_throttles_total', 'DynamoDB API call attempts that were throttled',
+  ['method', 'operation'])
+DYNAMODB_CONSUMED_CAPACITY = REGISTRY.counter(
+  'sampletodo_dynamodb_consumed_capacity_units_total', 'Consumed read and write capacity units',
+  ['method', 'operation', 'kind'])
+
+DYNAMODB_COUNTER_FAILURES = REGISTRY.counter(
+  'sampletodo_dynamodb_counter_update_failures_total',
+  'Writes whose change version and count update failed, the counts are off until reconcile-counts',
+  ['code'])
+
+DYNAMODB_POOL = REGISTRY.gauge(
+  'sampletodo_dynamodb_pool_connections', 'HTTP connections of the DynamoDB clients',
+  ['state'])
+
+CACHE_EVENTS = REGISTRY.counter(
+  'sampletodo_cache_events_total', 'Item cache lookups and removals', ['event'])
+CACHE_SIZE = REGISTRY.gauge(
+  'sampletodo_cache_size', 'Item cache entries and bytes', ['unit'])
+
+INGEST_QUEUE = REGISTRY.gauge(
+  'sampletodo_ingest_queue_tasks', 'Write-behind tasks accepted and not written yet', ['state'])
+INGEST_TASKS = REGISTRY.counter(
+  'sampletodo_ingest_tasks_total', 'Write-behind tasks by what happened to them', ['outcome'])
+
+class InstrumentedTable(object):
+  ''' Storage backend wrapper that times every public method
+
+  The method name is kept in a thread local while it runs, so the
+  DynamoDB client hooks can attribute their calls to it. The stats the
+  metrics scrape reads are not timed, every scrape would add samples.
+  '''
+  UNTIMED = frozenset(['cache_stats', 'ingest_stats', 'pool_stats'])
+
+  def __init__(self, table, backend):
+    self.table = table
+    self.backend = backend
+
+  def __getattr__(self, name):
+    attr = getattr(self.table, name)
+    if name.startswith('_') or name in self.UNTIMED or not callable(attr):
+      return attr
+
+    def timed(*args, **kwargs):
+      _local.method = name
+      start = time.time()
+      try:
+        result = attr(*args, **kwargs)
+      except Exception as ex:
+        BACKEND_METHOD_DURATION.observe(time.time() - start, self.backend, name)
+        BACKEND_METHOD_ERRORS.inc(1, self.backend, name, type(ex).__name__)
+        raise
+      finally:
+        _local.method = None
+      if isinstance(result, types.GeneratorType):
+        return self._timed_iter(name, result)
+      BACKEND_METHOD_DURATION.observe(time.time() - start, self.backend, name)
+      return result
+
+    # bound once, later lookups do not come through __getattr__
+    self.__dict__[name] = timed
+    return timed
+
+  def _timed_iter(self, name, iterator):
+    ''' Scans are generators, their calls happen while the caller iterates '''
+    start = time.time()
+    try:
+      while True:
+        _local.method = name
+        try:
+          item = next(iterator)
+        except StopIteration:
+          return
+        except Exception as ex:
+          BACKEND_METHOD_ERRORS.inc(1, self.backend, name, type(ex).__name__)
+          raise
+        finally:
+          _local.method = None
+        yield item
+    finally:
+      # a consumer that stops early also stops the scan
+      iterator.close()
+      BACKEND_METHOD_DURATION.observe(time.time() - start, self.backend, name)
@@ -1,11 +1,71 @@
 import os
 import uuid
+import atexit
+import random
+import decimal
+import threading
 import logging
+import logging.config
+import logging.handlers
 import flask
 import boto3
+import simplejson
 import structlog
 from termcolor import colored
 
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+try:
+  string_types = basestring
+except NameError:
+  string_types = str
+
+class ProcessLocalProxy(object):
+  ''' Build an object on first use and rebuild it in forked children
+
+  Lets module level objects like the DB stay cheap at import time and makes
+  every pre-forked worker create its own connections after fork.
+  '''
+  def __init__(self, factory):
+    self._factory = factory
+    self._lock = threading.Lock()
+    self._obj = None
+    self._pid = None
+
+  def get(self):
+    ''' Return the object for this process, building it if needed '''
+    if self._obj is None or self._pid != os.getpid():
+      with self._lock:
+        if self._obj is None or self._pid != os.getpid():
+          self._obj = self._factory()
+          self._pid = os.getpid()
+    return self._obj
+
+  def peek(self):
+    ''' The object if this process already built it, None otherwise '''
+    if self._pid != os.getpid():
+      return None
+    return self._obj
+
+  def __getattr__(self, name):
+    return getattr(self.get(), name)
+
+def json_default(obj):
+  ''' json.dumps default for the types DynamoDB hands back '''
+  if isinstance(obj, decimal.Decimal):
+    return int(obj) if obj == obj.to_integral_value() else float(obj)
+  if isinstance(obj, (set, frozenset)):
+    return sorted(obj)
+  raise TypeError('%r is not JSON serializable' % (obj,))
+
+def dumps_json(data):
+  ''' Encode data in a single pass, DynamoDB Decimals are written as JSON numbers '''
+  return simplejson.dumps(data, use_decimal=True, default=json_default,
+                          separators=(',', ':'))
+
 def setup_lib_log_levels():
   ''' Setup other libraries log level '''
   logging.getLogger('werkzeug').setLevel(logging.ERROR)
@@ -29,10 +89,10 @@ def generate_request_id(original_id=''):
 #  * If we've already created a request ID and stored it in the flask.g context local, use that
 #  * If a client has passed in the X-Request-Id header, create a new ID with that prepended
 #  * Otherwise, generate a request ID and store it in flask.g.request_id
-def request_id():
+def request_id(tty=False):
   ''' Get request id '''
   if getattr(flask.g, 'request_id', None):
-    if os.environ['SAMPLETODO_TTY'] == 'True':
+    if tty:
       return colored(flask.g.request_id, 'green')
     return flask.g.request_id
 
@@ -41,7 +101,7 @@ def request_id():
   new_uuid = generate_request_id(original_request_id)
   flask.g.request_id = new_uuid
 
-  if os.environ['SAMPLETODO_TTY'] == 'True':
+  if tty:
     new_uuid = colored(new_uuid, 'green')
 
   return new_uuid
@@ -50,25 +110,122 @@ class RequestIdFilter(logging.Filter):
   # This is a logging filter that makes the request ID available for use in
   # the logging format. Note that we're checking if we're in a request
   # context, as we may want to log things before Flask is fully loaded.
+  # The tty flag is fixed when logging is set up instead of being read from
+  # the environment for every record.
+  def __init__(self, tty=False):
+    logging.Filter.__init__(self)
+    self.tty = tty
+
   def filter(self, record):
-    record.request_id = request_id() if flask.has_request_context() else ''
+    record.request_id = request_id(self.tty) if flask.has_request_context() else ''
     return True
 
+class SuccessLogSampler(object):
+  ''' structlog processor that keeps only a sample of debug/info events
+
+  Warnings and errors are always kept. Inside a request the decision is made
+  once, so a sampled request keeps all of its log lines.
+  '''
+  def __init__(self, rate):
+    self.rate = rate
+
+  def __call__(self, _, method_name, event_dict):
+    if self.rate >= 1 or method_name not in ('debug', 'info'):
+      return event_dict
+
+    if flask.has_request_context():
+      sampled = getattr(flask.g, 'log_sampled', None)
+      if sampled is None:
+        sampled = flask.g.log_sampled = random.random() < self.rate
+    else:
+      sampled = random.random() < self.rate
+
+    if not sampled:
+      raise structlog.DropEvent
+    return event_dict
+
+if hasattr(logging.handlers, 'QueueHandler'):
+  class DeferredQueueHandler(logging.handlers.QueueHandler):
+    ''' QueueHandler that leaves formatting to the listener thread '''
+    def prepare(self, record):
+      # the stock prepare() renders the message on the calling thread, which
+      # is exactly the work the listener is there to take over
+      return record
+else:
+  DeferredQueueHandler = None
+
+_queue_listener = None
+# what logging.LogRecord looks up for every record, production mode turns them off
+_RECORD_LOOKUPS = ('logThreads', 'logMultiprocessing', 'logProcesses')
+_record_lookups = dict((flag, getattr(logging, flag)) for flag in _RECORD_LOOKUPS)
+_pid = os.getpid()
+
+def _start_queue_listener(handlers):
+  ''' Move handlers behind a queue drained by a background thread '''
+  global _queue_listener
+
+  log_queue = queue.Queue(-1)
+  queue_handler = DeferredQueueHandler(log_queue)
+  for handler in handlers:
+    # request ids live in the flask context, they must be read on the request thread
+    for log_filter in handler.filters[:]:
+      queue_handler.addFilter(log_filter)
+      handler.removeFilter(log_filter)
+
+  _queue_listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                                   respect_handler_level=True)
+  _queue_listener.start()
+  return queue_handler
+
+def stop_queue_listener():
+  ''' Flush and stop the background log writer '''
+  global _queue_listener
+  if _queue_listener is not None:
+    _queue_listener.stop()
+    _queue_listener = None
+
+def _restart_queue_listener_after_fork():
+  ''' Threads do not survive fork, start a fresh writer in the child '''
+  if _queue_listener is not None:
+    _queue_listener._thread = None
+    _queue_listener.start()
+
+def _refresh_pid_after_fork():
+  global _pid
+  _pid = os.getpid()
+
+atexit.register(stop_queue_listener)
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_refresh_pid_after_fork)
+  os.register_at_fork(after_in_child=_restart_queue_listener_after_fork)
+
 def _app_namer(_, __, event_dict):
   ''' app namer structlog processor '''
   event_dict['app_name'] = 'sampletodo_web_server'
   return event_dict
 
+def _add_process(_, __, event_dict):
+  ''' pid structlog processor, for records that do not look it up themselves '''
+  event_dict['process'] = _pid
+  return event_dict
+
 # based on the understanding gained by
 # https://blog.sneawo.com/blog/2017/07/28/json-logging-in-python/
-def setup_structlog(tty=False, logging_level=logging.INFO):
-  ''' Setup structlog module '''
+def setup_structlog(tty=False, logging_level=logging.INFO, production=False, sample_rate=1.0):
+  ''' Setup structlog module
+
+  production mode keeps logging off the request path: the format has no
+  caller file/line, records skip the thread and process lookups, info events
+  can be sampled and records are rendered and written by a background
+  QueueListener thread.
+  '''
   # configure logging module
   logging_config = {
     'version': 1,
     'filters': {
       'request_id': {
-        '()': 'sampletodo.utils.RequestIdFilter'
+        '()': 'sampletodo.common.utils.RequestIdFilter',
+        'tty': tty
       }
     },
     'disable_existing_loggers': False,
@@ -96,9 +253,13 @@ def setup_structlog(tty=False, logging_level=logging.INFO):
     }
     logging_config['loggers']['']['handlers'].append('tty')
   else:
+    log_format = '%(lineno)d %(process)s %(pathname)s %(funcName) %(request_id)s'
+    if production:
+      # _add_process puts the pid in the event instead
+      log_format = '%(request_id)s'
     logging_config['formatters']['json'] = {
       '()': 'pythonjsonlogger.jsonlogger.JsonFormatter',
-      'format': '%(lineno)d %(process)s %(pathname)s %(funcName) %(request_id)s',
+      'format': log_format,
     }
     logging_config['handlers']['json'] = {
       'class': 'logging.StreamHandler',
@@ -107,15 +268,31 @@ def setup_structlog(tty=False, logging_level=logging.INFO):
     }
     logging_config['loggers']['']['handlers'].append('json')
 
+  stop_queue_listener()
   logging.config.dictConfig(logging_config)
 
+  processors = [
+    _app_namer,
+    structlog.stdlib.filter_by_level,
+  ]
+  for flag, value in _record_lookups.items():
+    setattr(logging, flag, value and not production)
+  if production:
+    processors += [_add_process, SuccessLogSampler(sample_rate)]
+
+    root_logger = logging.getLogger()
+    if DeferredQueueHandler is not None:
+      handlers = root_logger.handlers[:]
+      for handler in handlers:
+        root_logger.removeHandler(handler)
+      root_logger.addHandler(_start_queue_listener(handlers))
+
   # configure structlog
   structlog.configure(
-    context_class=structlog.threadlocal.wrap_dict(dict),
+    context_class=dict,
     logger_factory=structlog.stdlib.LoggerFactory(),
-    processors=[
-      _app_namer,
-      structlog.stdlib.filter_by_level,
+    cache_logger_on_first_use=production,
+    processors=processors + [
       structlog.stdlib.add_logger_name,
       structlog.stdlib.add_log_level,
       structlog.stdlib.PositionalArgumentsFormatter(),
@@ -143,4 +320,7 @@ def setup_structlog_wrapper():
   if os.environ['SAMPLETODO_TTY'] == 'True':
     tty_logging = True
 
-  setup_structlog(tty_logging, logging_level)
+  production = os.environ.get('SAMPLETODO_LOG_MODE', 'development') == 'production'
+  sample_rate = float(os.environ.get('SAMPLETODO_LOG_SAMPLE_RATE', 1.0))
+
+  setup_structlog(tty_logging, logging_level, production, sample_rate)
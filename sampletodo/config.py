@@ -9,16 +9,103 @@ class Config(object):
 
   SAMPLETODO_HOST = os.getenv('SAMPLETODO_HOST', '127.0.0.1')
   SAMPLETODO_PORT = os.getenv('SAMPLETODO_PORT', 8080)
+  SAMPLETODO_SERVER = os.getenv('SAMPLETODO_SERVER', 'development')
+  # 0 means one worker per cpu core
+  SAMPLETODO_WORKERS = int(os.getenv('SAMPLETODO_WORKERS', 0))
+  SAMPLETODO_THREADS = int(os.getenv('SAMPLETODO_THREADS', 1))
+  SAMPLETODO_KEEPALIVE = int(os.getenv('SAMPLETODO_KEEPALIVE', 5))
+  SAMPLETODO_BACKLOG = int(os.getenv('SAMPLETODO_BACKLOG', 2048))
+  SAMPLETODO_WORKER_TIMEOUT = int(os.getenv('SAMPLETODO_WORKER_TIMEOUT', 30))
+  SAMPLETODO_GRACEFUL_TIMEOUT = int(os.getenv('SAMPLETODO_GRACEFUL_TIMEOUT', 30))
   SAMPLETODO_USERNAME = os.getenv('SAMPLETODO_USERNAME')
   SAMPLETODO_PASSWORD = os.getenv('SAMPLETODO_PASSWORD')
+  SAMPLETODO_PAGE_LIMIT = int(os.getenv('SAMPLETODO_PAGE_LIMIT', 100))
+  SAMPLETODO_MAX_PAGE_LIMIT = int(os.getenv('SAMPLETODO_MAX_PAGE_LIMIT', 1000))
+  SAMPLETODO_BATCH_MAX_ITEMS = int(os.getenv('SAMPLETODO_BATCH_MAX_ITEMS', 1000))
+
+  SAMPLETODO_METRICS_ENABLED = os.getenv('SAMPLETODO_METRICS_ENABLED', True)
+  if SAMPLETODO_METRICS_ENABLED == 'False':
+    SAMPLETODO_METRICS_ENABLED = False
+  # shared by pre-forked workers to merge their metrics, the production server
+  # creates a temporary one when this is not set
+  SAMPLETODO_METRICS_DIR = os.getenv('SAMPLETODO_METRICS_DIR')
+  SAMPLETODO_METRICS_FLUSH_INTERVAL = float(os.getenv('SAMPLETODO_METRICS_FLUSH_INTERVAL', 5))
+
+  SAMPLETODO_COMPRESSION_ENABLED = os.getenv('SAMPLETODO_COMPRESSION_ENABLED', True)
+  if SAMPLETODO_COMPRESSION_ENABLED == 'False':
+    SAMPLETODO_COMPRESSION_ENABLED = False
+  # smaller bodies are sent as they are, the encoding overhead eats the savings
+  SAMPLETODO_COMPRESSION_MIN_SIZE = int(os.getenv('SAMPLETODO_COMPRESSION_MIN_SIZE', 1024))
+  SAMPLETODO_GZIP_LEVEL = int(os.getenv('SAMPLETODO_GZIP_LEVEL', 6))
+  # br is only offered when the brotli package is installed
+  SAMPLETODO_BROTLI_LEVEL = int(os.getenv('SAMPLETODO_BROTLI_LEVEL', 4))
+
+  # POST /tasks answers 202 once the task is journaled and queued, see models/write_behind.py
+  SAMPLETODO_WRITE_BEHIND_ENABLED = os.getenv('SAMPLETODO_WRITE_BEHIND_ENABLED', False)
+  if SAMPLETODO_WRITE_BEHIND_ENABLED == 'False':
+    SAMPLETODO_WRITE_BEHIND_ENABLED = False
+  SAMPLETODO_WRITE_BEHIND_DIR = os.getenv('SAMPLETODO_WRITE_BEHIND_DIR', 'sampletodo-ingest')
+  SAMPLETODO_WRITE_BEHIND_QUEUE_SIZE = int(os.getenv('SAMPLETODO_WRITE_BEHIND_QUEUE_SIZE', 10000))
+  SAMPLETODO_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('SAMPLETODO_WRITE_BEHIND_BATCH_SIZE', 25))
+  SAMPLETODO_WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('SAMPLETODO_WRITE_BEHIND_FLUSH_INTERVAL', 0.05))
+  # how long a request waits for room in a full queue before it gets a 503
+  SAMPLETODO_WRITE_BEHIND_ENQUEUE_TIMEOUT = float(os.getenv('SAMPLETODO_WRITE_BEHIND_ENQUEUE_TIMEOUT', 0.5))
+  SAMPLETODO_WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv('SAMPLETODO_WRITE_BEHIND_MAX_ATTEMPTS', 5))
+  # False trades the tasks of the last moments before a machine crash for request latency
+  SAMPLETODO_WRITE_BEHIND_FSYNC = os.getenv('SAMPLETODO_WRITE_BEHIND_FSYNC', True)
+  if SAMPLETODO_WRITE_BEHIND_FSYNC == 'False':
+    SAMPLETODO_WRITE_BEHIND_FSYNC = False
+  SAMPLETODO_WRITE_BEHIND_STATUS_ENTRIES = int(os.getenv('SAMPLETODO_WRITE_BEHIND_STATUS_ENTRIES', 100000))
+
+  # dynamodb, sqlite or memory
+  SAMPLETODO_BACKEND = os.getenv('SAMPLETODO_BACKEND', 'dynamodb')
+  SQLITE_PATH = os.getenv('SQLITE_PATH', 'sampletodo.db')
+  SQLITE_TIMEOUT = float(os.getenv('SQLITE_TIMEOUT', 5))
+
+  AWS_ROLE_ARN = os.getenv('AWS_ROLE_ARN')
+  AWS_ROLE_SESSION_NAME = os.getenv('AWS_ROLE_SESSION_NAME', 'sampletodo')
+  AWS_ROLE_DURATION_SECONDS = int(os.getenv('AWS_ROLE_DURATION_SECONDS', 900))
+  AWS_CREDENTIALS_REFRESH_MARGIN = int(os.getenv('AWS_CREDENTIALS_REFRESH_MARGIN', 300))
 
   DYNAMODB_PORT = os.getenv('DYNAMODB_PORT', 8000)
   DYNAMODB_TABLE_NAME = os.getenv('DYNAMODB_TABLE_NAME', 'sampletodo-table')
+  DYNAMODB_STATUS_INDEX_NAME = os.getenv('DYNAMODB_STATUS_INDEX_NAME', 'task_status-createdat-index')
+  DYNAMODB_TITLE_INDEX_NAME = os.getenv('DYNAMODB_TITLE_INDEX_NAME', 'title_prefix-title_key-index')
+  DYNAMODB_BATCH_WORKERS = int(os.getenv('DYNAMODB_BATCH_WORKERS', 4))
+  DYNAMODB_SCAN_SEGMENTS = int(os.getenv('DYNAMODB_SCAN_SEGMENTS', 4))
+  DYNAMODB_SCAN_WORKERS = int(os.getenv('DYNAMODB_SCAN_WORKERS', 4))
+
+  # create the table on first connect instead of through sampletodo-manage create-table
+  DYNAMODB_AUTO_PROVISION = os.getenv('DYNAMODB_AUTO_PROVISION', False)
+  if DYNAMODB_AUTO_PROVISION == 'False':
+    DYNAMODB_AUTO_PROVISION = False
+
+  DYNAMODB_METADATA_REFRESH_INTERVAL = int(os.getenv('DYNAMODB_METADATA_REFRESH_INTERVAL', 60))
+  # how stale another process' writes can be in ETags, see TasksTable.change_version
+  DYNAMODB_CHANGE_VERSION_REFRESH_INTERVAL = float(os.getenv('DYNAMODB_CHANGE_VERSION_REFRESH_INTERVAL', 1))
+  DYNAMODB_MAX_POOL_CONNECTIONS = int(os.getenv('DYNAMODB_MAX_POOL_CONNECTIONS', 50))
+  DYNAMODB_PREWARM_CONNECTIONS = int(os.getenv('DYNAMODB_PREWARM_CONNECTIONS', 4))
+  DYNAMODB_CONNECT_TIMEOUT = float(os.getenv('DYNAMODB_CONNECT_TIMEOUT', 2))
+  DYNAMODB_READ_TIMEOUT = float(os.getenv('DYNAMODB_READ_TIMEOUT', 5))
+  DYNAMODB_MAX_ATTEMPTS = int(os.getenv('DYNAMODB_MAX_ATTEMPTS', 5))
+  # TOTAL or INDEXES feed the consumed capacity metrics, NONE stops asking for it
+  DYNAMODB_RETURN_CONSUMED_CAPACITY = os.getenv('DYNAMODB_RETURN_CONSUMED_CAPACITY', 'TOTAL')
+
+  DYNAMODB_CACHE_ENABLED = os.getenv('DYNAMODB_CACHE_ENABLED', False)
+  if DYNAMODB_CACHE_ENABLED == 'False':
+    DYNAMODB_CACHE_ENABLED = False
+  DYNAMODB_CACHE_MAX_ENTRIES = int(os.getenv('DYNAMODB_CACHE_MAX_ENTRIES', 10000))
+  DYNAMODB_CACHE_MAX_BYTES = int(os.getenv('DYNAMODB_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+  DYNAMODB_CACHE_TTL = int(os.getenv('DYNAMODB_CACHE_TTL', 30))
+  DYNAMODB_BATCH_MAX_RETRIES = int(os.getenv('DYNAMODB_BATCH_MAX_RETRIES', 8))
+  # counter items the writes spread over, only ever raise it, counts on dropped shards are lost
+  DYNAMODB_COUNTER_SHARDS = int(os.getenv('DYNAMODB_COUNTER_SHARDS', 8))
 
 class LocalRunConfig(Config):
   ''' Run flask locally '''
   DYNAMODB_ENABLE_LOCAL = True
   DYNAMODB_MOCK = False
+  DYNAMODB_AUTO_PROVISION = True
 
   AWS_ACCESS_KEY_ID = 'foo'
   AWS_SECRET_ACCESS_KEY = 'bar'
@@ -33,11 +120,15 @@ class TestLocalRunConfig(LocalRunConfig):
   DYNAMODB_ENABLE_LOCAL = False
   DYNAMODB_MOCK = True
   DYNAMODB_TABLE_NAME = os.getenv('DYNAMODB_TABLE_NAME', 'SampletodoTesting')
+  # the api tests run against mocked DynamoDB, SAMPLETODO_BACKEND=memory or sqlite and
+  # DYNAMODB_CACHE_ENABLED=True run them on another backend or through the item cache
+  SAMPLETODO_BACKEND = os.getenv('SAMPLETODO_BACKEND', 'dynamodb')
 
 class DockerConfig(Config):
   ''' Run flask via docker cmdline '''
   DYNAMODB_ENABLE_LOCAL = True
   DYNAMODB_MOCK = False
+  DYNAMODB_AUTO_PROVISION = True
 
   AWS_ACCESS_KEY_ID = 'foo'
   AWS_SECRET_ACCESS_KEY = 'bar'
@@ -51,6 +142,7 @@ class DockerComposeConfig(Config):
   ''' Run flask via docker compose '''
   DYNAMODB_ENABLE_LOCAL = True
   DYNAMODB_MOCK = False
+  DYNAMODB_AUTO_PROVISION = True
 
   AWS_ACCESS_KEY_ID = 'foo'
   AWS_SECRET_ACCESS_KEY = 'bar'
@@ -0,0 +1,54 @@
+''' Management commands for the todo api '''
+
+import argparse
+import json
+import sys
+
+import sampletodo.common.utils as utils
+
+def create_table():
+  ''' Create the table and its indexes unless they already exist '''
+  from sampletodo import app, create_db
+  # this is the provisioning step, connecting must not insist on an existing table
+  app.config['DYNAMODB_AUTO_PROVISION'] = True
+  obj = create_db(app)
+  # connecting already created a missing table, the second call would only find it
+  return getattr(obj, 'provisioned', None) or obj.provision_table()
+
+def migrate_indexes():
+  ''' Create missing secondary indexes and backfill their key attributes '''
+  from sampletodo import db
+  return db.migrate_indexes()
+
+def export_items():
+  ''' Stream every task to stdout as JSON lines using a parallel scan '''
+  from sampletodo import db
+  count = 0
+  for item in db.parallel_scan():
+    sys.stdout.write(json.dumps(item, sort_keys=True, default=utils.json_default) + '\n')
+    count += 1
+  return {'exported': count}
+
+def reconcile_counts():
+  ''' Recount the tasks per status and replace the counters the stats endpoint serves '''
+  from sampletodo import db
+  return db.reconcile_counts()
+
+COMMANDS = {
+  'create-table': create_table,
+  'export-items': export_items,
+  'migrate-indexes': migrate_indexes,
+  'reconcile-counts': reconcile_counts,
+}
+
+def main():
+  ''' Main function for the module '''
+  parser = argparse.ArgumentParser(description='sampletodo management commands')
+  parser.add_argument('command', choices=sorted(COMMANDS.keys()))
+  args = parser.parse_args()
+
+  result = COMMANDS[args.command]()
+  sys.stderr.write(json.dumps(result, indent=2, sort_keys=True, default=str) + '\n')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,550 @@
+''' Tasks table in dynamodb on an asyncio event loop
+
+Python 3 only, aiobotocore is imported by the async server and never by the
+flask app.
+'''
+
+import asyncio
+import random
+import time
+import traceback
+from collections import OrderedDict
+
+import structlog
+from aiobotocore.config import AioConfig
+from aiobotocore.credentials import AioRefreshableCredentials
+from aiobotocore.session import get_session
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import BotoCoreError, ClientError
+
+from sampletodo.version import __version__
+from sampletodo.models.dynamodb import ModelsException, BATCH_GET_SIZE, BATCH_WRITE_SIZE, \
+  COUNTER_ATTRS, SCAN_CURSOR_KEYS, STATUS_CURSOR_KEYS, TASKS_ONLY, TITLE_CURSOR_KEYS, \
+  attribute_definitions, backoff_delay, batch_write_deltas, batch_write_requests, \
+  bump_version_args, bumped_version, counter_failure_code, counter_ids, counts_from_items, \
+  delete_item_args, delete_requests, deleted_status, deserialize_item, encode_cursor, \
+  failed_puts, global_secondary_indexes, is_counter_id, key_condition_args, missing_task, \
+  new_item, projection_with_id, scan_expression_args, serialize_item, start_key, status_deltas, \
+  summarize_result, tally_deleted, task_status, tasks_only, title_key_condition, \
+  title_search_key, update_item_args, updated_item_deltas, versions_from_items, with_projection
+from sampletodo.models.credentials import StaticCredentialProvider, use_credentials
+from sampletodo.models.metadata import index_active
+import sampletodo.common.metrics as metrics
+
+class AioStaticCredentialProvider(StaticCredentialProvider):
+  ''' StaticCredentialProvider for aiobotocore, which awaits the providers '''
+  async def load(self):
+    return self.credentials
+
+class AsyncTasksTable(object):
+  ''' Store the todo data without blocking the event loop
+
+  Same operations and return values as TasksTable, as coroutines. Every
+  call goes through one aiobotocore client whose connection pool is sized
+  by DYNAMODB_MAX_POOL_CONNECTIONS, so a single process keeps that many
+  DynamoDB requests in flight. Use connect() before the first call and
+  close() when done, or "async with".
+  '''
+
+  def __init__(self, **kwargs):
+    self.kwargs = kwargs
+    self.table_name = kwargs['DYNAMODB_TABLE_NAME']
+    self.client = None
+    self._client_context = None
+    self._description = None
+    self._described_at = None
+    self._describe_lock = None
+    # newest change version seen per counter shard, see TasksTable.change_version
+    self._counter_ids = counter_ids(kwargs['DYNAMODB_COUNTER_SHARDS'])
+    self._versions = {}
+    self._versions_read_at = 0
+    self._lost_bumps = 0
+
+    logger = structlog.get_logger()
+    self.log = logger.new()
+    self.log = self.log.bind(build_version=__version__, model='async')
+
+  async def __aenter__(self):
+    await self.connect()
+    return self
+
+  async def __aexit__(self, *exc_info):
+    await self.close()
+
+  def _endpoint_url(self):
+    if self.kwargs['DYNAMODB_ENABLE_LOCAL']:
+      return 'http://%s:%s' % (self.kwargs['DYNAMODB_HOST'], self.kwargs['DYNAMODB_PORT'])
+    return None
+
+  def _client_config(self):
+    ''' Async counterpart of connection.botocore_config '''
+    return AioConfig(max_pool_connections=self.kwargs['DYNAMODB_MAX_POOL_CONNECTIONS'],
+                     connect_timeout=self.kwargs['DYNAMODB_CONNECT_TIMEOUT'],
+                     read_timeout=self.kwargs['DYNAMODB_READ_TIMEOUT'],
+                     retries={'max_attempts': self.kwargs['DYNAMODB_MAX_ATTEMPTS']})
+
+  async def _assume_role_credentials(self, session):
+    ''' Refreshable credentials for the configured role '''
+    async def fetch():
+      async with session.create_client('sts', region_name=self.kwargs['AWS_DEFAULT_REGION']) as sts:
+        response = await sts.assume_role(RoleArn=self.kwargs['AWS_ROLE_ARN'],
+                                         RoleSessionName=self.kwargs['AWS_ROLE_SESSION_NAME'],
+                                         DurationSeconds=self.kwargs['AWS_ROLE_DURATION_SECONDS'])
+      credentials = response['Credentials']
+      self.log.info('aws_assume_role', expiration=str(credentials['Expiration']))
+      return {
+        'access_key': credentials['AccessKeyId'],
+        'secret_key': credentials['SecretAccessKey'],
+        'token': credentials['SessionToken'],
+        'expiry_time': credentials['Expiration'].isoformat(),
+      }
+
+    return AioRefreshableCredentials.create_from_metadata(
+      metadata=await fetch(), refresh_using=fetch, method='sts-assume-role')
+
+  async def _create_client_context(self):
+    ''' aiobotocore client context for the configured credentials '''
+    session = get_session()
+    kwargs = {
+      'region_name': self.kwargs['AWS_DEFAULT_REGION'],
+      'config': self._client_config(),
+    }
+    endpoint_url = self._endpoint_url()
+    if endpoint_url:
+      kwargs['endpoint_url'] = endpoint_url
+
+    if self.kwargs.get('AWS_ACCESS_KEY_ID'):
+      self.log.info('aws_session_with_keys', aws_access_key_id='***',
+                    aws_secret_access_key='***', region_name=kwargs['region_name'])
+      kwargs['aws_access_key_id'] = self.kwargs['AWS_ACCESS_KEY_ID']
+      kwargs['aws_secret_access_key'] = self.kwargs['AWS_SECRET_ACCESS_KEY']
+    elif self.kwargs.get('AWS_ROLE_ARN'):
+      self.log.info('aws_session_assume_role', role=self.kwargs['AWS_ROLE_ARN'])
+      # refreshed by aiobotocore when a request finds them close to expiry
+      use_credentials(session, await self._assume_role_credentials(session),
+                      AioStaticCredentialProvider)
+
+    return session.create_client('dynamodb', **kwargs)
+
+  async def connect(self):
+    ''' Open the client, or replace it, and check that the table exists '''
+    log_msg = 'initializing_aws'
+    self.log.info(log_msg, status='started')
+
+    try:
+      context = await self._create_client_context()
+      client = await context.__aenter__()
+    except Exception as ex:
+      self.log.error('failed_aws_connect_dynamodb', error=str(ex), traceback=traceback.format_exc())
+      raise
+
+    previous = self._client_context
+    self.client, self._client_context = client, context
+    self._described_at = None
+
+    if await self._describe() is None:
+      if self.kwargs['DYNAMODB_AUTO_PROVISION']:
+        await self.provision_table()
+      else:
+        err = 'Table does not exist'
+        self.log.error('failed_initializing_model', err=err)
+        raise ModelsException(err)
+
+    if previous is not None:
+      asyncio.ensure_future(self._close_later(previous))
+
+    self.log.info(log_msg, status='done')
+
+  refresh_aws_connection = connect
+
+  async def _close_later(self, context):
+    ''' Close a replaced client once the calls already in flight on it are done '''
+    await asyncio.sleep(self.kwargs['DYNAMODB_READ_TIMEOUT'])
+    await context.__aexit__(None, None, None)
+
+  async def close(self):
+    ''' Close the client and its connection pool '''
+    context, self._client_context, self.client = self._client_context, None, None
+    if context is not None:
+      await context.__aexit__(None, None, None)
+
+  async def provision_table(self):
+    ''' Create the table with its indexes, same schema as TasksTable '''
+    self.log.info('creating_table')
+    await self.client.create_table(
+      TableName=self.table_name,
+      KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+      AttributeDefinitions=attribute_definitions(),
+      GlobalSecondaryIndexes=global_secondary_indexes(self.kwargs),
+      ProvisionedThroughput={'ReadCapacityUnits': 10, 'WriteCapacityUnits': 10})
+    await self.client.get_waiter('table_exists').wait(TableName=self.table_name)
+    self._described_at = None
+    await self._describe()
+    return {'created': True}
+
+  async def _describe(self):
+    ''' describe_table, cached like TableMetadata for DYNAMODB_METADATA_REFRESH_INTERVAL '''
+    described_at = self._described_at
+    if described_at is not None and \
+       time.time() - described_at < self.kwargs['DYNAMODB_METADATA_REFRESH_INTERVAL']:
+      return self._description
+
+    if self._describe_lock is None:
+      self._describe_lock = asyncio.Lock()
+    async with self._describe_lock:
+      # somebody else may have refreshed it while we waited
+      if self._described_at == described_at:
+        try:
+          response = await self.client.describe_table(TableName=self.table_name)
+          self._description = response['Table']
+        except ClientError as ex:
+          if ex.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+          self._description = None
+        self._described_at = time.time()
+    return self._description
+
+  async def _index_active(self, index_name):
+    return index_active(await self._describe(), index_name)
+
+  async def table_info(self):
+    ''' Table status, size and indexes '''
+    description = await self._describe()
+    if description is None:
+      return {'name': self.table_name, 'exists': False}
+    return {
+      'name': self.table_name,
+      'exists': True,
+      'status': description.get('TableStatus'),
+      'item_count': description.get('ItemCount'),
+      'size_bytes': description.get('TableSizeBytes'),
+      'indexes': dict((index['IndexName'], {'status': index.get('IndexStatus')})
+                      for index in description.get('GlobalSecondaryIndexes', [])),
+    }
+
+  def _log_result(self, event, result, **extra):
+    ''' Log a summary of a DynamoDB response, the full payload only at debug '''
+    self.log.debug(event, result=result)
+    extra.update(summarize_result(result))
+    self.log.info(event, **extra)
+
+  async def _page(self, operation, limit=None, cursor=None, projection=None,
+                  cursor_keys=SCAN_CURSOR_KEYS, **kwargs):
+    ''' Run a single scan/query page and attach the cursor for the next one '''
+    with_projection(kwargs, projection)
+    kwargs['TableName'] = self.table_name
+    if limit:
+      kwargs['Limit'] = limit
+    if cursor:
+      kwargs['ExclusiveStartKey'] = serialize_item(start_key(cursor, cursor_keys))
+
+    result = await operation(**kwargs)
+
+    result['Items'] = [deserialize_item(item) for item in result.get('Items', [])]
+    if 'LastEvaluatedKey' in result:
+      result['LastEvaluatedKey'] = deserialize_item(result['LastEvaluatedKey'])
+      result['NextCursor'] = encode_cursor(result['LastEvaluatedKey'])
+    return result
+
+  def _set_versions(self, versions):
+    # the loop is single threaded, only a bump that finished meanwhile can be newer
+    for counter_id, version in versions.items():
+      self._versions[counter_id] = max(version, self._versions.get(counter_id, 0))
+
+  async def _counter_items(self):
+    ''' The counter shards, one consistent BatchGetItem '''
+    items, _ = await self._batch_get(self._counter_ids, COUNTER_ATTRS, consistent_read=True)
+    return items
+
+  async def change_version(self):
+    ''' Table change counter, the sum of the shards, read at most every refresh interval '''
+    now = time.time()
+    if now - self._versions_read_at >= self.kwargs['DYNAMODB_CHANGE_VERSION_REFRESH_INTERVAL']:
+      self._set_versions(versions_from_items(await self._counter_items()))
+      self._versions_read_at = now
+    return sum(self._versions.values()) + self._lost_bumps
+
+  async def _bump_version(self, deltas=None):
+    ''' Count a write in a random counter shard, a failure is logged and counted, see TasksTable '''
+    counter_id = random.choice(self._counter_ids)
+    try:
+      result = await self.client.update_item(TableName=self.table_name,
+                                             **bump_version_args(deltas, counter_id))
+    except (ClientError, BotoCoreError) as ex:
+      metrics.DYNAMODB_COUNTER_FAILURES.inc(1, counter_failure_code(ex))
+      self.log.error('failed_bump_version', error=str(ex), deltas=deltas)
+      self._lost_bumps += 1
+      return
+    self._set_versions({counter_id: bumped_version(result)})
+
+  async def task_counts(self):
+    ''' Task counts per status summed over the counter shards, one small consistent read '''
+    return counts_from_items(await self._counter_items())
+
+  async def put_item(self, item):
+    ''' Create item '''
+    try:
+      item = new_item(item)
+    except ModelsException as ex:
+      self.log.error('failed_put_item', err=str(ex))
+      raise
+
+    self.log.debug('put_item', item=item)
+    result = await self.client.put_item(TableName=self.table_name, Item=serialize_item(item),
+                                        ReturnValues='ALL_OLD')
+    old_item = deserialize_item(result['Attributes']) if 'Attributes' in result else None
+    await self._bump_version(status_deltas(old_item, item))
+    return item
+
+  async def get_item_by_id(self, item_id, projection=None):
+    ''' Get item by id '''
+    self.log.debug('get_item_by_id', item_id=item_id, projection=projection)
+    if is_counter_id(item_id):
+      return {}
+    result = await self.client.get_item(**with_projection(
+      {'TableName': self.table_name, 'Key': {'id': {'S': item_id}}}, projection))
+    if 'Item' in result:
+      result['Item'] = deserialize_item(result['Item'])
+    self._log_result('get_item_by_id', result, found='Item' in result)
+    return result
+
+  async def _batch_get(self, item_ids, projection=None, consistent_read=False):
+    ''' Send one BatchGetItem call, retrying unprocessed keys with backoff '''
+    request = scan_expression_args(projection)
+    request['Keys'] = [{'id': {'S': item_id}} for item_id in item_ids]
+    if consistent_read:
+      request['ConsistentRead'] = True
+    items = []
+    attempt = 0
+
+    while True:
+      response = await self.client.batch_get_item(RequestItems={self.table_name: request})
+      items.extend(deserialize_item(item)
+                   for item in response['Responses'].get(self.table_name, []))
+      unprocessed = response.get('UnprocessedKeys', {}).get(self.table_name)
+      if not unprocessed or attempt >= self.kwargs['DYNAMODB_BATCH_MAX_RETRIES']:
+        break
+      request = unprocessed
+      await asyncio.sleep(backoff_delay(attempt))
+      attempt += 1
+
+    unprocessed_ids = [key['id']['S'] for key in (unprocessed or {}).get('Keys', [])]
+    return items, unprocessed_ids
+
+  async def get_items_by_ids(self, item_ids, projection=None):
+    ''' Get items by id with concurrent BatchGetItem calls '''
+    self.log.debug('get_items_by_ids', item_ids=len(item_ids), projection=projection)
+
+    item_ids = list(OrderedDict((item_id, None) for item_id in item_ids))
+    projection = projection_with_id(projection)
+
+    # the counter items are not tasks, they are reported missing
+    fetch_ids = [item_id for item_id in item_ids if not is_counter_id(item_id)]
+    chunks = [fetch_ids[idx:idx + BATCH_GET_SIZE]
+              for idx in range(0, len(fetch_ids), BATCH_GET_SIZE)]
+    found = {}
+    unprocessed_ids = set()
+    for items, unprocessed in await asyncio.gather(*[self._batch_get(chunk, projection)
+                                                     for chunk in chunks]):
+      found.update((item['id'], item) for item in items)
+      unprocessed_ids.update(unprocessed)
+
+    result = {
+      'Items': [found[item_id] for item_id in item_ids if item_id in found],
+      'MissingIds': [item_id for item_id in item_ids
+                     if item_id not in found and item_id not in unprocessed_ids],
+      'UnprocessedIds': [item_id for item_id in item_ids if item_id in unprocessed_ids],
+    }
+    self.log.info('get_items_by_ids', found=len(result['Items']),
+                  missing=len(result['MissingIds']),
+                  unprocessed=len(result['UnprocessedIds']))
+    return result
+
+  async def list_items(self, limit=None, cursor=None, projection=None):
+    ''' Get one page of items '''
+    self.log.debug('list_items', limit=limit, cursor=cursor, projection=projection)
+    result = await self._page(self.client.scan, limit=limit, cursor=cursor, projection=projection,
+                              **scan_expression_args(filter_expression=TASKS_ONLY))
+    self._log_result('list_items', result)
+    return result
+
+  async def get_items_by_status(self, done, limit=None, cursor=None, projection=None):
+    ''' Get one page of items by done status from the status index '''
+    self.log.debug('get_items_by_status', done=done, limit=limit, cursor=cursor,
+                   projection=projection)
+    index_name = self.kwargs['DYNAMODB_STATUS_INDEX_NAME']
+    if await self._index_active(index_name):
+      result = await self._page(self.client.query, limit=limit, cursor=cursor,
+                                projection=projection, cursor_keys=STATUS_CURSOR_KEYS,
+                                IndexName=index_name,
+                                **key_condition_args(Key('task_status').eq(task_status(done))))
+    else:
+      result = await self._page(self.client.scan, limit=limit, cursor=cursor,
+                                projection=projection,
+                                **scan_expression_args(filter_expression=Attr('done').eq(done)))
+    self._log_result('get_items_by_status', result, index_name=index_name)
+    return result
+
+  async def get_item_by_title(self, title, limit=None, cursor=None, projection=None):
+    ''' Get one page of items whose title starts with title from the title index '''
+    self.log.debug('get_item_by_title', title=title, limit=limit, cursor=cursor,
+                   projection=projection)
+
+    try:
+      title_key = title_search_key(title)
+    except ModelsException as ex:
+      self.log.error('failed_get_item_by_title', err=str(ex))
+      raise
+
+    index_name = self.kwargs['DYNAMODB_TITLE_INDEX_NAME']
+    if await self._index_active(index_name):
+      result = await self._page(self.client.query, limit=limit, cursor=cursor,
+                                projection=projection, cursor_keys=TITLE_CURSOR_KEYS,
+                                IndexName=index_name,
+                                **key_condition_args(title_key_condition(title_key)))
+    else:
+      filter_expression = Attr('title_key').begins_with(title_key)
+      result = await self._page(self.client.scan, limit=limit, cursor=cursor,
+                                projection=projection,
+                                **scan_expression_args(filter_expression=filter_expression))
+    self._log_result('get_item_by_title', result, index_name=index_name)
+    return result
+
+  async def get_item_by_attr(self, attr_name, attr_value, projection=None):
+    ''' Get item by attr_name == attr_value '''
+    self.log.debug('get_item_by_attr', attr_name=attr_name, attr_value=attr_value,
+                   projection=projection)
+    kwargs = scan_expression_args(filter_expression=tasks_only(Attr(attr_name).eq(attr_value)))
+    if not projection:
+      kwargs['Select'] = 'ALL_ATTRIBUTES'
+    result = await self._page(self.client.scan, projection=projection, **kwargs)
+    self._log_result('get_item_by_attr', result)
+    return result
+
+  async def update_item(self, item_id, updated_attrs):
+    ''' Update item attrs '''
+    self.log.debug('update_item', item_id=item_id, updated_attrs=updated_attrs)
+    kwargs, set_attrs, remove_attrs = update_item_args(item_id, updated_attrs)
+    values = serialize_item(kwargs['ExpressionAttributeValues'])
+
+    try:
+      result = await self.client.update_item(TableName=self.table_name,
+                                             Key={'id': {'S': item_id}},
+                                             **dict(kwargs, ExpressionAttributeValues=values))
+    except ClientError as ex:
+      err = missing_task(ex)
+      self.log.debug(str(err), item_id=item_id)
+      raise err
+
+    result['Attributes'] = deserialize_item(result['Attributes'])
+    await self._bump_version(updated_item_deltas(result, kwargs, set_attrs, remove_attrs))
+
+    self._log_result('update_item', result)
+    return result
+
+  async def delete_item(self, item_id):
+    ''' Delete item by id '''
+    self.log.debug('delete_item', item_id=item_id)
+    if is_counter_id(item_id):
+      return {}
+    result = await self.client.delete_item(TableName=self.table_name, **delete_item_args(item_id))
+    old_item = deserialize_item(result.pop('Attributes')) if 'Attributes' in result else None
+    await self._bump_version(status_deltas(old_item, None))
+    self._log_result('delete_item', result)
+    return result
+
+  async def _batch_write(self, requests):
+    ''' Send one BatchWriteItem call, retrying unprocessed requests with backoff '''
+    pending = requests
+    attempt = 0
+
+    while pending:
+      response = await self.client.batch_write_item(RequestItems={self.table_name: pending})
+      pending = response.get('UnprocessedItems', {}).get(self.table_name, [])
+      if not pending or attempt >= self.kwargs['DYNAMODB_BATCH_MAX_RETRIES']:
+        break
+      await asyncio.sleep(backoff_delay(attempt))
+      attempt += 1
+
+    return pending
+
+  async def batch_write_items(self, creates=(), deletes=()):
+    ''' Create items with concurrent BatchWriteItem calls and delete them with DeleteItem calls '''
+    self.log.debug('batch_write_items', creates=len(creates), deletes=len(deletes))
+    results, batches, seen = batch_write_requests(creates, deletes)
+
+    async def write_batch(batch):
+      try:
+        return failed_puts(batch, await self._batch_write([request for _, request in batch]))
+      except ClientError as ex:
+        return failed_puts(batch, error=str(ex))
+
+    # bounds the deletes in flight the same way DYNAMODB_BATCH_WORKERS does for TasksTable
+    in_flight = asyncio.Semaphore(self.kwargs['DYNAMODB_BATCH_WORKERS'])
+
+    async def delete_one(result):
+      try:
+        async with in_flight:
+          response = await self.client.delete_item(TableName=self.table_name,
+                                                   **delete_item_args(result['id']))
+      except ClientError as ex:
+        return result, str(ex), None
+      return result, None, deleted_status(response)
+
+    put_failures = [failure for failures in
+                    await asyncio.gather(*[write_batch(batch) for batch in batches])
+                    for failure in failures]
+    delete_outcomes = await asyncio.gather(*[delete_one(result) for result in seen.values()])
+
+    if batches or seen:
+      await self._bump_version(batch_write_deltas(results, put_failures, delete_outcomes))
+    self.log.info('batch_write_items', batches=len(batches), deletes=len(seen))
+    return results
+
+  async def delete_all_items(self):
+    ''' Delete all items with segmented keys-only scans and concurrent batch deletes '''
+    log_msg = 'delete_all_items'
+    self.log.debug(log_msg, status='started')
+
+    start = time.time()
+    counts = {'deleted': 0, 'unprocessed': 0}
+    deltas = {}
+    # bounds the deletes in flight the same way DYNAMODB_BATCH_WORKERS does for TasksTable
+    in_flight = asyncio.Semaphore(self.kwargs['DYNAMODB_BATCH_WORKERS'])
+
+    async def delete_batch(keys):
+      async with in_flight:
+        unprocessed = await self._batch_write(delete_requests(keys))
+      tally_deleted(counts, deltas, keys, unprocessed)
+
+    async def scan_segment(segment, total_segments):
+      kwargs = scan_expression_args(projection=['id', 'task_status'],
+                                    filter_expression=TASKS_ONLY)
+      kwargs.update(TableName=self.table_name, Segment=segment, TotalSegments=total_segments)
+      while True:
+        page = await self.client.scan(**kwargs)
+        keys = page.get('Items', [])
+        await asyncio.gather(*[delete_batch(keys[idx:idx + BATCH_WRITE_SIZE])
+                               for idx in range(0, len(keys), BATCH_WRITE_SIZE)])
+        if 'LastEvaluatedKey' not in page:
+          return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+    total_segments = self.kwargs['DYNAMODB_SCAN_SEGMENTS']
+    try:
+      await asyncio.gather(*[scan_segment(segment, total_segments)
+                             for segment in range(total_segments)])
+    except ClientError as ex:
+      if ex.response['Error']['Code'] != 'ResourceNotFoundException':
+        raise
+      self.log.info(log_msg, status='table_not_found')
+
+    if counts['deleted']:
+      await self._bump_version(deltas)
+    result = {
+      'deleted_count': counts['deleted'],
+      'unprocessed_count': counts['unprocessed'],
+      'elapsed_seconds': round(time.time() - start, 3),
+    }
+    self.log.info(log_msg, status='done', **result)
+    return result
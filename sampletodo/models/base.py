@@ -0,0 +1,396 @@
+''' Storage backend interface and the helpers every backend shares '''
+
+import base64
+import json
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from boto3.dynamodb.conditions import AttributeBase, ConditionBase
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+
+import sampletodo.common.utils as utils
+
+class ModelsException(Exception):
+  pass
+
+STATUS_PENDING = 'pending'
+STATUS_DONE = 'done'
+
+# id of the item holding the table change counter in DynamoDB, task ids never contain '#'.
+# The counter is sharded, the other shards are '#change_version#<n>'
+CHANGE_VERSION_ID = '#change_version'
+
+def is_counter_id(item_id):
+  ''' True for the ids of the counter items, which are never tasks '''
+  return item_id.startswith(CHANGE_VERSION_ID)
+
+def task_status(done):
+  ''' Map the done flag to the status index partition key '''
+  return STATUS_DONE if done else STATUS_PENDING
+
+# attributes clients are allowed to change through update_item
+UPDATABLE_ATTRS = ('title', 'done')
+
+# length of the normalized title prefix used as the title index partition key
+TITLE_PREFIX_LENGTH = 3
+TITLE_INDEX_ATTRS = ('title_prefix', 'title_key')
+# DynamoDB limit for range keys, title_key is the title index range key
+TITLE_KEY_MAX_BYTES = 1024
+
+def normalize_title(title):
+  ''' Lowercase and collapse whitespace so title lookups are case insensitive '''
+  return ' '.join(('%s' % title).lower().split())
+
+def truncate_utf8(value, max_bytes):
+  ''' Longest prefix of value whose UTF-8 encoding fits in max_bytes '''
+  encoded = value.encode('utf-8')
+  if len(encoded) <= max_bytes:
+    return value
+  # a character cut in half is dropped
+  return encoded[:max_bytes].decode('utf-8', 'ignore')
+
+def title_index_key(title):
+  ''' Normalized title cut to what fits in an index key, long titles share their first KB '''
+  return truncate_utf8(normalize_title(title), TITLE_KEY_MAX_BYTES)
+
+def derived_attrs(item):
+  ''' Index key attributes derived from the client visible attributes '''
+  attrs = {}
+  if 'done' in item:
+    attrs['task_status'] = task_status(item['done'])
+  if 'title' in item:
+    # empty strings are not valid index keys, such titles stay unindexed
+    title_key = title_index_key(item['title'])
+    if title_key:
+      attrs['title_prefix'] = title_key[:TITLE_PREFIX_LENGTH]
+      attrs['title_key'] = title_key
+  return attrs
+
+def title_search_key(title):
+  ''' Normalized title prefix to search for, long enough to pick an index bucket '''
+  title_key = title_index_key(title)
+  if len(title_key) < TITLE_PREFIX_LENGTH:
+    raise ModelsException('Title prefix must be at least %s characters' % TITLE_PREFIX_LENGTH)
+  return title_key
+
+def prefix_upper_bound(prefix):
+  ''' Smallest string that sorts after every string starting with prefix '''
+  return prefix[:-1] + u'%c' % (ord(prefix[-1]) + 1)
+
+def new_item(item):
+  ''' Validate a new item and stamp its id, timestamps and index keys '''
+  if 'title' not in item:
+    raise ModelsException('Title not provided')
+
+  timestamp = int(time.time())
+
+  item['id'] = str(uuid.uuid1())
+  item['createdat'] = timestamp
+  item['updatedat'] = timestamp
+  item['done'] = False
+  item.update(derived_attrs(item))
+  return item
+
+def update_attrs(updated_attrs):
+  ''' Attributes update_item sets and removes, only the ones the client sent
+
+  Concurrent updates of different fields then do not overwrite each other.
+  '''
+  set_attrs = dict((attr, updated_attrs[attr]) for attr in UPDATABLE_ATTRS
+                   if attr in updated_attrs)
+  set_attrs['updatedat'] = int(time.time())
+  set_attrs.update(derived_attrs(set_attrs))
+
+  remove_attrs = []
+  if 'title' in set_attrs:
+    remove_attrs = [attr for attr in TITLE_INDEX_ATTRS if attr not in set_attrs]
+  return set_attrs, remove_attrs
+
+# cursors carry typed DynamoDB keys, so every backend can share one format
+_cursor_serializer = TypeSerializer()
+_cursor_deserializer = TypeDeserializer()
+
+def encode_cursor(last_evaluated_key):
+  ''' Encode a LastEvaluatedKey as an opaque pagination cursor '''
+  key = dict((k, _cursor_serializer.serialize(v)) for k, v in last_evaluated_key.items())
+  data = json.dumps(key, sort_keys=True, separators=(',', ':')).encode('utf-8')
+  return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+  ''' Decode a pagination cursor back into an ExclusiveStartKey '''
+  padding = '=' * (-len(cursor) % 4)
+  try:
+    data = base64.urlsafe_b64decode((cursor + padding).encode('ascii'))
+    key = json.loads(data.decode('utf-8'))
+    return dict((k, _cursor_deserializer.deserialize(v)) for k, v in key.items())
+  except Exception:
+    raise ModelsException('Invalid cursor')
+
+def project(item, projection=None):
+  ''' Keep only the projected top level attributes of an item '''
+  if not projection:
+    return item
+  return dict((attr, item[attr]) for attr in projection if attr in item)
+
+def projection_with_id(projection=None):
+  ''' Projection that also returns the id, results are matched and paged by it '''
+  if projection and 'id' not in projection:
+    return ['id'] + list(projection)
+  return projection
+
+# top level attribute names only, a projection never reaches into nested documents
+FIELD_NAME = re.compile(r'^[A-Za-z0-9_.\-]{1,255}$')
+MAX_PROJECTION_FIELDS = 50
+
+def fields_projection(fields):
+  ''' Projection from a list of attribute names, checked the way every entry point checks them '''
+  projection = list(OrderedDict((field.strip(), None) for field in fields))
+  if not all(FIELD_NAME.match(field) for field in projection):
+    raise ModelsException('Invalid fields - %s' % ','.join(fields))
+  if len(projection) > MAX_PROJECTION_FIELDS:
+    raise ModelsException('fields is limited to %s attributes' % MAX_PROJECTION_FIELDS)
+  return projection
+
+def parse_fields(fields):
+  ''' Projection from a comma separated fields parameter, None returns every attribute '''
+  if fields is None:
+    return None
+  return fields_projection(fields.split(','))
+
+_MISSING = object()
+
+def _operand(value, item):
+  if isinstance(value, AttributeBase):
+    return item.get(value.name, _MISSING)
+  if isinstance(value, ConditionBase):
+    return evaluate_condition(value, item)
+  return value
+
+def _compare(compare):
+  def check(left, right):
+    if left is _MISSING or right is _MISSING:
+      return False
+    return compare(left, right)
+  return check
+
+# boto3 condition operators evaluated against python items
+_OPERATORS = {
+  '=': _compare(lambda left, right: left == right),
+  '<>': _compare(lambda left, right: left != right),
+  '<': _compare(lambda left, right: left < right),
+  '<=': _compare(lambda left, right: left <= right),
+  '>': _compare(lambda left, right: left > right),
+  '>=': _compare(lambda left, right: left >= right),
+  'begins_with': _compare(lambda left, right: isinstance(left, utils.string_types) and
+                                              left.startswith(right)),
+  'contains': _compare(lambda left, right: right in left),
+  'attribute_exists': lambda left: left is not _MISSING,
+  'attribute_not_exists': lambda left: left is _MISSING,
+  'AND': lambda left, right: left and right,
+  'OR': lambda left, right: left or right,
+  'NOT': lambda value: not value,
+}
+
+def evaluate_condition(condition, item):
+  ''' Evaluate a boto3 Attr/Key condition against an item, for backends without expressions '''
+  expression = condition.get_expression()
+  operator = expression['operator']
+  values = [_operand(value, item) for value in expression['values']]
+
+  if operator == 'IN':
+    return values[0] is not _MISSING and values[0] in values[1:]
+  if operator == 'BETWEEN':
+    return values[0] is not _MISSING and values[1] <= values[0] <= values[2]
+  if operator not in _OPERATORS:
+    raise ModelsException('Unsupported condition - %s' % operator)
+  return _OPERATORS[operator](*values)
+
+class TasksBackend(object):
+  ''' Operations the views and management commands expect from a storage backend
+
+  TasksTable is the DynamoDB implementation. Results use its response
+  shapes: pages are dicts with Items and, when there is more, NextCursor;
+  get_item_by_id only has Item when it found one; update_item returns
+  {'Attributes': item} and raises ModelsException('Did not find task') for
+  unknown ids. Reads take a projection, a list of top level attribute
+  names, and then only return those plus the id.
+
+  Backends that keep items locally only implement the _get, _insert,
+  _delete and _clear primitives plus the paged reads and update_item, the
+  bulk operations here are built on top of them.
+
+  Every write bumps change_version(), which the views turn into ETags. The
+  default counter lives in process memory, backends shared between
+  processes keep it next to the data.
+
+  task_counts() answers from counters the writes keep up to date instead
+  of counting items, reconcile_counts() recomputes them from the items.
+  '''
+
+  name = None
+  _version_lock = threading.Lock()
+  _change_version = 0
+
+  def refresh_aws_connection(self):
+    ''' Reconnect to the store '''
+
+  def provision_table(self):
+    ''' Create the storage unless it already exists '''
+    return {'created': False}
+
+  def migrate_indexes(self):
+    ''' Add missing indexes '''
+    return {'created_indexes': []}
+
+  def table_info(self):
+    ''' Status, size and indexes of the store '''
+    raise NotImplementedError
+
+  def change_version(self):
+    ''' Counter bumped by every write '''
+    return self._change_version
+
+  def _bump_version(self):
+    with self._version_lock:
+      self._change_version += 1
+
+  def task_counts(self):
+    ''' Number of tasks per status, without reading any tasks '''
+    raise NotImplementedError
+
+  def count_items(self):
+    ''' Number of tasks per status, counted from the tasks themselves '''
+    counts = dict((status, 0) for status in (STATUS_PENDING, STATUS_DONE))
+    for item in self.parallel_scan(projection=['task_status']):
+      counts[item['task_status']] += 1
+    return counts
+
+  def reconcile_counts(self):
+    ''' Replace the task counters with count_items(), returns {'before': ..., 'after': ...} '''
+    raise NotImplementedError
+
+  def put_item(self, item):
+    ''' Create item '''
+    item = new_item(item)
+    self._insert(item)
+    self._bump_version()
+    return dict(item)
+
+  def put_items(self, items):
+    ''' Store items that already went through new_item as they are, returns the ids not written
+
+    Writing an item again replaces it, so replaying a batch is safe.
+    '''
+    for item in items:
+      self._insert(item)
+    if items:
+      self._bump_version()
+    return []
+
+  def get_item_by_id(self, item_id, projection=None):
+    ''' Get item by id '''
+    item = self._get(item_id)
+    return {'Item': project(item, projection_with_id(projection))} if item is not None else {}
+
+  def list_items(self, limit=None, cursor=None, projection=None):
+    ''' Get one page of items '''
+    raise NotImplementedError
+
+  def get_items_by_status(self, done, limit=None, cursor=None, projection=None):
+    ''' Get one page of items by done status '''
+    raise NotImplementedError
+
+  def get_item_by_title(self, title, limit=None, cursor=None, projection=None):
+    ''' Get one page of items whose title starts with title '''
+    raise NotImplementedError
+
+  def update_item(self, item_id, updated_attrs):
+    ''' Update item attrs '''
+    raise NotImplementedError
+
+  def delete_item(self, item_id):
+    ''' Delete item by id '''
+    self._delete(item_id)
+    self._bump_version()
+    return {}
+
+  def delete_all_items(self):
+    ''' Delete all items '''
+    start = time.time()
+    deleted_count = self._clear()
+    self._bump_version()
+    return {
+      'deleted_count': deleted_count,
+      'unprocessed_count': 0,
+      'elapsed_seconds': round(time.time() - start, 3),
+    }
+
+  def iter_items(self, page_size=None):
+    ''' Yield all items, fetching them one page at a time '''
+    cursor = None
+    while True:
+      page = self.list_items(limit=page_size or 1000, cursor=cursor)
+      for item in page['Items']:
+        yield item
+      cursor = page.get('NextCursor')
+      if not cursor:
+        return
+
+  def parallel_scan(self, projection=None, filter_expression=None,
+                    total_segments=None, max_workers=None, deserialize=True):
+    ''' Stream every item, local stores have nothing to gain from segments '''
+    for item in self.iter_items():
+      if filter_expression is None or evaluate_condition(filter_expression, item):
+        yield project(item, projection)
+
+  def get_item_by_attr(self, attr_name, attr_value, projection=None):
+    ''' Get item by attr_name == attr_value '''
+    projection = projection_with_id(projection)
+    items = [project(item, projection) for item in self.iter_items()
+             if attr_name in item and item[attr_name] == attr_value]
+    return {'Items': items, 'Count': len(items)}
+
+  def get_items_by_ids(self, item_ids, projection=None):
+    ''' Get items by id '''
+    item_ids = list(OrderedDict((item_id, None) for item_id in item_ids))
+    projection = projection_with_id(projection)
+
+    items = []
+    missing = []
+    for item_id in item_ids:
+      item = self._get(item_id)
+      if item is None:
+        missing.append(item_id)
+      else:
+        items.append(project(item, projection))
+    return {'Items': items, 'MissingIds': missing, 'UnprocessedIds': []}
+
+  def batch_write_items(self, creates=(), deletes=()):
+    ''' Create and delete items, with TasksTable's per item results '''
+    results = {'created': [], 'deleted': []}
+
+    for index, item in enumerate(creates):
+      result = {'index': index}
+      results['created'].append(result)
+      if not isinstance(item, dict):
+        result.update(status='failed', error='Task must be an object')
+        continue
+      try:
+        result.update(status='created', task=self.put_item(item))
+      except ModelsException as ex:
+        result.update(status='failed', error=str(ex))
+
+    for item_id in deletes:
+      if not isinstance(item_id, utils.string_types) or not item_id or \
+         is_counter_id(item_id):
+        results['deleted'].append({'id': item_id, 'status': 'failed', 'error': 'Invalid task id'})
+        continue
+      self._delete(item_id)
+      results['deleted'].append({'id': item_id, 'status': 'deleted'})
+
+    if any(result['status'] == 'deleted' for result in results['deleted']):
+      self._bump_version()
+    return results
@@ -0,0 +1,245 @@
+''' In-process read-through cache for tasks '''
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from sampletodo.models.base import project, projection_with_id
+import sampletodo.common.utils as utils
+
+class ItemCache(object):
+  ''' LRU cache bounded by entry count and bytes with a per entry TTL
+
+  Writes bump a generation of their key. A read through the cache takes
+  the generation before it goes to the table and only fills the cache if
+  no write bumped it meanwhile, so a slow read can not put back an item
+  a write already replaced. Keys share generation_stripes counters, a
+  write to another key of the same stripe only costs a fill.
+  '''
+
+  def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024, ttl=30, clock=time.time,
+               generation_stripes=4096):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self._clock = clock
+    self._lock = threading.Lock()
+    # key -> (expires_at, size, item), oldest first
+    self._entries = OrderedDict()
+    self._bytes = 0
+    self._generations = [0] * generation_stripes
+    # bumped by clear(), which is a write to every key
+    self._epoch = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def _remove(self, key):
+    ''' Drop an entry, caller holds the lock '''
+    _, size, _ = self._entries.pop(key)
+    self._bytes -= size
+
+  def _stripe(self, key):
+    return hash(key) % len(self._generations)
+
+  def _bump(self, key):
+    ''' A write to key, caller holds the lock '''
+    self._generations[self._stripe(key)] += 1
+
+  def _store(self, key, item, size):
+    ''' Cache a copy of item, evicting least recently used entries to fit, caller holds the lock '''
+    if key in self._entries:
+      self._remove(key)
+
+    if size > self.max_bytes:
+      return
+
+    self._entries[key] = (self._clock() + self.ttl, size, dict(item))
+    self._bytes += size
+
+    while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+      self._remove(next(iter(self._entries)))
+      self.evictions += 1
+
+  def get(self, key):
+    ''' Return a copy of the cached item or None '''
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+
+      expires_at, _, item = entry
+      if expires_at <= self._clock():
+        self._remove(key)
+        self.expirations += 1
+        self.misses += 1
+        return None
+
+      # re-insert to mark the entry as most recently used
+      del self._entries[key]
+      self._entries[key] = entry
+      self.hits += 1
+      return dict(item)
+
+  def generation(self, key):
+    ''' Token to take before reading key from the table, for fill '''
+    with self._lock:
+      return self._epoch, self._generations[self._stripe(key)]
+
+  def fill(self, key, item, generation):
+    ''' Cache an item read from the table, unless key was written since generation was taken '''
+    size = len(json.dumps(item, default=utils.json_default))
+    with self._lock:
+      if (self._epoch, self._generations[self._stripe(key)]) == generation:
+        self._store(key, item, size)
+
+  def set(self, key, item):
+    ''' Cache a copy of an item that was just written '''
+    size = len(json.dumps(item, default=utils.json_default))
+    with self._lock:
+      self._bump(key)
+      self._store(key, item, size)
+
+  def invalidate(self, key):
+    ''' Drop a single entry '''
+    with self._lock:
+      self._bump(key)
+      if key in self._entries:
+        self._remove(key)
+
+  def clear(self):
+    ''' Drop every entry '''
+    with self._lock:
+      self._epoch += 1
+      self._entries.clear()
+      self._bytes = 0
+
+  def stats(self):
+    ''' Cache counters and sizes '''
+    with self._lock:
+      return {
+        'entries': len(self._entries),
+        'bytes': self._bytes,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'expirations': self.expirations,
+        'max_entries': self.max_entries,
+        'max_bytes': self.max_bytes,
+        'ttl': self.ttl,
+      }
+
+class CachedTasksTable(object):
+  ''' TasksTable wrapper that serves get_item_by_id from an ItemCache
+
+  The cache is per process. Writes through this wrapper keep it in step,
+  writes from other processes show up once the entries expire, after at
+  most the cache ttl.
+  '''
+
+  def __init__(self, table, cache):
+    self.table = table
+    self.cache = cache
+
+  def __getattr__(self, name):
+    # everything that is not cache aware goes straight to the table
+    return getattr(self.table, name)
+
+  def get_item_by_id(self, item_id, projection=None):
+    ''' Get item by id, reading through the cache '''
+    item = self.cache.get(item_id)
+    if item is not None:
+      return {'Item': project(item, projection_with_id(projection))}
+
+    if projection:
+      # a partial item must not be cached as the whole one
+      return self.table.get_item_by_id(item_id, projection)
+
+    generation = self.cache.generation(item_id)
+    result = self.table.get_item_by_id(item_id)
+    if 'Item' in result:
+      self.cache.fill(item_id, result['Item'], generation)
+    return result
+
+  def get_items_by_ids(self, item_ids, projection=None):
+    ''' Get items by id, only fetching the cache misses '''
+    if projection:
+      return self.table.get_items_by_ids(item_ids, projection)
+
+    cached = {}
+    for item_id in item_ids:
+      if item_id not in cached:
+        item = self.cache.get(item_id)
+        if item is not None:
+          cached[item_id] = item
+
+    generations = dict((item_id, self.cache.generation(item_id))
+                       for item_id in item_ids if item_id not in cached)
+    result = self.table.get_items_by_ids([item_id for item_id in item_ids
+                                          if item_id not in cached])
+    for item in result['Items']:
+      self.cache.fill(item['id'], item, generations[item['id']])
+      cached[item['id']] = item
+
+    # keep the order of the requested ids
+    result['Items'] = [cached.pop(item_id) for item_id in item_ids if item_id in cached]
+    return result
+
+  def put_item(self, item):
+    ''' Create item and cache it '''
+    result = self.table.put_item(item)
+    self.cache.set(result['id'], result)
+    return result
+
+  def put_items(self, items):
+    ''' Store stamped items and cache the ones that were written '''
+    unprocessed = self.table.put_items(items)
+    skipped = set(unprocessed)
+    for item in items:
+      if item['id'] not in skipped:
+        self.cache.set(item['id'], item)
+    return unprocessed
+
+  def update_item(self, item_id, updated_attrs):
+    ''' Update item attrs and refresh the cached copy '''
+    try:
+      result = self.table.update_item(item_id, updated_attrs)
+    except Exception:
+      self.cache.invalidate(item_id)
+      raise
+
+    self.cache.set(item_id, result['Attributes'])
+    return result
+
+  def delete_item(self, item_id):
+    ''' Delete item and drop it from the cache '''
+    try:
+      return self.table.delete_item(item_id)
+    finally:
+      self.cache.invalidate(item_id)
+
+  def batch_write_items(self, creates=(), deletes=()):
+    ''' Batch create and delete items, keeping the cache in step '''
+    results = self.table.batch_write_items(creates, deletes)
+
+    for result in results['created']:
+      if result['status'] == 'created':
+        self.cache.set(result['task']['id'], result['task'])
+    for result in results['deleted']:
+      if result['status'] == 'deleted':
+        self.cache.invalidate(result['id'])
+    return results
+
+  def delete_all_items(self):
+    ''' Delete all items and empty the cache '''
+    try:
+      return self.table.delete_all_items()
+    finally:
+      self.cache.clear()
+
+  def cache_stats(self):
+    ''' Cache counters and sizes '''
+    return self.cache.stats()
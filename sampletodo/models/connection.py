@@ -0,0 +1,195 @@
+''' Thread safe DynamoDB connection handling '''
+
+import threading
+import time
+import weakref
+
+from botocore.config import Config as BotocoreConfig
+
+import sampletodo.common.metrics as metrics
+
+# operations that accept ReturnConsumedCapacity, and whether they read or write
+CAPACITY_OPERATIONS = {
+  'GetItem': 'read',
+  'BatchGetItem': 'read',
+  'Query': 'read',
+  'Scan': 'read',
+  'TransactGetItems': 'read',
+  'PutItem': 'write',
+  'UpdateItem': 'write',
+  'DeleteItem': 'write',
+  'BatchWriteItem': 'write',
+  'TransactWriteItems': 'write',
+}
+
+THROTTLE_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+                  'RequestLimitExceeded')
+
+def botocore_config(kwargs):
+  ''' Client config tuned for many concurrent requests '''
+  options = {
+    'max_pool_connections': kwargs['DYNAMODB_MAX_POOL_CONNECTIONS'],
+    'connect_timeout': kwargs['DYNAMODB_CONNECT_TIMEOUT'],
+    'read_timeout': kwargs['DYNAMODB_READ_TIMEOUT'],
+    'retries': {'max_attempts': kwargs['DYNAMODB_MAX_ATTEMPTS']},
+  }
+  try:
+    return BotocoreConfig(tcp_keepalive=True, **options)
+  except TypeError:
+    # botocore releases older than 1.27 do not know tcp_keepalive
+    return BotocoreConfig(**options)
+
+def _record_capacity(method, operation, consumed):
+  ''' Add ConsumedCapacity, a dict or a list of them for batch calls, to the counters '''
+  if isinstance(consumed, dict):
+    consumed = [consumed]
+  for entry in consumed:
+    read = entry.get('ReadCapacityUnits')
+    write = entry.get('WriteCapacityUnits')
+    if read is None and write is None:
+      # TOTAL only has CapacityUnits, the operation tells what kind they are
+      if CAPACITY_OPERATIONS.get(operation) == 'read':
+        read = entry.get('CapacityUnits')
+      else:
+        write = entry.get('CapacityUnits')
+    if read:
+      metrics.DYNAMODB_CONSUMED_CAPACITY.inc(read, method, operation, 'read')
+    if write:
+      metrics.DYNAMODB_CONSUMED_CAPACITY.inc(write, method, operation, 'write')
+
+class ClientInstrumentation(object):
+  ''' botocore event handlers that feed the DynamoDB metrics
+
+  Calls are attributed to the model method running on the calling thread,
+  see metrics.InstrumentedTable. ConsumedCapacity is requested for every
+  operation that supports it, counted and removed again, so callers get
+  the responses they asked for.
+  '''
+
+  def __init__(self, return_consumed_capacity='TOTAL'):
+    self.return_consumed_capacity = return_consumed_capacity
+
+  def register(self, events):
+    events.register('before-parameter-build.dynamodb', self.before_call,
+                    unique_id='sampletodo-metrics-before')
+    events.register('needs-retry.dynamodb', self.needs_retry,
+                    unique_id='sampletodo-metrics-retry')
+    events.register('after-call.dynamodb', self.after_call,
+                    unique_id='sampletodo-metrics-after')
+    events.register('after-call-error.dynamodb', self.after_call_error,
+                    unique_id='sampletodo-metrics-error')
+
+  def before_call(self, params, model, context, **_):
+    context['metrics_start'] = time.time()
+    context['metrics_method'] = metrics.current_method()
+    if self.return_consumed_capacity != 'NONE' and model.name in CAPACITY_OPERATIONS:
+      context['metrics_capacity_requested'] = 'ReturnConsumedCapacity' not in params
+      params.setdefault('ReturnConsumedCapacity', self.return_consumed_capacity)
+
+  def needs_retry(self, response, operation, **_):
+    if response is None:
+      return
+    code = response[1].get('Error', {}).get('Code')
+    if code in THROTTLE_CODES:
+      metrics.DYNAMODB_THROTTLES.inc(1, metrics.current_method(), operation.name)
+
+  def after_call(self, parsed, model, context, **_):
+    if 'metrics_start' not in context:
+      return
+    method = context['metrics_method']
+    metrics.DYNAMODB_CALL_DURATION.observe(time.time() - context['metrics_start'],
+                                           method, model.name)
+
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts')
+    if retries:
+      metrics.DYNAMODB_RETRIES.inc(retries, method, model.name)
+    if 'Error' in parsed:
+      metrics.DYNAMODB_ERRORS.inc(1, method, model.name, parsed['Error'].get('Code'))
+
+    if 'ConsumedCapacity' in parsed:
+      _record_capacity(method, model.name, parsed['ConsumedCapacity'])
+      if context.get('metrics_capacity_requested'):
+        del parsed['ConsumedCapacity']
+
+  def after_call_error(self, exception, context, **kwargs):
+    if 'metrics_start' not in context:
+      return
+    operation = kwargs['event_name'].rsplit('.', 1)[-1]
+    metrics.DYNAMODB_CALL_DURATION.observe(time.time() - context['metrics_start'],
+                                           context['metrics_method'], operation)
+    metrics.DYNAMODB_ERRORS.inc(1, context['metrics_method'], operation,
+                                type(exception).__name__)
+
+class ConnectionBundle(object):
+  ''' Immutable set of boto3 objects built from one session and endpoint
+
+  The low level client is thread safe and shared by every thread. boto3
+  resources are not, so each thread lazily gets its own resource and Table
+  objects. Reconnecting builds a new bundle and swaps the reference, so a
+  request never sees a half updated connection.
+  '''
+
+  def __init__(self, session, region_name, endpoint_url=None, config=None,
+               instrumentation=None):
+    self.session = session
+    self.region_name = region_name
+    self.endpoint_url = endpoint_url
+    self.config = config
+    self.instrumentation = instrumentation
+    # every low level client built so far, resources included, for pool stats
+    self._clients = weakref.WeakSet()
+    self.client = self._create('client')
+    self._local = threading.local()
+    # boto3 sessions are not thread safe either, serialize what we build from them
+    self._session_lock = threading.Lock()
+
+  def _create(self, kind):
+    ''' Build a client or resource for this bundle's endpoint '''
+    kwargs = {'region_name': self.region_name, 'config': self.config}
+    if self.endpoint_url:
+      kwargs['endpoint_url'] = self.endpoint_url
+    obj = getattr(self.session, kind)('dynamodb', **kwargs)
+
+    client = obj if kind == 'client' else obj.meta.client
+    self._clients.add(client)
+    if self.instrumentation is not None:
+      self.instrumentation.register(client.meta.events)
+    return obj
+
+  def resource(self):
+    ''' DynamoDB resource owned by the calling thread '''
+    resource = getattr(self._local, 'resource', None)
+    if resource is None:
+      with self._session_lock:
+        resource = self._local.resource = self._create('resource')
+      self._local.tables = {}
+    return resource
+
+  def table(self, table_name):
+    ''' Table object owned by the calling thread '''
+    resource = self.resource()
+    table = self._local.tables.get(table_name)
+    if table is None:
+      table = self._local.tables[table_name] = resource.Table(table_name)
+    return table
+
+  def warm(self, table_name):
+    ''' Open a pooled connection and build this thread's Table '''
+    self.client.describe_table(TableName=table_name)
+    self.table(table_name)
+
+  def pool_stats(self):
+    ''' In use, idle and allowed HTTP connections across the clients, from urllib3 internals '''
+    stats = {'in_use': 0, 'idle': 0, 'max': 0}
+    for client in list(self._clients):
+      try:
+        pools = client._endpoint.http_session._manager.pools
+        for key in pools.keys():
+          connections = pools[key].pool
+          # the queue starts out full of None placeholders, checked out slots are in use
+          stats['idle'] += sum(1 for conn in list(connections.queue) if conn is not None)
+          stats['in_use'] += connections.maxsize - connections.qsize()
+          stats['max'] += connections.maxsize
+      except (AttributeError, KeyError, TypeError):
+        continue
+    return stats
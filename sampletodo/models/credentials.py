@@ -0,0 +1,143 @@
+''' AWS credentials that are refreshed in the background '''
+
+import os
+import threading
+import time
+import traceback
+import weakref
+
+import structlog
+from botocore.credentials import CredentialProvider, Credentials, ReadOnlyCredentials
+
+_instances = weakref.WeakSet()
+
+class BackgroundRefreshCredentials(Credentials):
+  ''' Credentials renewed by a daemon thread ahead of their expiry
+
+  botocore signs every request with get_frozen_credentials(). Here that only
+  returns the current snapshot, so no request ever waits on STS: the
+  refresher thread fetches new credentials refresh_margin seconds before the
+  current ones expire and swaps the snapshot in one assignment. Failed
+  fetches are retried every retry_delay seconds while the old credentials
+  are still valid.
+
+  fetch is called without arguments and returns a dict with access_key,
+  secret_key, token and expiry_time (epoch seconds).
+  '''
+
+  method = 'sampletodo-background-refresh'
+
+  def __init__(self, fetch, refresh_margin=300, retry_delay=10, clock=time.time):
+    self._fetch = fetch
+    self._refresh_margin = refresh_margin
+    self._retry_delay = retry_delay
+    self._clock = clock
+    self._stop = threading.Event()
+    self._thread = None
+    self.refresh_count = 0
+    self.failure_count = 0
+    self.log = structlog.get_logger().new(component='credentials_refresher')
+
+    # the first fetch happens on the caller's thread, there is nothing to serve before it
+    self._update(fetch())
+    _instances.add(self)
+
+  def _update(self, credentials):
+    ''' Swap in a fresh snapshot '''
+    self._expiry_time = credentials['expiry_time']
+    self._frozen = ReadOnlyCredentials(credentials['access_key'],
+                                       credentials['secret_key'],
+                                       credentials.get('token'))
+
+  @property
+  def access_key(self):
+    return self._frozen.access_key
+
+  @property
+  def secret_key(self):
+    return self._frozen.secret_key
+
+  @property
+  def token(self):
+    return self._frozen.token
+
+  @property
+  def expiry_time(self):
+    return self._expiry_time
+
+  def get_frozen_credentials(self):
+    ''' Current credentials, never blocks '''
+    return self._frozen
+
+  def seconds_until_refresh(self):
+    ''' Time left before the refresher renews the credentials '''
+    remaining = self._expiry_time - self._clock()
+    # credentials that live shorter than the margin are renewed half way through
+    return max(0, remaining - min(self._refresh_margin, remaining / 2.0))
+
+  def refresh(self):
+    ''' Fetch new credentials now, returns True on success '''
+    try:
+      self._update(self._fetch())
+    except Exception as ex:
+      self.failure_count += 1
+      self.log.error('refresh_credentials', status='failed', error=str(ex),
+                     traceback=traceback.format_exc())
+      return False
+
+    self.refresh_count += 1
+    self.log.info('refresh_credentials', status='done', expiry_time=self._expiry_time)
+    return True
+
+  def _run(self):
+    ''' Refresher thread loop '''
+    while not self._stop.wait(self.seconds_until_refresh()):
+      if not self.refresh():
+        remaining = self._expiry_time - self._clock()
+        if remaining > 1:
+          self._stop.wait(min(self._retry_delay, remaining / 2.0))
+        else:
+          self._stop.wait(self._retry_delay)
+
+  def start(self):
+    ''' Start the refresher thread if it is not running '''
+    if self._thread is not None and self._thread.is_alive():
+      return
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run, name='credentials-refresher')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    ''' Stop the refresher thread '''
+    self._stop.set()
+    if self._thread is not None and self._thread is not threading.current_thread():
+      self._thread.join()
+    self._thread = None
+
+class StaticCredentialProvider(CredentialProvider):
+  ''' Credential chain entry that hands out credentials the app already holds '''
+  METHOD = 'sampletodo-static'
+
+  def __init__(self, credentials):
+    CredentialProvider.__init__(self)
+    self.credentials = credentials
+
+  def load(self):
+    return self.credentials
+
+def use_credentials(botocore_session, credentials, provider_class=StaticCredentialProvider):
+  ''' Make a botocore session sign with credentials, ahead of the rest of its credential chain '''
+  resolver = botocore_session.get_component('credential_provider')
+  resolver.insert_before(resolver.providers[0].METHOD, provider_class(credentials))
+  return botocore_session
+
+def _restart_after_fork():
+  ''' Threads do not survive fork, restart the refreshers in the child '''
+  for credentials in list(_instances):
+    if credentials._thread is not None:
+      credentials._thread = None
+      credentials.start()
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_restart_after_fork)
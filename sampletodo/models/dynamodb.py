@@ -1,108 +1,524 @@
 ''' Tasks table in dynamodb '''
 
 import os
+import base64
 import structlog
 import json
 import time
-import uuid
+import random
+import calendar
+import threading
 import boto3
+import botocore.session
 import traceback
-from boto3.dynamodb.conditions import Attr
-from moto import mock_dynamodb2
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from boto3.dynamodb.conditions import Attr, Key, ConditionExpressionBuilder
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+from botocore.exceptions import BotoCoreError, ClientError
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
 
 from sampletodo.version import __version__
+# re-exported, models.dynamodb is where the rest of the app imports them from
+from sampletodo.models.base import ModelsException, CHANGE_VERSION_ID, STATUS_PENDING, \
+  STATUS_DONE, TITLE_INDEX_ATTRS, TITLE_PREFIX_LENGTH, UPDATABLE_ATTRS, TasksBackend, \
+  decode_cursor, derived_attrs, encode_cursor, is_counter_id, new_item, title_index_key, \
+  fields_projection, parse_fields, projection_with_id, task_status, title_search_key, update_attrs
+from sampletodo.models.connection import ClientInstrumentation, ConnectionBundle, \
+  botocore_config
+from sampletodo.models.credentials import BackgroundRefreshCredentials, use_credentials
+from sampletodo.models.metadata import TableMetadata
+import sampletodo.common.metrics as metrics
 import sampletodo.common.utils as utils
 
-class ModelsException(Exception):
-  pass
+def update_expression(set_attrs, remove_attrs=()):
+  ''' Build update_item expression arguments for SET and REMOVE actions '''
+  names = {}
+  values = {}
+  actions = []
 
-def func_name():
-  return traceback.extract_stack(None, 2)[0][2]
+  if set_attrs:
+    for attr, value in set_attrs.items():
+      names['#%s' % attr] = attr
+      values[':%s' % attr] = value
+    actions.append('SET ' + ', '.join('#%s = :%s' % (attr, attr) for attr in set_attrs))
 
-class TasksTable(object):
-  ''' Store the todo data '''
-  mock_dynamodb2 = mock_dynamodb2()
+  if remove_attrs:
+    for attr in remove_attrs:
+      names['#%s' % attr] = attr
+    actions.append('REMOVE ' + ', '.join('#%s' % attr for attr in remove_attrs))
 
-  def _aws_session_assume_role(self):
-    ''' Assume AWS role '''
-    log_msg = 'aws_session_assume_role'
+  kwargs = {
+    'ExpressionAttributeNames': names,
+    'UpdateExpression': ' '.join(actions),
+  }
+  if values:
+    kwargs['ExpressionAttributeValues'] = values
+  return kwargs
+
+def summarize_result(result):
+  ''' Counts and sizes of a DynamoDB response, cheap enough to log on every call '''
+  summary = {}
+  if 'Items' in result:
+    summary['count'] = len(result['Items'])
+  if 'ScannedCount' in result:
+    summary['scanned_count'] = result['ScannedCount']
+  if 'Attributes' in result:
+    summary['attributes'] = len(result['Attributes'])
+  if 'LastEvaluatedKey' in result:
+    summary['has_more'] = True
+  metadata = result.get('ResponseMetadata', {})
+  if metadata:
+    summary['http_status_code'] = metadata.get('HTTPStatusCode')
+    summary['retry_attempts'] = metadata.get('RetryAttempts')
+  return summary
+
+# BatchWriteItem accepts at most 25 put/delete requests per call
+BATCH_WRITE_SIZE = 25
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_SIZE = 100
+
+def backoff_delay(attempt, base=0.05, cap=2.0):
+  ''' Exponential backoff with full jitter for retrying unprocessed batch items '''
+  return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+# parallel scan workers push pages onto a queue, these mark how they finished
+_SEGMENT_DONE = object()
+_SEGMENT_FAILED = object()
+
+def deserialize_item(item):
+  ''' Convert a low level client item into python types '''
+  return dict((k, _deserializer.deserialize(v)) for k, v in item.items())
+
+def serialize_item(item):
+  ''' Convert python types into a low level client item '''
+  return dict((k, _serializer.serialize(v)) for k, v in item.items())
+
+def scan_expression_args(projection=None, filter_expression=None):
+  ''' Build low level client scan arguments from attribute names and a boto3 condition '''
+  kwargs = {}
+  names = {}
+
+  if projection:
+    placeholders = []
+    for idx, attr in enumerate(projection):
+      names['#p%s' % idx] = attr
+      placeholders.append('#p%s' % idx)
+    kwargs['ProjectionExpression'] = ', '.join(placeholders)
+
+  if filter_expression is not None:
+    built = ConditionExpressionBuilder().build_expression(filter_expression)
+    names.update(built.attribute_name_placeholders)
+    kwargs['FilterExpression'] = built.condition_expression
+    kwargs['ExpressionAttributeValues'] = dict(
+      (k, _serializer.serialize(v)) for k, v in built.attribute_value_placeholders.items())
+
+  if names:
+    kwargs['ExpressionAttributeNames'] = names
+  return kwargs
+
+def with_projection(kwargs, projection=None):
+  ''' Add a ProjectionExpression to get/scan/query arguments, keeping their attribute names '''
+  projection = projection_with_id(projection)
+  if projection:
+    args = scan_expression_args(projection)
+    kwargs['ProjectionExpression'] = args['ProjectionExpression']
+    # the #p placeholders never collide with the #n ones boto3 builds for conditions
+    kwargs.setdefault('ExpressionAttributeNames', {}).update(args['ExpressionAttributeNames'])
+  return kwargs
+
+def key_condition_args(key_condition):
+  ''' Build low level client query arguments from a boto3 key condition '''
+  built = ConditionExpressionBuilder().build_expression(key_condition, is_key_condition=True)
+  return {
+    'KeyConditionExpression': built.condition_expression,
+    'ExpressionAttributeNames': built.attribute_name_placeholders,
+    'ExpressionAttributeValues': dict((k, _serializer.serialize(v))
+                                      for k, v in built.attribute_value_placeholders.items()),
+  }
+
+def update_args(updated_attrs):
+  ''' Conditional update_item arguments for the attributes the client sent '''
+  return attrs_update_args(*update_attrs(updated_attrs))
+
+def attrs_update_args(set_attrs, remove_attrs=()):
+  ''' update_args for the attributes update_attrs picked '''
+  kwargs = update_expression(set_attrs, remove_attrs)
+  kwargs['ExpressionAttributeNames']['#id'] = 'id'
+  kwargs['ConditionExpression'] = 'attribute_exists(#id)'
+  kwargs['ReturnValues'] = 'ALL_NEW'
+  return kwargs
+
+# the counter items have none of the index keys, scans have to leave them out
+TASKS_ONLY = ~Attr('id').begins_with(CHANGE_VERSION_ID)
+
+# key attributes of the LastEvaluatedKey of table scans and of each index query,
+# a cursor only continues the kind of page it came from
+SCAN_CURSOR_KEYS = ('id',)
+STATUS_CURSOR_KEYS = ('createdat', 'id', 'task_status')
+TITLE_CURSOR_KEYS = ('id', 'title_key', 'title_prefix')
+
+def start_key(cursor, cursor_keys):
+  ''' Decode a cursor into an ExclusiveStartKey, which must have the cursor_keys attributes '''
+  key = decode_cursor(cursor)
+  if sorted(key) != sorted(cursor_keys):
+    raise ModelsException('Invalid cursor')
+  return key
+
+def tasks_only(filter_expression=None):
+  ''' Scan filter that leaves out the change version item '''
+  if filter_expression is None:
+    return TASKS_ONLY
+  return filter_expression & TASKS_ONLY
+
+def counter_ids(shards):
+  ''' Ids of the counter items, the first one is the counter of tables from before sharding '''
+  return [CHANGE_VERSION_ID] + ['%s#%s' % (CHANGE_VERSION_ID, shard) for shard in range(1, shards)]
+
+def bump_version_args(deltas=None, counter_id=CHANGE_VERSION_ID):
+  ''' Low level update_item arguments that atomically add one to a change version shard
+
+  The counter items also keep the number of tasks per status in
+  <status>_count attributes, deltas maps statuses to the change of their
+  count. The change version and the counts are the sums over the shards.
+  '''
+  names = {'#version': 'change_version'}
+  values = {':one': {'N': '1'}}
+  actions = ['#version :one']
+  for status, delta in sorted((deltas or {}).items()):
+    if delta:
+      names['#%s' % status] = '%s_count' % status
+      values[':%s' % status] = {'N': str(delta)}
+      actions.append('#%s :%s' % (status, status))
+  return {
+    'Key': {'id': {'S': counter_id}},
+    'UpdateExpression': 'ADD ' + ', '.join(actions),
+    'ExpressionAttributeNames': names,
+    'ExpressionAttributeValues': values,
+    'ReturnValues': 'UPDATED_NEW',
+  }
+
+# what change_version() and task_counts() read of the counter items
+COUNTER_ATTRS = ['id', 'change_version', 'pending_count', 'done_count']
+
+def versions_from_items(items):
+  ''' {counter id: change version} of counter items '''
+  return dict((item['id'], int(item.get('change_version', 0))) for item in items)
+
+def counts_from_items(items):
+  ''' Task counts per status summed over counter items '''
+  return dict((status, sum(int(item.get('%s_count' % status, 0)) for item in items))
+              for status in (STATUS_PENDING, STATUS_DONE))
+
+def counter_failure_code(ex):
+  ''' Metric label of a failed counter update '''
+  if isinstance(ex, ClientError):
+    return ex.response['Error']['Code']
+  return type(ex).__name__
+
+def status_deltas(old, new):
+  ''' Count changes of replacing item old with item new, either may be None '''
+  deltas = {}
+  if old and old.get('task_status'):
+    deltas[old['task_status']] = -1
+  if new and new.get('task_status'):
+    deltas[new['task_status']] = deltas.get(new['task_status'], 0) + 1
+  return deltas
+
+def batch_deltas(results, statuses):
+  ''' Count changes of a batch_write_items result, statuses has the deleted items' status '''
+  deltas = {}
+  for result in results['created']:
+    if result['status'] == 'created':
+      status = result['task']['task_status']
+      deltas[status] = deltas.get(status, 0) + 1
+  # repeated ids share one result
+  deleted = set(result['id'] for result in results['deleted'] if result['status'] == 'deleted')
+  for item_id in deleted:
+    if statuses.get(item_id):
+      deltas[statuses[item_id]] = deltas.get(statuses[item_id], 0) - 1
+  return deltas
+
+def add_deleted(deltas, keys, unprocessed_ids=()):
+  ''' Take deleted low level keys, scanned with their task_status, off the counts '''
+  for key in keys:
+    if key['id']['S'] not in unprocessed_ids and 'task_status' in key:
+      status = key['task_status']['S']
+      deltas[status] = deltas.get(status, 0) - 1
+  return deltas
+
+# the sync and the async tables share the request building and response handling
+# below, they only differ in how they wait for DynamoDB
+
+def bumped_version(result):
+  ''' Change version of the shard a bump_version_args update_item returned '''
+  return int(result['Attributes']['change_version']['N'])
+
+def request_ids(requests):
+  ''' Ids of the items of BatchWriteItem put and delete requests '''
+  return set(request['PutRequest']['Item']['id']['S'] if 'PutRequest' in request
+             else request['DeleteRequest']['Key']['id']['S'] for request in requests)
+
+def batch_write_requests(creates, deletes, stamp=new_item):
+  ''' Validate a batch_write_items call before anything is written
+
+  Returns (results, batches, deletes), invalid tasks and ids already
+  failed in results. batches are lists of up to BATCH_WRITE_SIZE
+  (result, PutRequest) pairs, deletes maps every distinct id to its
+  result, repeated ids share a single delete and result.
+  '''
+  results = {'created': [], 'deleted': []}
+  pending = []
+
+  for index, item in enumerate(creates):
+    result = {'index': index}
+    results['created'].append(result)
     try:
-      self.log.bind(mechanism='assume_role')
-      self.log.info(log_msg,
-                    role=self.kwargs['AWS_ROLE_ARN'],
-                    session_name=self.kwargs['AWS_ROLE_SESSION_NAME'])
+      if not isinstance(item, dict):
+        raise ModelsException('Task must be an object')
+      item = stamp(item)
+      request = {'PutRequest': {'Item': serialize_item(item)}}
+    except (ModelsException, TypeError) as ex:
+      result.update(status='failed', error=str(ex))
+      continue
+    result.update(status='created', task=item)
+    pending.append((result, request))
+
+  seen = OrderedDict()
+  for item_id in deletes:
+    if not isinstance(item_id, utils.string_types) or not item_id or \
+       is_counter_id(item_id):
+      results['deleted'].append({'id': item_id, 'status': 'failed', 'error': 'Invalid task id'})
+      continue
+    if item_id in seen:
+      results['deleted'].append(seen[item_id])
+      continue
+    result = seen[item_id] = {'id': item_id, 'status': 'deleted'}
+    results['deleted'].append(result)
+
+  batches = [pending[idx:idx + BATCH_WRITE_SIZE] for idx in range(0, len(pending), BATCH_WRITE_SIZE)]
+  return results, batches, seen
+
+def failed_puts(batch, unprocessed=(), error=None):
+  ''' (result, error) of the tasks of a batch the call failed with error or left unprocessed '''
+  if error is not None:
+    return [(result, error) for result, _ in batch]
+  failed_ids = request_ids(unprocessed)
+  return [(result, 'Unprocessed after retries') for result, _ in batch
+          if result['task']['id'] in failed_ids]
+
+def delete_item_args(item_id):
+  ''' Low level delete_item arguments, the old item says which count the delete takes one off '''
+  return {'Key': {'id': {'S': item_id}}, 'ReturnValues': 'ALL_OLD'}
+
+def deleted_status(response):
+  ''' task_status of what a delete_item_args call removed, None when there was nothing '''
+  return response.get('Attributes', {}).get('task_status', {}).get('S')
+
+def batch_write_deltas(results, put_failures, delete_outcomes):
+  ''' Record the failed writes of a batch_write_items call and return its count changes
+
+  put_failures are failed_puts pairs, delete_outcomes (result, error,
+  deleted_status) of every DeleteItem call.
+  '''
+  for result, error in put_failures:
+    result.pop('task', None)
+    result.update(status='failed', error=error)
 
-      client = boto3.client('sts')
-      response = client.assume_role(RoleArn=self.kwargs['AWS_ROLE_ARN'],
-                                    RoleSessionName=self.kwargs['AWS_ROLE_SESSION_NAME'],
-                                    DurationSeconds=900)
+  statuses = {}
+  for result, error, status in delete_outcomes:
+    if error:
+      result.update(status='failed', error=error)
+    else:
+      statuses[result['id']] = status
+  return batch_deltas(results, statuses)
+
+def delete_requests(keys):
+  ''' BatchWriteItem delete requests of low level keys '''
+  return [{'DeleteRequest': {'Key': {'id': key['id']}}} for key in keys]
+
+def tally_deleted(counts, deltas, keys, unprocessed):
+  ''' Add a delete_requests batch of scanned keys to the delete_all_items counts and count changes '''
+  unprocessed_ids = request_ids(unprocessed)
+  counts['deleted'] += len(keys) - len(unprocessed_ids)
+  counts['unprocessed'] += len(unprocessed_ids)
+  add_deleted(deltas, keys, unprocessed_ids)
+
+def update_item_args(item_id, updated_attrs):
+  ''' Conditional update_item arguments, with the attributes they set and remove
+
+  ReturnValues is ALL_OLD when the status changes, the old status is
+  needed to move the count and the new item follows from it.
+  '''
+  if is_counter_id(item_id):
+    raise ModelsException('Did not find task')
+  set_attrs, remove_attrs = update_attrs(updated_attrs)
+  kwargs = attrs_update_args(set_attrs, remove_attrs)
+  if 'task_status' in set_attrs:
+    kwargs['ReturnValues'] = 'ALL_OLD'
+  return kwargs, set_attrs, remove_attrs
+
+def missing_task(ex):
+  ''' ModelsException for an update whose condition found no task, other errors are raised '''
+  if ex.response['Error']['Code'] != 'ConditionalCheckFailedException':
+    raise ex
+  return ModelsException('Did not find task')
 
-      aws_access_key_id = response['Credentials']['AccessKeyId']
-      aws_secret_access_key = response['Credentials']['SecretAccessKey']
-      aws_session_token = response['Credentials']['SessionToken']
+def updated_item_deltas(result, kwargs, set_attrs, remove_attrs):
+  ''' Count changes of an update_item_args call, an ALL_OLD result becomes the updated item '''
+  if kwargs['ReturnValues'] != 'ALL_OLD':
+    return None
+  old_item = result['Attributes']
+  updated = dict(old_item, **set_attrs)
+  for attr in remove_attrs:
+    updated.pop(attr, None)
+  result['Attributes'] = updated
+  return status_deltas(old_item, updated)
 
-      del response['Credentials']['AccessKeyId']
-      del response['Credentials']['SecretAccessKey']
-      del response['Credentials']['SessionToken']
+def title_key_condition(title_key):
+  ''' Title index key condition of the tasks whose title_key starts with a title_search_key '''
+  return Key('title_prefix').eq(title_key[:TITLE_PREFIX_LENGTH]) & \
+         Key('title_key').begins_with(title_key)
 
-      self.log.info(log_msg, response=json.dumps(response, default=str))
+def attribute_definitions():
+  ''' Attributes used by the table and index key schemas '''
+  return [
+    {'AttributeName': 'id', 'AttributeType': 'S'},
+    {'AttributeName': 'task_status', 'AttributeType': 'S'},
+    {'AttributeName': 'createdat', 'AttributeType': 'N'},
+    {'AttributeName': 'title_prefix', 'AttributeType': 'S'},
+    {'AttributeName': 'title_key', 'AttributeType': 'S'},
+  ]
 
-      session = boto3.Session(aws_access_key_id=aws_access_key_id,
-                              aws_secret_access_key=aws_secret_access_key,
-                              aws_session_token=aws_session_token)
+def global_secondary_indexes(kwargs):
+  ''' Global secondary indexes the table is expected to have '''
+  return [
+    {
+      'IndexName': kwargs['DYNAMODB_STATUS_INDEX_NAME'],
+      'KeySchema': [
+        {'AttributeName': 'task_status', 'KeyType': 'HASH'},
+        {'AttributeName': 'createdat', 'KeyType': 'RANGE'}
+      ],
+      'Projection': {'ProjectionType': 'ALL'},
+      'ProvisionedThroughput': {
+        'ReadCapacityUnits': 10,
+        'WriteCapacityUnits': 10
+      }
+    },
+    {
+      'IndexName': kwargs['DYNAMODB_TITLE_INDEX_NAME'],
+      'KeySchema': [
+        {'AttributeName': 'title_prefix', 'KeyType': 'HASH'},
+        {'AttributeName': 'title_key', 'KeyType': 'RANGE'}
+      ],
+      'Projection': {'ProjectionType': 'ALL'},
+      'ProvisionedThroughput': {
+        'ReadCapacityUnits': 10,
+        'WriteCapacityUnits': 10
+      }
+    }
+  ]
+
+class TasksTable(TasksBackend):
+  ''' Store the todo data in DynamoDB '''
+  name = 'dynamodb'
+  # shared by every instance, moto is only imported when DYNAMODB_MOCK is set
+  _dynamodb_mock = None
+
+  def _assume_role_credentials(self, sts_client):
+    ''' Fetch temporary credentials for the configured role '''
+    log_msg = 'aws_assume_role'
+    response = sts_client.assume_role(RoleArn=self.kwargs['AWS_ROLE_ARN'],
+                                      RoleSessionName=self.kwargs['AWS_ROLE_SESSION_NAME'],
+                                      DurationSeconds=self.kwargs['AWS_ROLE_DURATION_SECONDS'])
+    credentials = response.pop('Credentials')
+    self.log.info(log_msg, response=json.dumps(response, default=str),
+                  expiration=str(credentials['Expiration']))
+
+    return {
+      'access_key': credentials['AccessKeyId'],
+      'secret_key': credentials['SecretAccessKey'],
+      'token': credentials['SessionToken'],
+      'expiry_time': calendar.timegm(credentials['Expiration'].utctimetuple()),
+    }
+
+  def _aws_session_assume_role(self):
+    ''' Assume AWS role, the credentials are renewed in the background '''
+    log_msg = 'aws_session_assume_role'
+    log = self.log.bind(mechanism='assume_role')
+    try:
+      log.info(log_msg,
+               role=self.kwargs['AWS_ROLE_ARN'],
+               session_name=self.kwargs['AWS_ROLE_SESSION_NAME'])
+
+      sts_client = boto3.client('sts')
+      credentials = BackgroundRefreshCredentials(
+        lambda: self._assume_role_credentials(sts_client),
+        refresh_margin=self.kwargs['AWS_CREDENTIALS_REFRESH_MARGIN'])
+
+      botocore_session = use_credentials(botocore.session.get_session(), credentials)
+      session = boto3.Session(botocore_session=botocore_session,
+                              region_name=self.kwargs['AWS_DEFAULT_REGION'])
     except Exception as ex:
       tb = traceback.format_exc()
-      self.log.error(log_msg, status='failed', error=str(ex), traceback=tb)
-      self.log = self.log.unbind('mechanism')
+      log.error(log_msg, status='failed', error=str(ex), traceback=tb)
       raise ex
 
-    self.log = self.log.unbind('mechanism')
+    # clients built from the session keep signing with the refreshed credentials
+    if self._credentials is not None:
+      self._credentials.stop()
+    self._credentials = credentials
+    credentials.start()
+
     return session
 
   def _aws_session_with_keys(self):
     ''' Create AWS session directly '''
     log_msg = 'aws_session_with_keys'
+    log = self.log.bind(mechanism='keys')
     try:
-      self.log.bind(mechanism='keys')
-      self.log.info('connection_parameters',
-                    aws_access_key_id='***',
-                    aws_secret_access_key='***',
-                    region_name=self.kwargs['AWS_DEFAULT_REGION'])
+      log.info('connection_parameters',
+               aws_access_key_id='***',
+               aws_secret_access_key='***',
+               region_name=self.kwargs['AWS_DEFAULT_REGION'])
       session = boto3.Session(aws_access_key_id=self.kwargs['AWS_ACCESS_KEY_ID'],
                               aws_secret_access_key=self.kwargs['AWS_SECRET_ACCESS_KEY'],
                               region_name=self.kwargs['AWS_DEFAULT_REGION'])
     except Exception as ex:
       tb = traceback.format_exc()
-      self.log.error(log_msg, status='failed', error=str(ex), traceback=tb)
-      self.log = self.log.unbind('mechanism')
+      log.error(log_msg, status='failed', error=str(ex), traceback=tb)
       raise ex
 
-    self.log = self.log.unbind('mechanism')
     return session
 
-  def aws_connect_dynamodb(self):
-    ''' Connect to AWS DynamoDB '''
+  def aws_connect_dynamodb(self, session):
+    ''' Build a DynamoDB connection bundle from a session '''
     log_msg = 'connecting_to_dynamodb'
     self.log.info(log_msg, status='started')
     try:
+      url = None
       if self.kwargs['DYNAMODB_ENABLE_LOCAL']:
-        self.url = 'http://%s:%s' % (self.kwargs['DYNAMODB_HOST'],
-                                     self.kwargs['DYNAMODB_PORT'])
-        self.client = self.session.client('dynamodb', endpoint_url=self.url,
-                                           region_name=self.kwargs['AWS_DEFAULT_REGION'])
-        self.resource = self.session.resource('dynamodb', endpoint_url=self.url,
-                                               region_name=self.kwargs['AWS_DEFAULT_REGION'])
-      else:
-        self.client = self.session.client('dynamodb',
-                                           region_name=self.kwargs['AWS_DEFAULT_REGION'])
-        self.resource = self.session.resource('dynamodb',
-                                               region_name=self.kwargs['AWS_DEFAULT_REGION'])
+        url = 'http://%s:%s' % (self.kwargs['DYNAMODB_HOST'],
+                                self.kwargs['DYNAMODB_PORT'])
+      connection = ConnectionBundle(session, self.kwargs['AWS_DEFAULT_REGION'],
+                                    endpoint_url=url,
+                                    config=botocore_config(self.kwargs),
+                                    instrumentation=ClientInstrumentation(
+                                      self.kwargs['DYNAMODB_RETURN_CONSUMED_CAPACITY']))
     except Exception as ex:
       tb = traceback.format_exc()
       self.log.info(log_msg, status='failed', error=str(ex), traceback=tb)
       raise ex
 
     self.log.info(log_msg, status='done')
+    return connection
 
   def aws_create_session(self):
     ''' Create AWS session'''
@@ -110,35 +526,62 @@ class TasksTable(object):
     self.log.info(log_msg, status='started')
 
     if os.environ['SAMPLETODO_CONFIG_ENV'] == 'TestLocalRunConfig':
-      self.session = boto3.Session()
+      session = boto3.Session()
     else:
       try:
-        self.session = self._aws_session_with_keys()
+        session = self._aws_session_with_keys()
       except Exception as ex:
-        self.session = self._aws_session_assume_role()
+        session = self._aws_session_assume_role()
 
-    self.log.info('aws_session_object', session=self.session)
+    self.log.info('aws_session_object', session=session)
     self.log.info(log_msg, status='done')
+    return session
+
+  # the current connection bundle is read once per access, so swapping it
+  # in refresh_aws_connection is atomic for requests running concurrently
+  @property
+  def session(self):
+    return self._connection.session
+
+  @property
+  def client(self):
+    return self._connection.client
+
+  @property
+  def resource(self):
+    return self._connection.resource()
+
+  @property
+  def _table(self):
+    return self._connection.table(self.kwargs['DYNAMODB_TABLE_NAME'])
 
-  def _table_exists(self):
-    ''' Check if a specific table exists '''
+  def _table_exists(self, client=None):
+    ''' Check if a specific table exists, from cached metadata unless a client is given '''
     self.log.info('checking_table_exists')
 
     try:
-      response = self.client.list_tables()
+      if client is not None:
+        return self.metadata.refresh(client) is not None
+      return self.metadata.exists()
     except Exception as ex:
       tb = traceback.format_exc()
       self.log.error('failed_table_exists_error', error=str(ex))
       self.log.error('failed_table_exists_traceback', traceback=tb)
       raise ex
 
-    return self.kwargs['DYNAMODB_TABLE_NAME'] in response['TableNames']
+  def _attribute_definitions(self):
+    ''' Attributes used by the table and index key schemas '''
+    return attribute_definitions()
 
-  def _create_table(self):
+  def _global_secondary_indexes(self):
+    ''' Global secondary indexes the table is expected to have '''
+    return global_secondary_indexes(self.kwargs)
+
+  def _create_table(self, client=None):
     ''' Create table '''
     self.log.info('creating_table')
     try:
-      response = self.client.create_table(
+      response = (client or self.client).create_table(
         TableName=self.kwargs['DYNAMODB_TABLE_NAME'],
         KeySchema=[
           {
@@ -146,12 +589,8 @@ class TasksTable(object):
             'KeyType': 'HASH'  #Partition key
           }
         ],
-        AttributeDefinitions=[
-          {
-            'AttributeName': 'id',
-            'AttributeType': 'S'
-          }
-        ],
+        AttributeDefinitions=self._attribute_definitions(),
+        GlobalSecondaryIndexes=self._global_secondary_indexes(),
         ProvisionedThroughput={
           'ReadCapacityUnits': 10,
           'WriteCapacityUnits': 10
@@ -164,156 +603,674 @@ class TasksTable(object):
       raise ex
     return response
 
+  def provision_table(self, client=None):
+    ''' Create the table with its indexes unless it already exists '''
+    client = client or self.client
+    if self._table_exists(client):
+      return {'created': False}
+
+    self._create_table(client)
+    client.get_waiter('table_exists').wait(TableName=self.kwargs['DYNAMODB_TABLE_NAME'])
+    self.metadata.refresh(client)
+    return {'created': True}
+
+  def _wait_for_index(self, index_name, delay=5, max_attempts=120):
+    ''' Wait until a global secondary index has finished building '''
+    for _ in range(max_attempts):
+      self.metadata.refresh()
+      if self.metadata.index_active(index_name):
+        return
+      time.sleep(delay)
+
+    err = 'Timed out waiting for index %s' % index_name
+    self.log.error('failed_wait_for_index', err=err)
+    raise ModelsException(err)
+
+  def _backfill_derived_attrs(self):
+    ''' Set index key attributes on items written before the index existed '''
+    scanned = 0
+    updated = 0
+    for item in self.parallel_scan():
+      scanned += 1
+      missing = dict((attr, value) for attr, value in derived_attrs(item).items()
+                     if item.get(attr) != value)
+      if not missing:
+        continue
+
+      self._table.update_item(Key={'id': item['id']}, **update_expression(missing))
+      updated += 1
+
+    return {'scanned': scanned, 'updated': updated}
+
+  def migrate_indexes(self):
+    ''' Add missing global secondary indexes to an existing table '''
+    log_msg = 'migrating_indexes'
+    self.log.info(log_msg, status='started')
+
+    self.metadata.refresh()
+    existing = set(self.metadata.indexes())
+
+    created = []
+    for index in self._global_secondary_indexes():
+      if index['IndexName'] in existing:
+        continue
+      self.log.info(log_msg, status='creating_index', index_name=index['IndexName'])
+      # DynamoDB only allows one index to be created per update_table call
+      self.client.update_table(
+        TableName=self.kwargs['DYNAMODB_TABLE_NAME'],
+        AttributeDefinitions=self._attribute_definitions(),
+        GlobalSecondaryIndexUpdates=[{'Create': index}],
+      )
+      self._wait_for_index(index['IndexName'])
+      created.append(index['IndexName'])
+
+    result = self._backfill_derived_attrs()
+    result['created_indexes'] = created
+
+    self.log.info(log_msg, status='done', result=result)
+    return result
+
   def refresh_aws_connection(self):
     ''' Reconnect AWS assume role '''
     log_msg = 'initializing_aws'
     self.log.info(log_msg, status='started')
 
     try:
-      self.aws_create_session()
+      session = self.aws_create_session()
     except Exception as ex:
       tb = traceback.format_exc()
       self.log.error('failed_aws_create_session', error=str(ex), traceback=tb)
       raise ex
 
     try:
-      self.aws_connect_dynamodb()
+      connection = self.aws_connect_dynamodb(session)
     except Exception as ex:
       tb = traceback.format_exc()
       self.log.error('failed_aws_connect_dynamodb', error=str(ex), traceback=tb)
       raise ex
 
-    if not self._table_exists():
-      if self.kwargs['DYNAMODB_MOCK'] or self.kwargs['DYNAMODB_ENABLE_LOCAL']:
-        self._create_table()
+    if not self._table_exists(connection.client):
+      if self.kwargs['DYNAMODB_AUTO_PROVISION']:
+        self.provisioned = self.provision_table(connection.client)
       else:
-        if not self.kwargs['DYNAMODB_ENABLE_LOCAL']:
-          err = 'Table does not exist'
-          self.log.error('failed_initializing_model', err=err)
-          raise ModelsException(err)
+        err = 'Table does not exist'
+        self.log.error('failed_initializing_model', err=err)
+        raise ModelsException(err)
 
-    self._table = self.resource.Table(self.kwargs['DYNAMODB_TABLE_NAME'])
+    # requests already in flight finish on the bundle they started with
+    self._connection = connection
 
     self.log.info(log_msg, status='done')
 
+  def table_info(self):
+    ''' Cached table status, size, capacity and indexes '''
+    return self.metadata.summary()
+
+  def pool_stats(self):
+    ''' HTTP connection pool usage of the current connection '''
+    return self._connection.pool_stats()
+
+  def warm_connections(self, count=None):
+    ''' Open pooled connections ahead of the first requests '''
+    count = self.kwargs['DYNAMODB_PREWARM_CONNECTIONS'] if count is None else count
+    if count < 1:
+      return
+
+    log_msg = 'warming_connections'
+    self.log.info(log_msg, status='started', count=count)
+
+    connection = self._connection
+    table_name = self.kwargs['DYNAMODB_TABLE_NAME']
+    executor = ThreadPoolExecutor(max_workers=count)
+    try:
+      # concurrent calls are what makes the client open count connections
+      list(executor.map(lambda _: connection.client.describe_table(TableName=table_name),
+                        range(count)))
+    finally:
+      executor.shutdown(wait=True)
+    connection.warm(table_name)
+
+    self.log.info(log_msg, status='done', count=count)
+
   def __init__(self, **kwargs):
 
     self.kwargs = kwargs
+    self._credentials = None
+    # newest change version seen per counter shard and when they were read, see change_version
+    self._counter_ids = counter_ids(kwargs['DYNAMODB_COUNTER_SHARDS'])
+    self._versions = {}
+    self._versions_read_at = 0
+    # writes whose counter update failed, they still have to change this process' ETags
+    self._lost_bumps = 0
+    self._version_lock = threading.Lock()
+    # provision_table() result when connecting created the table, see DYNAMODB_AUTO_PROVISION
+    self.provisioned = None
+    self.metadata = TableMetadata(lambda: self.client, kwargs['DYNAMODB_TABLE_NAME'],
+                                  refresh_interval=kwargs['DYNAMODB_METADATA_REFRESH_INTERVAL'])
 
     logger = structlog.get_logger()
     self.log = logger.new()
     self.log = self.log.bind(build_version=__version__)
 
-    self.log = self.log.bind(stage='initializing')
+    init_log = self.log.bind(stage='initializing')
+    init_log.debug('initializing_model', class_name=self.__class__, kwargs=kwargs)
 
-    self.log.debug('initializing_model', class_name=self.__class__, kwargs=kwargs)
-
-    if self.kwargs['DYNAMODB_MOCK']:
-      self.log.debug('mocking dynamodb')
-      self.mock_dynamodb2.start()
+    if self.kwargs['DYNAMODB_MOCK'] and TasksTable._dynamodb_mock is None:
+      init_log.debug('mocking dynamodb')
+      from moto import mock_dynamodb2
+      TasksTable._dynamodb_mock = mock_dynamodb2()
+      TasksTable._dynamodb_mock.start()
 
     self.refresh_aws_connection()
+    self.warm_connections()
+
+  def _set_versions(self, versions, read_at=None):
+    ''' Remember the newest version seen per shard, refreshes and bumps can finish out of order '''
+    with self._version_lock:
+      for counter_id, version in versions.items():
+        self._versions[counter_id] = max(version, self._versions.get(counter_id, 0))
+      if read_at is not None:
+        self._versions_read_at = read_at
+
+  def _current_version(self):
+    return sum(self._versions.values()) + self._lost_bumps
+
+  def _counter_items(self):
+    ''' The counter shards, one consistent BatchGetItem '''
+    items, _ = self._batch_get(self._counter_ids, COUNTER_ATTRS, consistent_read=True)
+    return items
+
+  def change_version(self):
+    ''' Table change counter, the sum of the shards, read at most every refresh interval
+
+    Writes from this process are seen right away, writes from other
+    processes within DYNAMODB_CHANGE_VERSION_REFRESH_INTERVAL seconds.
+    '''
+    now = time.time()
+    if now - self._versions_read_at < self.kwargs['DYNAMODB_CHANGE_VERSION_REFRESH_INTERVAL']:
+      return self._current_version()
+
+    # shards left unprocessed keep the version seen last
+    self._set_versions(versions_from_items(self._counter_items()), now)
+    return self._current_version()
+
+  def _bump_version(self, deltas=None):
+    ''' Count a write in a random counter shard, after the write so readers never see it early
+
+    The write already went through, a failed counter update is logged and
+    counted instead of failing it.
+    '''
+    counter_id = random.choice(self._counter_ids)
+    try:
+      result = self.client.update_item(TableName=self.kwargs['DYNAMODB_TABLE_NAME'],
+                                       **bump_version_args(deltas, counter_id))
+    except (ClientError, BotoCoreError) as ex:
+      metrics.DYNAMODB_COUNTER_FAILURES.inc(1, counter_failure_code(ex))
+      self.log.error('failed_bump_version', error=str(ex), deltas=deltas)
+      with self._version_lock:
+        self._lost_bumps += 1
+      return
+    self._set_versions({counter_id: bumped_version(result)})
+
+  def task_counts(self):
+    ''' Task counts per status summed over the counter shards, one small consistent read '''
+    return counts_from_items(self._counter_items())
+
+  def count_items(self, total_segments=None, max_workers=None):
+    ''' Task counts per status from parallel Select=COUNT scans, one set of segments per status
+
+    Only counts travel back, but every scan reads the whole table.
+    '''
+    total_segments = total_segments or self.kwargs['DYNAMODB_SCAN_SEGMENTS']
+    max_workers = max_workers or self.kwargs['DYNAMODB_SCAN_WORKERS']
+    statuses = (STATUS_PENDING, STATUS_DONE)
+
+    def count_segment(status, segment):
+      # the counter item has no task_status, the filter leaves it out as well
+      kwargs = scan_expression_args(filter_expression=Attr('task_status').eq(status))
+      kwargs.update(TableName=self.kwargs['DYNAMODB_TABLE_NAME'], Select='COUNT',
+                    Segment=segment, TotalSegments=total_segments)
+      return sum(page['Count'] for page in self._iter_pages(self.client.scan, **kwargs))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+      futures = [(status, executor.submit(metrics.propagate(count_segment), status, segment))
+                 for status in statuses for segment in range(total_segments)]
+      counts = dict((status, 0) for status in statuses)
+      for status, future in futures:
+        counts[status] += future.result()
+    finally:
+      executor.shutdown(wait=True)
+    return counts
+
+  def reconcile_counts(self):
+    ''' Replace the counters with count_items()
 
-    self.log = self.log.unbind('stage')
+    Writes that land while the scans run can be missed or counted twice,
+    run it when the table is quiet.
+    '''
+    before = self.task_counts()
+    after = self.count_items()
+    statuses = sorted(after)
+    # the first shard takes the counts, the others start over from 0
+    for counter_id in self._counter_ids:
+      counts = after if counter_id == CHANGE_VERSION_ID else dict((status, 0) for status in statuses)
+      result = self.client.update_item(
+        TableName=self.kwargs['DYNAMODB_TABLE_NAME'], Key={'id': {'S': counter_id}},
+        UpdateExpression='SET %s ADD #version :one' % ', '.join('#%s = :%s' % (status, status)
+                                                                for status in statuses),
+        ExpressionAttributeNames=dict([('#version', 'change_version')] +
+                                      [('#%s' % status, '%s_count' % status)
+                                       for status in statuses]),
+        ExpressionAttributeValues=dict([(':one', {'N': '1'})] +
+                                       [(':%s' % status, {'N': str(counts[status])})
+                                        for status in statuses]),
+        ReturnValues='UPDATED_NEW')
+      self._set_versions({counter_id: bumped_version(result)})
+    self.log.info('reconcile_counts', before=before, after=after)
+    return {'before': before, 'after': after}
+
+  def _new_item(self, item):
+    ''' Validate a new item and stamp its id, timestamps and index keys '''
+    try:
+      return new_item(item)
+    except ModelsException as ex:
+      self.log.error('failed_put_item', err=str(ex))
+      raise
+
+  def _log_result(self, event, result, **extra):
+    ''' Log a summary of a DynamoDB response, the full payload only at debug '''
+    self.log.debug(event, result=result)
+    extra.update(summarize_result(result))
+    self.log.info(event, **extra)
 
   def put_item(self, item):
     ''' Create item '''
     self.log.debug('put_item', item=item)
-    if 'title' not in item:
-      err = 'Title not provided'
-      self.log.error('failed_put_item', err=err)
-      raise ModelsException(err)
-
-    timestamp = int(time.time())
-
-    item['id'] = str(uuid.uuid1())
-    item['createdat'] = timestamp
-    item['updatedat'] = timestamp
-    item['done'] = False
+    item = self._new_item(item)
 
     self.log.debug('put_item', item=item)
 
-    self._table.put_item(Item=item)
+    result = self._table.put_item(Item=item, ReturnValues='ALL_OLD')
+    self._bump_version(status_deltas(result.get('Attributes'), item))
 
     return item
 
-  def get_item_by_id(self, item_id):
+  def batch_write_items(self, creates=(), deletes=()):
+    ''' Create items with parallel BatchWriteItem calls and delete them with parallel DeleteItem calls
+
+    BatchWriteItem does not say what a delete removed, DeleteItem returns
+    the old item, so the counts move by the status that was actually deleted.
+    '''
+    self.log.debug('batch_write_items', creates=len(creates), deletes=len(deletes))
+    results, batches, seen = batch_write_requests(creates, deletes, self._new_item)
+
+    def write_batch(batch):
+      try:
+        return failed_puts(batch, self._batch_write([request for _, request in batch]))
+      except ClientError as ex:
+        return failed_puts(batch, error=str(ex))
+
+    def delete_one(item_id):
+      try:
+        return None, deleted_status(self.client.delete_item(
+          TableName=self.kwargs['DYNAMODB_TABLE_NAME'], **delete_item_args(item_id)))
+      except ClientError as ex:
+        return str(ex), None
+
+    executor = ThreadPoolExecutor(max_workers=self.kwargs['DYNAMODB_BATCH_WORKERS'])
+    try:
+      batch_futures = [executor.submit(metrics.propagate(write_batch), batch)
+                       for batch in batches]
+      delete_futures = [(result, executor.submit(metrics.propagate(delete_one), item_id))
+                        for item_id, result in seen.items()]
+      put_failures = [failure for future in batch_futures for failure in future.result()]
+      delete_outcomes = [(result,) + future.result() for result, future in delete_futures]
+    finally:
+      executor.shutdown(wait=True)
+
+    if batches or seen:
+      self._bump_version(batch_write_deltas(results, put_failures, delete_outcomes))
+    self.log.info('batch_write_items', batches=len(batches), deletes=len(seen))
+    return results
+
+  def put_items(self, items):
+    ''' Store stamped items with BatchWriteItem, returns the ids still unprocessed after retries
+
+    The ids must be unique, BatchWriteItem rejects a batch that repeats a
+    key. Replaying items that were already written counts them twice in
+    task_counts(), reconcile_counts() fixes that.
+    '''
+    unprocessed = []
+    deltas = {}
+    for idx in range(0, len(items), BATCH_WRITE_SIZE):
+      batch = items[idx:idx + BATCH_WRITE_SIZE]
+      pending = self._batch_write([{'PutRequest': {'Item': serialize_item(item)}}
+                                   for item in batch])
+      pending_ids = request_ids(pending)
+      for item in batch:
+        if item['id'] in pending_ids:
+          unprocessed.append(item['id'])
+        else:
+          deltas[item['task_status']] = deltas.get(item['task_status'], 0) + 1
+
+    if deltas:
+      self._bump_version(deltas)
+    self.log.info('put_items', items=len(items), unprocessed=len(unprocessed))
+    return unprocessed
+
+  def get_item_by_id(self, item_id, projection=None):
     ''' Get item by id '''
-    self.log.debug(func_name(), item_id=item_id)
-    result = self._table.get_item(Key={'id': item_id})
-    self.log.info(func_name(), result=result)
+    self.log.debug('get_item_by_id', item_id=item_id, projection=projection)
+    if is_counter_id(item_id):
+      return {}
+    result = self._table.get_item(**with_projection({'Key': {'id': item_id}}, projection))
+    self._log_result('get_item_by_id', result, found='Item' in result)
     return result
 
-  def get_item_by_title(self, title):
-    ''' Get item by title '''
-    self.log.debug(func_name(), title=title)
-    result = self._table.scan(
-              Select='ALL_ATTRIBUTES',
-              FilterExpression=Attr('title').begins_with(title))
-    self.log.info(func_name(), result=result)
+  def _batch_get(self, item_ids, projection=None, consistent_read=False):
+    ''' Send one BatchGetItem call, retrying unprocessed keys with backoff '''
+    table_name = self.kwargs['DYNAMODB_TABLE_NAME']
+    request = scan_expression_args(projection)
+    request['Keys'] = [{'id': {'S': item_id}} for item_id in item_ids]
+    if consistent_read:
+      request['ConsistentRead'] = True
+    items = []
+    attempt = 0
+
+    while True:
+      response = self.client.batch_get_item(RequestItems={table_name: request})
+      items.extend(deserialize_item(item) for item in response['Responses'].get(table_name, []))
+      unprocessed = response.get('UnprocessedKeys', {}).get(table_name)
+      if not unprocessed or attempt >= self.kwargs['DYNAMODB_BATCH_MAX_RETRIES']:
+        break
+      # unprocessed keys come back with the projection arguments attached
+      request = unprocessed
+      time.sleep(backoff_delay(attempt))
+      attempt += 1
+
+    unprocessed_ids = [key['id']['S'] for key in (unprocessed or {}).get('Keys', [])]
+    return items, unprocessed_ids
+
+  def get_items_by_ids(self, item_ids, projection=None):
+    ''' Get items by id with parallel BatchGetItem calls '''
+    self.log.debug('get_items_by_ids', item_ids=len(item_ids), projection=projection)
+
+    # BatchGetItem rejects duplicate keys, and results are matched back by id
+    item_ids = list(OrderedDict((item_id, None) for item_id in item_ids))
+    projection = projection_with_id(projection)
+
+    # the counter items are not tasks, they are reported missing
+    fetch_ids = [item_id for item_id in item_ids if not is_counter_id(item_id)]
+    chunks = [fetch_ids[idx:idx + BATCH_GET_SIZE]
+              for idx in range(0, len(fetch_ids), BATCH_GET_SIZE)]
+    found = {}
+    unprocessed_ids = set()
+
+    executor = ThreadPoolExecutor(max_workers=self.kwargs['DYNAMODB_BATCH_WORKERS'])
+    try:
+      batch_get = metrics.propagate(lambda chunk: self._batch_get(chunk, projection))
+      for items, unprocessed in executor.map(batch_get, chunks):
+        found.update((item['id'], item) for item in items)
+        unprocessed_ids.update(unprocessed)
+    finally:
+      executor.shutdown(wait=True)
+
+    result = {
+      'Items': [found[item_id] for item_id in item_ids if item_id in found],
+      'MissingIds': [item_id for item_id in item_ids
+                     if item_id not in found and item_id not in unprocessed_ids],
+      'UnprocessedIds': [item_id for item_id in item_ids if item_id in unprocessed_ids],
+    }
+    self.log.info('get_items_by_ids', found=len(result['Items']),
+                  missing=len(result['MissingIds']),
+                  unprocessed=len(result['UnprocessedIds']))
     return result
 
-  def get_item_by_attr(self, attr_name, attr_value):
+  def get_item_by_title(self, title, limit=None, cursor=None, projection=None):
+    ''' Get one page of items whose title starts with title from the title index '''
+    self.log.debug('get_item_by_title', title=title, limit=limit, cursor=cursor,
+                   projection=projection)
+
+    try:
+      title_key = title_search_key(title)
+    except ModelsException as ex:
+      self.log.error('failed_get_item_by_title', err=str(ex))
+      raise
+
+    index_name = self.kwargs['DYNAMODB_TITLE_INDEX_NAME']
+    if self.metadata.index_active(index_name):
+      result = self._page(self._table.query, limit=limit, cursor=cursor,
+                          projection=projection, cursor_keys=TITLE_CURSOR_KEYS,
+                          IndexName=index_name,
+                          KeyConditionExpression=title_key_condition(title_key))
+    else:
+      # the index is missing or still building, fall back to the filtered scan,
+      # on the same normalized key so both paths find the same tasks
+      result = self._page(self._table.scan, limit=limit, cursor=cursor, projection=projection,
+                          FilterExpression=Attr('title_key').begins_with(title_key))
+    self._log_result('get_item_by_title', result, index_name=index_name)
+    return result
+
+  def get_item_by_attr(self, attr_name, attr_value, projection=None):
     ''' Get item by attr_name == attr_value '''
-    self.log.debug(func_name(), attr_name=attr_name, attr_value=attr_value)
-    result = self._table.scan(
-              Select='ALL_ATTRIBUTES',
-              FilterExpression=Attr(attr_name).eq(attr_value))
-    self.log.info(func_name(), result=result)
+    self.log.debug('get_item_by_attr', attr_name=attr_name, attr_value=attr_value,
+                   projection=projection)
+    kwargs = {'FilterExpression': tasks_only(Attr(attr_name).eq(attr_value))}
+    if not projection:
+      kwargs['Select'] = 'ALL_ATTRIBUTES'
+    result = self._table.scan(**with_projection(kwargs, projection))
+    self._log_result('get_item_by_attr', result)
+    return result
+
+  def _page(self, operation, limit=None, cursor=None, projection=None,
+            cursor_keys=SCAN_CURSOR_KEYS, **kwargs):
+    ''' Run a single scan/query page and attach the cursor for the next one '''
+    # LastEvaluatedKey has the key attributes whatever the projection leaves out
+    with_projection(kwargs, projection)
+    if limit:
+      kwargs['Limit'] = limit
+    if cursor:
+      kwargs['ExclusiveStartKey'] = start_key(cursor, cursor_keys)
+
+    result = operation(**kwargs)
+
+    if 'LastEvaluatedKey' in result:
+      result['NextCursor'] = encode_cursor(result['LastEvaluatedKey'])
+    return result
+
+  def _iter_pages(self, operation, page_size=None, **kwargs):
+    ''' Yield scan/query pages until LastEvaluatedKey runs out '''
+    if page_size:
+      kwargs['Limit'] = page_size
+
+    while True:
+      result = operation(**kwargs)
+      yield result
+      if 'LastEvaluatedKey' not in result:
+        return
+      kwargs['ExclusiveStartKey'] = result['LastEvaluatedKey']
+
+  def list_items(self, limit=None, cursor=None, projection=None):
+    ''' Get one page of items '''
+    self.log.debug('list_items', limit=limit, cursor=cursor, projection=projection)
+    result = self._page(self._table.scan, limit=limit, cursor=cursor, projection=projection,
+                        FilterExpression=TASKS_ONLY)
+    self._log_result('list_items', result)
     return result
 
-  def list_items(self):
-    ''' Get all items '''
-    result = self._table.scan()
-    self.log.info(func_name(), result=result)
+  def parallel_scan(self, projection=None, filter_expression=None,
+                    total_segments=None, max_workers=None, deserialize=True):
+    ''' Scan the whole table in parallel segments and stream the merged items '''
+    total_segments = total_segments or self.kwargs['DYNAMODB_SCAN_SEGMENTS']
+    max_workers = max_workers or self.kwargs['DYNAMODB_SCAN_WORKERS']
+    self.log.debug('parallel_scan', total_segments=total_segments, max_workers=max_workers)
+
+    scan_kwargs = scan_expression_args(projection, tasks_only(filter_expression))
+    scan_kwargs['TableName'] = self.kwargs['DYNAMODB_TABLE_NAME']
+    scan_kwargs['TotalSegments'] = total_segments
+
+    # bounded so that slow consumers apply backpressure to the scanning threads
+    pages = queue.Queue(maxsize=max_workers * 2)
+    stop = threading.Event()
+
+    def publish(entry):
+      while not stop.is_set():
+        try:
+          pages.put(entry, timeout=0.1)
+          return
+        except queue.Full:
+          continue
+
+    def scan_segment(segment):
+      try:
+        for page in self._iter_pages(self.client.scan, Segment=segment, **scan_kwargs):
+          if stop.is_set():
+            break
+          publish(page.get('Items', []))
+      except Exception as ex:
+        publish((_SEGMENT_FAILED, ex))
+      publish(_SEGMENT_DONE)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+      for segment in range(total_segments):
+        executor.submit(metrics.propagate(scan_segment), segment)
+
+      remaining = total_segments
+      while remaining:
+        entry = pages.get()
+        if entry is _SEGMENT_DONE:
+          remaining -= 1
+          continue
+        if isinstance(entry, tuple) and entry[0] is _SEGMENT_FAILED:
+          raise entry[1]
+        for item in entry:
+          yield deserialize_item(item) if deserialize else item
+    finally:
+      # also reached when the consumer stops iterating early
+      stop.set()
+      executor.shutdown(wait=True)
+
+  def get_items_by_status(self, done, limit=None, cursor=None, projection=None):
+    ''' Get one page of items by done status from the status index '''
+    self.log.debug('get_items_by_status', done=done, limit=limit, cursor=cursor,
+                   projection=projection)
+    index_name = self.kwargs['DYNAMODB_STATUS_INDEX_NAME']
+    if self.metadata.index_active(index_name):
+      result = self._page(self._table.query, limit=limit, cursor=cursor,
+                          projection=projection, cursor_keys=STATUS_CURSOR_KEYS,
+                          IndexName=index_name,
+                          KeyConditionExpression=Key('task_status').eq(task_status(done)))
+    else:
+      # the index is missing or still building, fall back to the filtered scan
+      result = self._page(self._table.scan, limit=limit, cursor=cursor, projection=projection,
+                          FilterExpression=Attr('done').eq(done))
+    self._log_result('get_items_by_status', result, index_name=index_name)
     return result
 
+  def iter_items(self, page_size=None):
+    ''' Yield all items, fetching them one page at a time '''
+    for page in self._iter_pages(self._table.scan, page_size=page_size,
+                                 FilterExpression=TASKS_ONLY):
+      for item in page.get('Items', []):
+        yield item
+
   def delete_item(self, item_id):
     ''' Delete item by id '''
-    self.log.debug(func_name(), item_id=item_id)
-    result = self._table.delete_item(Key={'id': item_id})
-    self.log.info(func_name(), result=result)
+    self.log.debug('delete_item', item_id=item_id)
+    if is_counter_id(item_id):
+      return {}
+    # the old item says which count the delete takes one off, without a read before it
+    result = self._table.delete_item(Key={'id': item_id}, ReturnValues='ALL_OLD')
+    self._bump_version(status_deltas(result.pop('Attributes', None), None))
+    self._log_result('delete_item', result)
     return result
 
+  def _batch_write(self, requests):
+    ''' Send one BatchWriteItem call, retrying unprocessed requests with backoff '''
+    table_name = self.kwargs['DYNAMODB_TABLE_NAME']
+    pending = requests
+    attempt = 0
+
+    while pending:
+      response = self.client.batch_write_item(RequestItems={table_name: pending})
+      pending = response.get('UnprocessedItems', {}).get(table_name, [])
+      if not pending or attempt >= self.kwargs['DYNAMODB_BATCH_MAX_RETRIES']:
+        break
+      time.sleep(backoff_delay(attempt))
+      attempt += 1
+
+    # whatever is still pending gave up after the last retry
+    return pending
+
+  def _iter_key_batches(self):
+    ''' Yield batches of serialized primary keys with their status from a parallel scan '''
+    batch = []
+    for key in self.parallel_scan(projection=['id', 'task_status'], deserialize=False):
+      batch.append(key)
+      if len(batch) == BATCH_WRITE_SIZE:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+
   def delete_all_items(self):
-    ''' Delete all items '''
-    self.log.debug('delete_all_items')
+    ''' Delete all items with keys-only scans and parallel batch deletes '''
+    log_msg = 'delete_all_items'
+    self.log.debug(log_msg, status='started')
 
-    if self._table_exists():
-      result = self._table.scan()
-      for item in result['Items']:
-        self.log.debug('deleting_item', item_id=item['id'])
-        self.delete_item(item['id'])
+    start = time.time()
+    counts = {'deleted': 0, 'unprocessed': 0}
+    deltas = {}
+    workers = self.kwargs['DYNAMODB_BATCH_WORKERS']
+
+    def delete_batch(keys):
+      return keys, self._batch_write(delete_requests(keys))
+
+    def collect(futures):
+      for future in futures:
+        tally_deleted(counts, deltas, *future.result())
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    in_flight = set()
+    try:
+      for keys in self._iter_key_batches():
+        # keep a bounded number of batches queued so memory stays flat
+        if len(in_flight) >= workers * 2:
+          done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+          collect(done)
+        in_flight.add(executor.submit(metrics.propagate(delete_batch), keys))
+      collect(wait(in_flight)[0])
+    except self.client.exceptions.ResourceNotFoundException:
+      self.log.info(log_msg, status='table_not_found')
+    finally:
+      executor.shutdown(wait=True)
+
+    if counts['deleted']:
+      self._bump_version(deltas)
+
+    result = {
+      'deleted_count': counts['deleted'],
+      'unprocessed_count': counts['unprocessed'],
+      'elapsed_seconds': round(time.time() - start, 3),
+    }
+    self.log.info(log_msg, status='done', **result)
+    return result
 
   def update_item(self, item_id, updated_attrs):
     ''' Update item attrs '''
-    self.log.debug(func_name(), item_id=item_id, updated_attrs=updated_attrs)
-
-    item = self.get_item_by_id(item_id)
-    if 'Item' not in item:
-      err = 'Did not find task'
-      self.log.debug(err, item_id=item_id)
-      raise ModelsException(err)
-
-    for attr in ['title', 'done']:
-      if attr not in updated_attrs:
-        updated_attrs[attr] = item['Item'][attr]
-
-    timestamp = int(time.time())
-
-    result = self._table.update_item(
-              Key={
-                'id': item_id
-              },
-              ExpressionAttributeValues={
-                ':title': updated_attrs['title'],
-                ':done': updated_attrs['done'],
-                ':updatedat': timestamp,
-              },
-              UpdateExpression='SET title = :title, '
-                               'done = :done, '
-                               'updatedat = :updatedat',
-              ReturnValues='UPDATED_NEW',
-            )
-    self.log.info(func_name(), result=result)
+    self.log.debug('update_item', item_id=item_id, updated_attrs=updated_attrs)
+    kwargs, set_attrs, remove_attrs = update_item_args(item_id, updated_attrs)
+
+    try:
+      result = self._table.update_item(Key={'id': item_id}, **kwargs)
+    except ClientError as ex:
+      err = missing_task(ex)
+      self.log.debug(str(err), item_id=item_id)
+      raise err
+
+    self._bump_version(updated_item_deltas(result, kwargs, set_attrs, remove_attrs))
+
+    self._log_result('update_item', result)
     return result
@@ -0,0 +1,175 @@
+''' Tasks kept in process memory '''
+
+import bisect
+import copy
+import threading
+
+from sampletodo.models.base import ModelsException, STATUS_DONE, STATUS_PENDING, \
+  TasksBackend, decode_cursor, encode_cursor, prefix_upper_bound, project, \
+  projection_with_id, task_status, title_search_key, update_attrs
+
+class MemoryTasksTable(TasksBackend):
+  ''' Store the todo data in a dict, with sorted indexes shaped like the DynamoDB ones
+
+  Nothing is shared between processes or kept across restarts, meant for
+  tests and throwaway local runs. Reads return copies, so callers can not
+  change stored items behind the lock's back.
+  '''
+
+  name = 'memory'
+
+  def __init__(self, **kwargs):
+    self.kwargs = kwargs
+    self._lock = threading.RLock()
+    self._clear()
+
+  def _index(self, item):
+    ''' Add an item to the sorted key lists, caller holds the lock '''
+    bisect.insort(self._ids, (item['id'],))
+    bisect.insort(self._by_status[item['task_status']], (item['createdat'], item['id']))
+    if 'title_key' in item:
+      bisect.insort(self._by_title, (item['title_key'], item['id']))
+
+  def _unindex(self, item):
+    ''' Remove an item from the sorted key lists, caller holds the lock '''
+    def remove(keys, key):
+      del keys[bisect.bisect_left(keys, key)]
+
+    remove(self._ids, (item['id'],))
+    remove(self._by_status[item['task_status']], (item['createdat'], item['id']))
+    if 'title_key' in item:
+      remove(self._by_title, (item['title_key'], item['id']))
+
+  def _get(self, item_id):
+    with self._lock:
+      item = self._items.get(item_id)
+      return copy.deepcopy(item) if item is not None else None
+
+  def _insert(self, item):
+    item = copy.deepcopy(item)
+    with self._lock:
+      if item['id'] in self._items:
+        self._unindex(self._items[item['id']])
+      self._items[item['id']] = item
+      self._index(item)
+
+  def _delete(self, item_id):
+    with self._lock:
+      item = self._items.pop(item_id, None)
+      if item is not None:
+        self._unindex(item)
+      return item is not None
+
+  def _clear(self):
+    with self._lock:
+      count = len(getattr(self, '_items', {}))
+      self._items = {}
+      # sorted keys: (id,), (createdat, id) per status and (title_key, id)
+      self._ids = []
+      self._by_status = {STATUS_PENDING: [], STATUS_DONE: []}
+      self._by_title = []
+      return count
+
+  def _page(self, keys, start, limit, cursor_key, end=None, projection=None):
+    ''' One page of items from a sorted key list, every key ends with the item id '''
+    projection = projection_with_id(projection)
+    result = {}
+    with self._lock:
+      position = bisect.bisect_right(keys, start) if start is not None else 0
+      stop = bisect.bisect_left(keys, end) if end is not None else len(keys)
+      page_keys = keys[position:min(stop, position + limit) if limit else stop]
+      items = [self._items[key[-1]] for key in page_keys]
+      if page_keys and position + len(page_keys) < stop:
+        # from the whole item, the projection may leave out the key attributes
+        result['LastEvaluatedKey'] = cursor_key(items[-1])
+        result['NextCursor'] = encode_cursor(result['LastEvaluatedKey'])
+      # projected before copying, unwanted attributes are never copied
+      result['Items'] = [copy.deepcopy(project(item, projection)) for item in items]
+
+    result['Count'] = len(result['Items'])
+    return result
+
+  def list_items(self, limit=None, cursor=None, projection=None):
+    ''' Get one page of items in id order '''
+    start = None
+    if cursor:
+      start = (self._cursor_field(cursor, 'id'),)
+    return self._page(self._ids, start, limit, lambda item: {'id': item['id']},
+                      projection=projection)
+
+  def get_items_by_status(self, done, limit=None, cursor=None, projection=None):
+    ''' Get one page of items by done status, oldest first '''
+    start = None
+    if cursor:
+      start = (self._cursor_field(cursor, 'createdat'), self._cursor_field(cursor, 'id'))
+    return self._page(self._by_status[task_status(done)], start, limit,
+                      lambda item: {'id': item['id'], 'task_status': item['task_status'],
+                                    'createdat': item['createdat']},
+                      projection=projection)
+
+  def get_item_by_title(self, title, limit=None, cursor=None, projection=None):
+    ''' Get one page of items whose title starts with title '''
+    title_key = title_search_key(title)
+    start = (title_key,)
+    if cursor:
+      start = (self._cursor_field(cursor, 'title_key'), self._cursor_field(cursor, 'id'))
+    return self._page(self._by_title, start, limit,
+                      lambda item: {'id': item['id'], 'title_prefix': item['title_prefix'],
+                                    'title_key': item['title_key']},
+                      end=(prefix_upper_bound(title_key),), projection=projection)
+
+  def _cursor_field(self, cursor, field):
+    ''' A key attribute from a cursor '''
+    key = decode_cursor(cursor)
+    if field not in key:
+      raise ModelsException('Invalid cursor')
+    return key[field]
+
+  def update_item(self, item_id, updated_attrs):
+    ''' Update item attrs '''
+    set_attrs, remove_attrs = update_attrs(updated_attrs)
+    with self._lock:
+      item = self._items.get(item_id)
+      if item is None:
+        raise ModelsException('Did not find task')
+
+      self._unindex(item)
+      item = dict(item, **copy.deepcopy(set_attrs))
+      for attr in remove_attrs:
+        item.pop(attr, None)
+      self._items[item_id] = item
+      self._index(item)
+      self._bump_version()
+      return {'Attributes': copy.deepcopy(item)}
+
+  def task_counts(self):
+    ''' The status index sizes, they are always current '''
+    with self._lock:
+      return dict((status, len(keys)) for status, keys in self._by_status.items())
+
+  def reconcile_counts(self):
+    ''' Nothing to reconcile, the counts come from the indexes '''
+    counts = self.task_counts()
+    return {'before': counts, 'after': counts}
+
+  def table_info(self):
+    ''' Item and index sizes, with the index names the DynamoDB table uses '''
+    with self._lock:
+      return {
+        'name': self.name,
+        'backend': self.name,
+        'exists': True,
+        'status': 'ACTIVE',
+        'item_count': len(self._items),
+        'key_schema': {'id': 'HASH'},
+        'indexes': {
+          self.kwargs.get('DYNAMODB_STATUS_INDEX_NAME', 'status'): {
+            'status': 'ACTIVE',
+            'item_count': sum(len(keys) for keys in self._by_status.values()),
+          },
+          self.kwargs.get('DYNAMODB_TITLE_INDEX_NAME', 'title'): {
+            'status': 'ACTIVE',
+            'item_count': len(self._by_title),
+          },
+        },
+      }
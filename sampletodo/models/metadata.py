@@ -0,0 +1,124 @@
+''' Cached DynamoDB table metadata '''
+
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+def index_active(description, index_name):
+  ''' Whether a table description has an index that can serve queries '''
+  for index in (description or {}).get('GlobalSecondaryIndexes', []):
+    if index['IndexName'] == index_name:
+      return index.get('IndexStatus') == 'ACTIVE' and not index.get('Backfilling', False)
+  return False
+
+class TableMetadata(object):
+  ''' describe_table results cached for refresh_interval seconds
+
+  Existence checks, index routing, capacity reporting and health checks read
+  from here instead of making control plane calls on the request path. Once
+  a description is cached, a stale entry is refreshed by one caller while
+  the others keep using the stale copy.
+  '''
+
+  def __init__(self, client_getter, table_name, refresh_interval=60, clock=time.time):
+    self._client_getter = client_getter
+    self.table_name = table_name
+    self.refresh_interval = refresh_interval
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._description = None
+    self._fetched_at = None
+
+  def refresh(self, client=None):
+    ''' Describe the table now, returns the description or None if it does not exist '''
+    client = client or self._client_getter()
+    try:
+      description = client.describe_table(TableName=self.table_name)['Table']
+    except ClientError as ex:
+      if ex.response['Error']['Code'] != 'ResourceNotFoundException':
+        raise
+      description = None
+
+    self._description = description
+    self._fetched_at = self._clock()
+    return description
+
+  def get(self):
+    ''' Cached table description, None if the table does not exist '''
+    fetched_at = self._fetched_at
+    if fetched_at is not None and self._clock() - fetched_at < self.refresh_interval:
+      return self._description
+
+    if fetched_at is not None and not self._lock.acquire(False):
+      # somebody else is refreshing, the stale copy is good enough meanwhile
+      return self._description
+    if fetched_at is None:
+      self._lock.acquire()
+
+    try:
+      if self._fetched_at == fetched_at:
+        self.refresh()
+      return self._description
+    finally:
+      self._lock.release()
+
+  def invalidate(self):
+    ''' Force the next read to describe the table again '''
+    self._fetched_at = None
+
+  def exists(self):
+    ''' Whether the table exists '''
+    return self.get() is not None
+
+  def status(self):
+    ''' Table status, None if the table does not exist '''
+    description = self.get()
+    return description['TableStatus'] if description else None
+
+  def key_schema(self):
+    ''' Table key schema as {attribute: key type} '''
+    description = self.get() or {}
+    return dict((key['AttributeName'], key['KeyType'])
+                for key in description.get('KeySchema', []))
+
+  def indexes(self):
+    ''' Global secondary indexes by name '''
+    description = self.get() or {}
+    return dict((index['IndexName'], index)
+                for index in description.get('GlobalSecondaryIndexes', []))
+
+  def index_active(self, index_name):
+    ''' Whether an index exists and can serve queries '''
+    return index_active(self.get(), index_name)
+
+  def summary(self):
+    ''' Table status, size, capacity and indexes for reporting '''
+    description = self.get()
+    if description is None:
+      return {'name': self.table_name, 'exists': False}
+
+    def capacity(entry):
+      throughput = entry.get('ProvisionedThroughput', {})
+      return {
+        'read_capacity_units': throughput.get('ReadCapacityUnits'),
+        'write_capacity_units': throughput.get('WriteCapacityUnits'),
+      }
+
+    summary = {
+      'name': self.table_name,
+      'exists': True,
+      'status': description.get('TableStatus'),
+      'item_count': description.get('ItemCount'),
+      'size_bytes': description.get('TableSizeBytes'),
+      'billing_mode': description.get('BillingModeSummary', {}).get('BillingMode', 'PROVISIONED'),
+      'key_schema': self.key_schema(),
+      'indexes': {},
+      'metadata_age_seconds': round(self._clock() - self._fetched_at, 3),
+    }
+    summary.update(capacity(description))
+    for name, index in self.indexes().items():
+      summary['indexes'][name] = dict(capacity(index),
+                                      status=index.get('IndexStatus'),
+                                      item_count=index.get('ItemCount'))
+    return summary
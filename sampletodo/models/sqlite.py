@@ -0,0 +1,253 @@
+''' Tasks in a local SQLite database '''
+
+import json
+import sqlite3
+import threading
+
+from sampletodo.models.base import ModelsException, STATUS_DONE, STATUS_PENDING, \
+  TasksBackend, decode_cursor, encode_cursor, prefix_upper_bound, project, \
+  projection_with_id, task_status, title_search_key, update_attrs
+import sampletodo.common.utils as utils
+
+SCHEMA = [
+  '''CREATE TABLE IF NOT EXISTS tasks (
+       id TEXT PRIMARY KEY,
+       task_status TEXT NOT NULL,
+       createdat INTEGER NOT NULL,
+       title_key TEXT,
+       item TEXT NOT NULL
+     )''',
+  # the same access paths as the DynamoDB status and title indexes
+  'CREATE INDEX IF NOT EXISTS tasks_status ON tasks (task_status, createdat, id)',
+  'CREATE INDEX IF NOT EXISTS tasks_title ON tasks (title_key, id)',
+  # the change version every worker process sees, see TasksBackend.change_version
+  'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+  "INSERT OR IGNORE INTO meta (key, value) VALUES ('change_version', 0)",
+  # task counts per status, kept by triggers in the transaction of every write
+  "INSERT OR IGNORE INTO meta (key, value) "
+  "SELECT 'pending_count', COUNT(*) FROM tasks WHERE task_status = 'pending'",
+  "INSERT OR IGNORE INTO meta (key, value) "
+  "SELECT 'done_count', COUNT(*) FROM tasks WHERE task_status = 'done'",
+  '''CREATE TRIGGER IF NOT EXISTS tasks_count_insert AFTER INSERT ON tasks BEGIN
+       UPDATE meta SET value = value + 1 WHERE key = NEW.task_status || '_count';
+     END''',
+  '''CREATE TRIGGER IF NOT EXISTS tasks_count_delete AFTER DELETE ON tasks BEGIN
+       UPDATE meta SET value = value - 1 WHERE key = OLD.task_status || '_count';
+     END''',
+  '''CREATE TRIGGER IF NOT EXISTS tasks_count_update AFTER UPDATE OF task_status ON tasks
+     WHEN OLD.task_status <> NEW.task_status BEGIN
+       UPDATE meta SET value = value - 1 WHERE key = OLD.task_status || '_count';
+       UPDATE meta SET value = value + 1 WHERE key = NEW.task_status || '_count';
+     END''',
+]
+
+def _row(item):
+  ''' Column values for an item '''
+  return (item['id'], item['task_status'], item['createdat'], item.get('title_key'),
+          utils.dumps_json(item))
+
+class SqliteTasksTable(TasksBackend):
+  ''' Store the todo data in a SQLite file, for single node deployments
+
+  Items are stored as JSON next to the columns the indexes need. Every
+  thread gets its own connection, WAL mode lets readers run alongside the
+  single writer, including readers in other worker processes.
+  '''
+
+  name = 'sqlite'
+
+  def __init__(self, **kwargs):
+    self.kwargs = kwargs
+    self.path = kwargs['SQLITE_PATH']
+    self._local = threading.local()
+    # bumped by refresh_aws_connection, threads reopen their connection when it changes
+    self._generation = 0
+    self.provision_table()
+
+  def _connection(self):
+    ''' SQLite connection owned by the calling thread '''
+    if getattr(self._local, 'generation', None) != self._generation:
+      if getattr(self._local, 'connection', None) is not None:
+        self._local.connection.close()
+      # autocommit, transactions are started explicitly where they are needed
+      connection = sqlite3.connect(self.path, timeout=self.kwargs['SQLITE_TIMEOUT'],
+                                   isolation_level=None)
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('PRAGMA synchronous=NORMAL')
+      # INSERT OR REPLACE only fires the delete trigger of the replaced row with this
+      connection.execute('PRAGMA recursive_triggers=ON')
+      self._local.connection = connection
+      self._local.generation = self._generation
+    return self._local.connection
+
+  def _execute(self, sql, params=()):
+    return self._connection().execute(sql, params)
+
+  def refresh_aws_connection(self):
+    ''' Reopen the database connections '''
+    self._generation += 1
+
+  def provision_table(self):
+    ''' Create the table and its indexes unless they already exist '''
+    exists = self._execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tasks'"
+                          ).fetchone() is not None
+    for statement in SCHEMA:
+      self._execute(statement)
+    return {'created': not exists}
+
+  def change_version(self):
+    ''' Counter bumped by every write, shared through the database file '''
+    return self._execute("SELECT value FROM meta WHERE key = 'change_version'").fetchone()[0]
+
+  def _bump_version(self):
+    self._execute("UPDATE meta SET value = value + 1 WHERE key = 'change_version'")
+
+  def task_counts(self):
+    ''' Task counts per status from the meta table '''
+    rows = self._execute("SELECT key, value FROM meta WHERE key IN ('pending_count', 'done_count')")
+    return dict((key[:-len('_count')], value) for key, value in rows)
+
+  def count_items(self):
+    ''' Task counts per status from the status index '''
+    counts = dict((status, 0) for status in (STATUS_PENDING, STATUS_DONE))
+    counts.update(self._execute('SELECT task_status, COUNT(*) FROM tasks GROUP BY task_status'))
+    return counts
+
+  def reconcile_counts(self):
+    ''' Recount in a write transaction, no write can slip in between '''
+    connection = self._connection()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+      before = self.task_counts()
+      after = self.count_items()
+      for status, count in after.items():
+        connection.execute('UPDATE meta SET value = ? WHERE key = ?', (count, '%s_count' % status))
+    except Exception:
+      connection.execute('ROLLBACK')
+      raise
+    connection.execute('COMMIT')
+    return {'before': before, 'after': after}
+
+  def _get(self, item_id):
+    row = self._execute('SELECT item FROM tasks WHERE id = ?', (item_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+  def _insert(self, item):
+    self._execute('INSERT OR REPLACE INTO tasks (id, task_status, createdat, title_key, item) '
+                  'VALUES (?, ?, ?, ?, ?)', _row(item))
+
+  def _delete(self, item_id):
+    return self._execute('DELETE FROM tasks WHERE id = ?', (item_id,)).rowcount > 0
+
+  def _clear(self):
+    return self._execute('DELETE FROM tasks').rowcount
+
+  def _page(self, where, params, order_by, limit, cursor_key, projection=None):
+    ''' One page of items, one row more than asked for tells whether there is another '''
+    sql = 'SELECT item FROM tasks WHERE %s ORDER BY %s' % (where or '1', order_by)
+    if limit:
+      sql += ' LIMIT %d' % (limit + 1)
+    items = [json.loads(row[0]) for row in self._execute(sql, params)]
+
+    result = {}
+    if limit and len(items) > limit:
+      items = items[:limit]
+      result['LastEvaluatedKey'] = cursor_key(items[-1])
+      result['NextCursor'] = encode_cursor(result['LastEvaluatedKey'])
+    projection = projection_with_id(projection)
+    result['Items'] = [project(item, projection) for item in items]
+    result['Count'] = len(items)
+    return result
+
+  def _cursor_fields(self, cursor, *fields):
+    ''' Key attributes from a cursor '''
+    key = decode_cursor(cursor)
+    if not all(field in key for field in fields):
+      raise ModelsException('Invalid cursor')
+    # numbers come back from the cursor as Decimal, which sqlite3 can not bind
+    return [int(key[field]) if field == 'createdat' else key[field] for field in fields]
+
+  def list_items(self, limit=None, cursor=None, projection=None):
+    ''' Get one page of items in id order '''
+    where, params = None, ()
+    if cursor:
+      where, params = 'id > ?', self._cursor_fields(cursor, 'id')
+    return self._page(where, params, 'id', limit, lambda item: {'id': item['id']},
+                      projection)
+
+  def get_items_by_status(self, done, limit=None, cursor=None, projection=None):
+    ''' Get one page of items by done status, oldest first '''
+    where = 'task_status = ?'
+    params = [task_status(done)]
+    if cursor:
+      createdat, item_id = self._cursor_fields(cursor, 'createdat', 'id')
+      where += ' AND (createdat > ? OR (createdat = ? AND id > ?))'
+      params += [createdat, createdat, item_id]
+    return self._page(where, params, 'createdat, id', limit,
+                      lambda item: {'id': item['id'], 'task_status': item['task_status'],
+                                    'createdat': item['createdat']},
+                      projection)
+
+  def get_item_by_title(self, title, limit=None, cursor=None, projection=None):
+    ''' Get one page of items whose title starts with title '''
+    title_key = title_search_key(title)
+    where = 'title_key >= ? AND title_key < ?'
+    params = [title_key, prefix_upper_bound(title_key)]
+    if cursor:
+      cursor_title_key, item_id = self._cursor_fields(cursor, 'title_key', 'id')
+      where += ' AND (title_key > ? OR (title_key = ? AND id > ?))'
+      params += [cursor_title_key, cursor_title_key, item_id]
+    return self._page(where, params, 'title_key, id', limit,
+                      lambda item: {'id': item['id'], 'title_prefix': item['title_prefix'],
+                                    'title_key': item['title_key']},
+                      projection)
+
+  def update_item(self, item_id, updated_attrs):
+    ''' Update item attrs in a write transaction '''
+    set_attrs, remove_attrs = update_attrs(updated_attrs)
+    connection = self._connection()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+      item = self._get(item_id)
+      if item is None:
+        raise ModelsException('Did not find task')
+
+      item.update(set_attrs)
+      for attr in remove_attrs:
+        item.pop(attr, None)
+      row = _row(item)
+      connection.execute('UPDATE tasks SET task_status = ?, createdat = ?, title_key = ?, item = ? '
+                         'WHERE id = ?', row[1:] + row[:1])
+      self._bump_version()
+    except Exception:
+      connection.execute('ROLLBACK')
+      raise
+    connection.execute('COMMIT')
+    return {'Attributes': item}
+
+  def table_info(self):
+    ''' Database size and indexes, with the index names the DynamoDB table uses '''
+    item_count = self._execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+    page_count = self._execute('PRAGMA page_count').fetchone()[0]
+    page_size = self._execute('PRAGMA page_size').fetchone()[0]
+    title_count = self._execute('SELECT COUNT(*) FROM tasks WHERE title_key IS NOT NULL'
+                               ).fetchone()[0]
+    return {
+      'name': self.path,
+      'backend': self.name,
+      'exists': True,
+      'status': 'ACTIVE',
+      'item_count': item_count,
+      'size_bytes': page_count * page_size,
+      'key_schema': {'id': 'HASH'},
+      'indexes': {
+        self.kwargs.get('DYNAMODB_STATUS_INDEX_NAME', 'tasks_status'): {
+          'status': 'ACTIVE',
+          'item_count': item_count,
+        },
+        self.kwargs.get('DYNAMODB_TITLE_INDEX_NAME', 'tasks_title'): {
+          'status': 'ACTIVE',
+          'item_count': title_count,
+        },
+      },
+    }
@@ -0,0 +1,379 @@
+''' Write-behind ingestion of new tasks
+
+WriteBehindTable answers put_item as soon as the stamped task is in a
+local journal file and an in-process queue. A background thread writes
+the queue to the wrapped backend with put_items, in batches of up to
+batch_size tasks or whatever arrived within flush_interval seconds.
+
+Every process appends to its own journal in the journal directory and
+holds an exclusive lock on it while it runs. A journal nobody holds a
+lock on belongs to a process that died, the next WriteBehindTable that
+starts takes over the tasks in it that were never written.
+'''
+
+import atexit
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import structlog
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+from sampletodo.version import __version__
+from sampletodo.models.base import ModelsException, new_item
+from sampletodo.models.dynamodb import backoff_delay
+import sampletodo.common.utils as utils
+
+STATUS_QUEUED = 'queued'
+STATUS_WRITTEN = 'written'
+STATUS_RETRYING = 'retrying'
+
+# tells the flusher to write what is queued and stop
+_CLOSE = object()
+
+# seconds an exiting process waits for the queue to be written, the journal keeps the rest
+CLOSE_TIMEOUT = 10
+# longest pause before a batch that used up its attempts is tried again
+RETRY_DELAY_CAP = 30
+
+class QueueFullException(ModelsException):
+  ''' The queue stayed full for the whole enqueue timeout '''
+
+class Journal(object):
+  ''' Append only log of accepted tasks and of the ones that were written
+
+  Lines are {"put": item} and {"written": [ids]}. The file is emptied
+  whenever every task in it has been written.
+  '''
+
+  def __init__(self, path, fsync=True):
+    self.path = path
+    self.fsync = fsync
+    self._lock = threading.Lock()
+    self._outstanding = 0
+    self._file = open(path, 'a')
+    # held until close, tells other processes this journal is not orphaned
+    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+  def _write(self, record):
+    self._file.write(json.dumps(record, sort_keys=True, default=utils.json_default) + '\n')
+    self._file.flush()
+
+  def append(self, item):
+    ''' Log an accepted task, on disk before the caller gets its answer '''
+    with self._lock:
+      self._write({'put': item})
+      self._outstanding += 1
+    if self.fsync:
+      # outside the lock, concurrent requests share the disk flushes
+      os.fsync(self._file.fileno())
+
+  def ack(self, item_ids):
+    ''' Log tasks that were written, a lost ack only means writing them again '''
+    with self._lock:
+      self._outstanding -= len(item_ids)
+      if self._outstanding == 0:
+        self._file.truncate(0)
+      else:
+        self._write({'written': item_ids})
+
+  def outstanding(self):
+    with self._lock:
+      return self._outstanding
+
+  def close(self, remove=False):
+    with self._lock:
+      if remove:
+        os.remove(self.path)
+      self._file.close()
+
+  @staticmethod
+  def pending(lines):
+    ''' Tasks of journal lines that were never acknowledged, in the order they came '''
+    items = OrderedDict()
+    for line in lines:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        # the last line of a process that died mid write
+        continue
+      if 'put' in record:
+        items[record['put']['id']] = record['put']
+      for item_id in record.get('written', []):
+        items.pop(item_id, None)
+    return list(items.values())
+
+def claim_orphans(directory, own_path):
+  ''' Tasks left behind in the journals of dead processes, the journals are removed
+
+  Each orphan is locked before it is read, two processes starting at once
+  can not both take over the same journal.
+  '''
+  items = []
+  paths = []
+  for path in sorted(glob.glob(os.path.join(directory, 'ingest-*.jsonl'))):
+    if path == own_path:
+      continue
+    try:
+      handle = open(path, 'r')
+    except IOError:
+      continue
+    try:
+      fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      # a running process owns it
+      handle.close()
+      continue
+    if os.fstat(handle.fileno()).st_nlink == 0:
+      # another process took it over and removed it before we got the lock
+      handle.close()
+      continue
+    items.extend(Journal.pending(handle))
+    paths.append((path, handle))
+  return items, paths
+
+def journaled(directory, item_id):
+  ''' True when a journal in directory holds item_id and it was not written yet '''
+  for path in glob.glob(os.path.join(directory, 'ingest-*.jsonl')):
+    try:
+      with open(path, 'r') as handle:
+        lines = handle.readlines()
+    except IOError:
+      # removed by its process or by a takeover meanwhile
+      continue
+    # most journals do not mention the id, those are not parsed
+    if any(item_id in line for line in lines) and \
+       any(item['id'] == item_id for item in Journal.pending(lines)):
+      return True
+  return False
+
+class WriteBehindTable(object):
+  ''' Storage backend wrapper that queues put_item and writes the queue in batches
+
+  put_item blocks for up to enqueue_timeout seconds while queue_size
+  tasks are waiting to be written and then raises QueueFullException.
+  A batch the backend keeps failing is tried max_attempts times, then
+  goes back on the queue after a pause that grows with every round that
+  fails in a row, up to RETRY_DELAY_CAP seconds. Its tasks keep their
+  queue slots meanwhile, so a long outage turns into 503s until the
+  backend is back and the queue drains.
+  Everything but put_item goes straight to the table, a queued task only
+  shows up in reads once it was written.
+  '''
+
+  def __init__(self, table, directory, queue_size=10000, batch_size=25, flush_interval=0.05,
+               enqueue_timeout=0.5, max_attempts=5, fsync=True, status_entries=100000):
+    self.table = table
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.enqueue_timeout = enqueue_timeout
+    self.max_attempts = max_attempts
+    self.status_entries = status_entries
+    self.directory = directory
+
+    logger = structlog.get_logger()
+    self.log = logger.new()
+    self.log = self.log.bind(build_version=__version__, component='write_behind')
+
+    self.queue_size = queue_size
+    # tasks accepted and not written yet, put_item waits on _space while there are queue_size
+    self._waiting = 0
+    self._space = threading.Condition()
+    self._queue = queue.Queue()
+    self._status_lock = threading.Lock()
+    # id -> status of recently accepted tasks, oldest first
+    self._statuses = OrderedDict()
+    self._counts = {'accepted': 0, 'rejected': 0, 'replayed': 0, STATUS_WRITTEN: 0,
+                    'retried': 0}
+    # rounds of max_attempts that failed in a row, for the pause before the next one
+    self._failed_rounds = 0
+    self._stop = threading.Event()
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    path = os.path.join(directory, 'ingest-%s-%s.jsonl' % (os.getpid(), uuid.uuid4().hex[:8]))
+    self.journal = Journal(path, fsync=fsync)
+
+    items, orphans = claim_orphans(directory, path)
+    # replayed tasks are not held back by the queue size, they were accepted already
+    self._waiting = len(items)
+    for item in items:
+      self.journal.append(item)
+      self._enqueue(item)
+    for orphan_path, handle in orphans:
+      os.remove(orphan_path)
+      handle.close()
+    self._counts['replayed'] = len(items)
+    if items:
+      self.log.info('replaying_journals', journals=len(orphans), items=len(items))
+
+    self._closed = False
+    self._thread = threading.Thread(target=self._run, name='write-behind-flusher')
+    self._thread.daemon = True
+    self._thread.start()
+    atexit.register(self.close, CLOSE_TIMEOUT)
+
+  def __getattr__(self, name):
+    return getattr(self.table, name)
+
+  def _set_status(self, item_ids, status):
+    with self._status_lock:
+      for item_id in item_ids:
+        self._statuses.pop(item_id, None)
+        self._statuses[item_id] = status
+      while len(self._statuses) > self.status_entries:
+        self._statuses.popitem(last=False)
+
+  def _count(self, outcome, count=1):
+    with self._status_lock:
+      self._counts[outcome] += count
+
+  def _take_slot(self):
+    ''' Wait up to enqueue_timeout for the queue to have room, False when it did not '''
+    deadline = time.time() + self.enqueue_timeout
+    with self._space:
+      while self._waiting >= self.queue_size:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self._space.wait(remaining)
+      self._waiting += 1
+      return True
+
+  def _free_slots(self, count):
+    with self._space:
+      self._waiting -= count
+      self._space.notify(count)
+
+  def _enqueue(self, item):
+    self._set_status([item['id']], STATUS_QUEUED)
+    self._queue.put(item)
+
+  def put_item(self, item):
+    ''' Stamp the item and queue it, returns the item the way put_item would have stored it '''
+    item = new_item(item)
+    if not self._take_slot():
+      self._count('rejected')
+      raise QueueFullException('Too many tasks waiting to be written, try again')
+
+    try:
+      self.journal.append(item)
+    except Exception:
+      self._free_slots(1)
+      raise
+    self._count('accepted')
+    self._enqueue(item)
+    return dict(item)
+
+  def ingest_status(self, item_id):
+    ''' queued, retrying or written for tasks this process accepted recently, None otherwise
+
+    Tasks other processes accepted are queued while they are in their
+    journals, the workers of a host share the journal directory.
+    '''
+    with self._status_lock:
+      status = self._statuses.get(item_id)
+    if status is None and journaled(self.directory, item_id):
+      status = STATUS_QUEUED
+    return status
+
+  def ingest_stats(self):
+    ''' Queue depth and what happened to the accepted tasks '''
+    with self._status_lock:
+      stats = dict(self._counts)
+    stats.update(queued=self._waiting, queue_size=self.queue_size)
+    return stats
+
+  def _next_batch(self):
+    ''' Up to batch_size tasks, waiting at most flush_interval after the first one '''
+    item = self._queue.get()
+    if item is _CLOSE:
+      return None
+
+    batch = [item]
+    deadline = time.time() + self.flush_interval
+    while len(batch) < self.batch_size:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      try:
+        item = self._queue.get(timeout=remaining)
+      except queue.Empty:
+        break
+      if item is _CLOSE:
+        # write this batch first, the next call stops the flusher
+        self._queue.put(_CLOSE)
+        break
+      batch.append(item)
+    return batch
+
+  def _flush(self, batch):
+    ''' Write a batch, retrying what the table did not write, returns the tasks still pending '''
+    pending = batch
+    for attempt in range(self.max_attempts):
+      try:
+        unprocessed = set(self.table.put_items(pending))
+      except Exception as ex:
+        self.log.error('write_behind_flush_failed', items=len(pending), attempt=attempt,
+                       err=str(ex))
+        unprocessed = set(item['id'] for item in pending)
+
+      written = [item['id'] for item in pending if item['id'] not in unprocessed]
+      if written:
+        self.journal.ack(written)
+        self._set_status(written, STATUS_WRITTEN)
+        self._count(STATUS_WRITTEN, len(written))
+        self._free_slots(len(written))
+
+      pending = [item for item in pending if item['id'] in unprocessed]
+      if not pending:
+        return []
+      if attempt + 1 < self.max_attempts:
+        time.sleep(backoff_delay(attempt))
+    return pending
+
+  def _retry_later(self, items):
+    ''' Pause and put tasks back on the queue, they keep their slots and journal entries '''
+    item_ids = [item['id'] for item in items]
+    self._set_status(item_ids, STATUS_RETRYING)
+    self._count('retried', len(items))
+    self._failed_rounds += 1
+    delay = backoff_delay(self._failed_rounds, base=self.flush_interval, cap=RETRY_DELAY_CAP)
+    self.log.error('write_behind_retrying', items=len(items), rounds=self._failed_rounds,
+                   delay=round(delay, 3))
+    # close() cuts the pause short, whatever is left stays in the journal
+    self._stop.wait(delay)
+    for item in items:
+      self._queue.put(item)
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      if batch is None:
+        return
+      pending = self._flush(batch)
+      if pending:
+        self._retry_later(pending)
+      else:
+        self._failed_rounds = 0
+
+  def close(self, timeout=None):
+    ''' Write what is queued and stop the flusher, the journal is removed when it is empty '''
+    if self._closed:
+      return
+    self._closed = True
+    self._stop.set()
+    self._queue.put(_CLOSE)
+    self._thread.join(timeout)
+    outstanding = self.journal.outstanding()
+    self.journal.close(remove=not outstanding)
+    self.log.info('write_behind_closed', outstanding=outstanding)
@@ -1,14 +1,120 @@
 ''' Wrapper for running the todo api '''
 
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+
 def run():
-  ''' Run the todo api '''
+  ''' Run the todo api with the flask development server '''
   from sampletodo import app
   app.run(host=app.config['SAMPLETODO_HOST'], port=int(app.config['SAMPLETODO_PORT']),
           use_reloader=False, debug=app.config['SAMPLETODO_DEBUG'])
 
+def post_fork(_, worker):
+  ''' Connect each worker to DynamoDB right after fork, before it takes requests '''
+  from sampletodo import db
+  worker.log.info('initializing db in worker %s' % worker.pid)
+  db.get()
+
+def worker_exit(_, worker):
+  ''' Leave the final counts of an exiting worker for the others to report '''
+  import sampletodo.common.metrics as metrics
+  metrics.REGISTRY.flush()
+
+def metrics_dir(config):
+  ''' Directory the workers merge their metrics through, and whether it is ours to remove '''
+  import sampletodo.common.metrics as metrics
+  directory = config['SAMPLETODO_METRICS_DIR']
+  created = not directory
+  if created:
+    directory = tempfile.mkdtemp(prefix='sampletodo-metrics-')
+  else:
+    # counts left over from a previous master would be reported again
+    for filename in os.listdir(directory):
+      if filename.startswith('metrics-') or filename.startswith('.metrics-'):
+        os.remove(os.path.join(directory, filename))
+  metrics.REGISTRY.configure(directory, config['SAMPLETODO_METRICS_FLUSH_INTERVAL'])
+  return directory, created
+
+def server_options(config):
+  ''' gunicorn settings from the app config '''
+  workers = config['SAMPLETODO_WORKERS'] or multiprocessing.cpu_count()
+  threads = config['SAMPLETODO_THREADS']
+  return {
+    'bind': '%s:%s' % (config['SAMPLETODO_HOST'], config['SAMPLETODO_PORT']),
+    'workers': workers,
+    'threads': threads,
+    # plain sync workers can not use threads, gthread also keeps connections alive
+    'worker_class': 'gthread' if threads > 1 else 'sync',
+    'keepalive': config['SAMPLETODO_KEEPALIVE'],
+    'backlog': config['SAMPLETODO_BACKLOG'],
+    'timeout': config['SAMPLETODO_WORKER_TIMEOUT'],
+    'graceful_timeout': config['SAMPLETODO_GRACEFUL_TIMEOUT'],
+    # the app is imported once in the master, the DB connects per worker after fork
+    'preload_app': True,
+    'post_fork': post_fork,
+    'worker_exit': worker_exit,
+  }
+
+def run_production():
+  ''' Run the todo api with pre-forked gunicorn workers
+
+  Send HUP to the master process for a graceful reload: new workers (with
+  fresh DB connections) are started before the old ones finish their
+  requests and exit. Deploying new code is a USR2 (re-exec the master)
+  followed by QUIT to the old master once the new one is up.
+  '''
+  from gunicorn.app.base import BaseApplication
+  from sampletodo import app
+
+  directory, created = None, False
+  if app.config['SAMPLETODO_METRICS_ENABLED']:
+    directory, created = metrics_dir(app.config)
+  master_pid = os.getpid()
+
+  class Server(BaseApplication):
+    ''' gunicorn application serving the flask app '''
+    def load_config(self):
+      for key, value in server_options(app.config).items():
+        self.cfg.set(key, value)
+
+    def load(self):
+      return app
+
+  try:
+    Server().run()
+  finally:
+    # workers unwind through here as well when they exit
+    if created and os.getpid() == master_pid:
+      shutil.rmtree(directory, ignore_errors=True)
+
+def run_async():
+  ''' Run the todo api on an asyncio event loop with aiohttp, Python 3 only '''
+  from aiohttp import web
+  from sampletodo import app
+  from sampletodo.async_views import create_async_app
+
+  web.run_app(create_async_app(app.config), host=app.config['SAMPLETODO_HOST'],
+              port=int(app.config['SAMPLETODO_PORT']),
+              backlog=app.config['SAMPLETODO_BACKLOG'])
+
 def main():
   ''' Main function for the module '''
-  run()
+  parser = argparse.ArgumentParser(description='Run the sampletodo api')
+  parser.add_argument('--server', choices=['development', 'production', 'async'],
+                      help='server to run, defaults to SAMPLETODO_SERVER')
+  args = parser.parse_args()
+
+  from sampletodo import app
+  server = args.server or app.config['SAMPLETODO_SERVER']
+  if server == 'production':
+    run_production()
+  elif server == 'async':
+    run_async()
+  else:
+    run()
 
 if __name__ == '__main__':
   main()
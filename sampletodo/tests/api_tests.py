@@ -4,12 +4,16 @@ import os
 import base64
 import sys
 import json
+import zlib
 import inspect
+import threading
 import unittest
 
 os.environ['SAMPLETODO_CONFIG_ENV'] = 'TestLocalRunConfig'
 
-from sampletodo import app, auth
+from boto3.dynamodb.conditions import Attr
+
+from sampletodo import app, auth, db
 from sampletodo import views
 
 @auth.verify_password
@@ -34,6 +38,33 @@ class JustodoitTestCase(unittest.TestCase):
     response = self.client.open(url, method='GET')
     assert response.status_code == 200
 
+  def test_request_id_in_response(self):
+    ''' Test the request id is echoed in the body and headers '''
+    url = '/todo/api/v1.0/health'
+    response = self.client.open(url, method='GET', headers={'X-Request-Id': 'test-request-id'})
+    response_ds = json.loads(response.data)
+    assert response_ds['request_id'] == 'test-request-id'
+    assert response.headers['X-Request-Id'] == 'test-request-id'
+    assert response.headers['Content-Type'] == 'application/json'
+
+  def test_get_health_db(self):
+    ''' Test table health '''
+    url = '/todo/api/v1.0/health/db'
+    response = self.client.open(url, method='GET')
+    assert response.status_code == 200
+
+  def test_get_table_info(self):
+    ''' Test table metadata reporting '''
+    url = '/todo/api/v1.0/table'
+    response = self.client.open(url, method='GET')
+    response_ds = json.loads(response.data)
+
+    assert response.status_code == 200
+    assert response_ds['table']['exists'] == True
+    assert response_ds['table']['key_schema'] == {'id': 'HASH'}
+    assert app.config['DYNAMODB_STATUS_INDEX_NAME'] in response_ds['table']['indexes']
+    assert app.config['DYNAMODB_TITLE_INDEX_NAME'] in response_ds['table']['indexes']
+
   def test_get_build_version(self):
     ''' Test build_version '''
     url = '/todo/api/v1.0/build_version'
@@ -52,6 +83,22 @@ class JustodoitTestCase(unittest.TestCase):
     response = self._delete_all_tasks()
     assert response.status_code == 200
 
+  def test_delete_all_tasks_counts(self):
+    ''' Test deletion of all tasks reports what it deleted '''
+    func_name = inspect.stack()[0][3]
+    for idx in range(30):
+      self._create_task('function-%s-%s' % (func_name, idx))
+
+    response = self._delete_all_tasks()
+    response_ds = json.loads(response.data)
+
+    assert response.status_code == 200
+    assert response_ds['deleted_count'] == 30
+    assert response_ds['unprocessed_count'] == 0
+
+    response = self._get_all_tasks()
+    assert json.loads(response.data)['tasks'] == []
+
   def _get_all_tasks(self):
     ''' Test getting all tasks '''
     url = '/todo/api/v1.0/tasks'
@@ -64,6 +111,35 @@ class JustodoitTestCase(unittest.TestCase):
     response = self._get_all_tasks()
     assert response.status_code == 200
 
+  def test_get_all_tasks_paginated(self):
+    ''' Test walking all tasks with limit and cursor '''
+    func_name = inspect.stack()[0][3]
+    task_ids = set()
+    for idx in range(3):
+      response = self._create_task('function-%s-%s' % (func_name, idx))
+      task_ids.add(json.loads(response.data)['task']['id'])
+
+    seen_ids = set()
+    url = '/todo/api/v1.0/tasks?limit=2'
+    while True:
+      response = self.client.open(url, method='GET')
+      response_ds = json.loads(response.data)
+      assert response.status_code == 200
+      assert len(response_ds['tasks']) <= 2
+      seen_ids.update(task['id'] for task in response_ds['tasks'])
+      if not response_ds['next_cursor']:
+        break
+      url = '/todo/api/v1.0/tasks?limit=2&cursor=%s' % response_ds['next_cursor']
+
+    assert seen_ids == task_ids
+
+  def test_get_all_tasks_invalid_pagination(self):
+    ''' Test rejecting bad limit and cursor values '''
+    for query in ['limit=0', 'limit=abc', 'cursor=not-a-cursor']:
+      url = '/todo/api/v1.0/tasks?%s' % query
+      response = self.client.open(url, method='GET')
+      assert response.status_code == 400
+
   def _create_task(self, task_name):
     ''' Wrapper for task creation '''
     url = '/todo/api/v1.0/tasks'
@@ -106,6 +182,117 @@ class JustodoitTestCase(unittest.TestCase):
     assert response.status_code == 200
     assert response_ds['task']['id'] == task_id
 
+  @unittest.skipUnless(app.config['DYNAMODB_CACHE_ENABLED'],
+                       'DYNAMODB_CACHE_ENABLED=True runs the api tests through the item cache')
+  def test_get_task_by_id_cached(self):
+    ''' Test repeated lookups are served from the item cache '''
+    func_name = inspect.stack()[0][3]
+    response = self._create_task('function-%s' % func_name)
+    task_id = json.loads(response.data)['task']['id']
+
+    url = '/todo/api/v1.0/cache/stats'
+    hits = json.loads(self.client.open(url, method='GET').data)['hits']
+
+    self._get_task_by_id(task_id)
+    self._get_task_by_id(task_id)
+
+    response_ds = json.loads(self.client.open(url, method='GET').data)
+    assert response_ds['enabled'] == True
+    assert response_ds['hits'] == hits + 2
+
+    # updates refresh the cached copy
+    self._update_task_attr(task_id, 'title', 'updated')
+    response_ds = json.loads(self._get_task_by_id(task_id).data)
+    assert response_ds['task']['title'] == 'updated'
+
+    # deletes invalidate it
+    self.client.open('/todo/api/v1.0/tasks/%s' % task_id, method='DELETE')
+    response_ds = json.loads(self._get_task_by_id(task_id).data)
+    assert response_ds['task'] == {}
+
+  def test_conditional_get(self):
+    ''' Test ETags follow writes and a current If-None-Match gets an empty 304 '''
+    func_name = inspect.stack()[0][3]
+    task_id = json.loads(self._create_task('function-%s' % func_name).data)['task']['id']
+
+    for url in ['/todo/api/v1.0/tasks', '/todo/api/v1.0/tasks/status/pending',
+                '/todo/api/v1.0/tasks/%s' % task_id]:
+      response = self.client.open(url, method='GET')
+      etag = response.headers['ETag']
+      assert etag.startswith('W/"v')
+      assert response.headers['Cache-Control'] == 'no-cache'
+
+      response = self.client.open(url, method='GET', headers={'If-None-Match': etag})
+      assert response.status_code == 304
+      assert response.data == b''
+      assert response.headers['ETag'] == etag
+
+    self._update_task_attr(task_id, 'done', True)
+    response = self.client.open('/todo/api/v1.0/tasks', method='GET',
+                                headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert json.loads(response.data)['tasks'][0]['done'] == True
+
+  def test_compressed_list(self):
+    ''' Test task lists are gzip encoded for clients that accept it, small bodies are not '''
+    func_name = inspect.stack()[0][3]
+    creates = [{'title': 'function-%s-%s' % (func_name, idx)} for idx in range(30)]
+    self.client.open('/todo/api/v1.0/tasks/batch', method='POST',
+                     data=json.dumps({'create': creates}), headers=self.content_type_header)
+
+    url = '/todo/api/v1.0/tasks'
+    plain = self.client.open(url, method='GET')
+    response = self.client.open(url, method='GET', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert int(response.headers['Content-Length']) < len(plain.data)
+    assert json.loads(zlib.decompress(response.data, 16 + zlib.MAX_WBITS))['tasks'] == \
+           json.loads(plain.data)['tasks']
+
+    response = self.client.open('/todo/api/v1.0/health', method='GET',
+                                headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert json.loads(response.data)['status'] == 'good'
+
+  def test_sparse_fieldsets(self):
+    ''' Test fields limits the returned attributes and is validated '''
+    func_name = inspect.stack()[0][3]
+    task_id = json.loads(self._create_task('function-%s' % func_name).data)['task']['id']
+
+    url = '/todo/api/v1.0/tasks/%s?fields=title,done' % task_id
+    response_ds = json.loads(self.client.open(url, method='GET').data)
+    assert response_ds['task'] == {'id': task_id, 'title': 'function-%s' % func_name,
+                                   'done': False}
+
+    for url in ['/todo/api/v1.0/tasks?fields=title',
+                '/todo/api/v1.0/tasks/status/pending?fields=title',
+                '/todo/api/v1.0/tasks/search?title=function-%s&fields=title' % func_name]:
+      response_ds = json.loads(self.client.open(url, method='GET').data)
+      assert response_ds['tasks']
+      assert all(sorted(task) == ['id', 'title'] for task in response_ds['tasks'])
+
+    for fields in ['', 'title,,done', 'a b', ','.join('f%s' % idx for idx in range(51))]:
+      response = self.client.open('/todo/api/v1.0/tasks?fields=%s' % fields, method='GET')
+      assert response.status_code == 400
+
+  def test_task_stats(self):
+    ''' Test the stats follow done transitions and carry an ETag '''
+    url = '/todo/api/v1.0/tasks/stats'
+    before = json.loads(self.client.open(url, method='GET').data)['stats']
+
+    func_name = inspect.stack()[0][3]
+    task_id = json.loads(self._create_task('function-%s' % func_name).data)['task']['id']
+    self._update_task_attr(task_id, 'done', True)
+
+    response = self.client.open(url, method='GET')
+    stats = json.loads(response.data)['stats']
+    assert stats['done'] == before['done'] + 1
+    assert stats['pending'] == before['pending']
+    assert stats['total'] == stats['pending'] + stats['done']
+    assert self.client.open(url, method='GET',
+                            headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
   def _update_task_attr(self, task_id, attr_name, attr_value):
     ''' Wrapper for updating task attribute '''
     url = '/todo/api/v1.0/tasks/%s' % task_id
@@ -133,6 +320,28 @@ class JustodoitTestCase(unittest.TestCase):
     assert response.status_code == 200
     assert response_ds['task']['title'] == updated_task_title
 
+  def test_update_task_keeps_other_attrs(self):
+    ''' Test partial updates leave the other attributes alone '''
+    func_name = inspect.stack()[0][3]
+    task_name = 'function-%s' % func_name
+    response = self._create_task(task_name)
+    task_id = json.loads(response.data)['task']['id']
+
+    response = self._update_task_attr(task_id, 'done', True)
+    response_ds = json.loads(response.data)
+
+    assert response.status_code == 200
+    assert response_ds['task']['done'] == True
+    assert response_ds['task']['title'] == task_name
+
+  def test_update_missing_task(self):
+    ''' Test updating a task that does not exist '''
+    response = self._update_task_attr('does-not-exist', 'title', 'updated')
+    response_ds = json.loads(response.data)
+
+    assert response.status_code == 400
+    assert response_ds['text'] == 'Did not find task'
+
   def test_update_task_status(self):
     ''' Test updating task title '''
     # create task_1
@@ -166,7 +375,7 @@ class JustodoitTestCase(unittest.TestCase):
     response_ds = json.loads(response.data)
 
     assert response.status_code == 200
-    assert len(response_ds) == 1
+    assert len(response_ds['tasks']) == 1
     assert response_ds['tasks'][0]['title'] == task_2_name
 
     # get all done tasks
@@ -175,9 +384,160 @@ class JustodoitTestCase(unittest.TestCase):
     response_ds = json.loads(response.data)
 
     assert response.status_code == 200
-    assert len(response_ds) == 1
+    assert len(response_ds['tasks']) == 1
     assert response_ds['tasks'][0]['title'] == task_1_name
 
+  def test_search_tasks_by_title(self):
+    ''' Test title prefix search '''
+    func_name = inspect.stack()[0][3]
+    for title in ['Read a book %s' % func_name,
+                  'read another book %s' % func_name,
+                  'Write a book %s' % func_name]:
+      self._create_task(title)
+
+    url = '/todo/api/v1.0/tasks/search?title=READ'
+    response = self.client.open(url, method='GET')
+    response_ds = json.loads(response.data)
+
+    assert response.status_code == 200
+    assert len(response_ds['tasks']) == 2
+    assert all(task['title'].lower().startswith('read') for task in response_ds['tasks'])
+
+    # prefixes shorter than the index bucket are rejected
+    url = '/todo/api/v1.0/tasks/search?title=re'
+    response = self.client.open(url, method='GET')
+    assert response.status_code == 400
+
+  def test_parallel_scan(self):
+    ''' Test segmented scans return every task exactly once '''
+    func_name = inspect.stack()[0][3]
+    task_ids = []
+    for idx in range(10):
+      response = self._create_task('function-%s-%s' % (func_name, idx))
+      task_ids.append(json.loads(response.data)['task']['id'])
+
+    items = list(db.parallel_scan(total_segments=3, max_workers=2))
+    assert sorted(item['id'] for item in items) == sorted(task_ids)
+
+    # projection and filter expressions are applied per segment
+    self._update_task_attr(task_ids[0], 'done', True)
+    items = list(db.parallel_scan(projection=['id', 'done'],
+                                  filter_expression=Attr('done').eq(True)))
+    assert items == [{'id': task_ids[0], 'done': True}]
+
+  def test_batch_tasks(self):
+    ''' Test bulk creation and deletion '''
+    func_name = inspect.stack()[0][3]
+    response = self._create_task('function-%s-existing' % func_name)
+    existing_id = json.loads(response.data)['task']['id']
+
+    url = '/todo/api/v1.0/tasks/batch'
+    creates = [{'title': 'function-%s-%s' % (func_name, idx)} for idx in range(30)]
+    creates.append({'not_a_title': True})
+    data = json.dumps({'create': creates, 'delete': [existing_id, existing_id]})
+    response = self.client.open(url, method='POST', data=data,
+                                headers=self.content_type_header)
+    response_ds = json.loads(response.data)
+
+    assert response.status_code == 200
+    statuses = [result['status'] for result in response_ds['created']]
+    assert statuses == ['created'] * 30 + ['failed']
+    assert response_ds['created'][-1]['error'] == 'Title not provided'
+    assert [result['status'] for result in response_ds['deleted']] == ['deleted', 'deleted']
+    created_id = response_ds['created'][0]['task']['id']
+
+    response_ds = json.loads(self._get_task_by_id(existing_id).data)
+    assert response_ds['task'] == {}
+
+    response_ds = json.loads(self._get_task_by_id(created_id).data)
+    assert response_ds['task']['title'] == 'function-%s-0' % func_name
+
+  def test_lookup_tasks(self):
+    ''' Test fetching many tasks by id '''
+    func_name = inspect.stack()[0][3]
+    task_ids = []
+    for idx in range(3):
+      response = self._create_task('function-%s-%s' % (func_name, idx))
+      task_ids.append(json.loads(response.data)['task']['id'])
+
+    url = '/todo/api/v1.0/tasks/lookup'
+    ids = [task_ids[2], 'does-not-exist', task_ids[0], task_ids[2]]
+    data = json.dumps({'ids': ids, 'fields': ['title']})
+    response = self.client.open(url, method='POST', data=data,
+                                headers=self.content_type_header)
+    response_ds = json.loads(response.data)
+
+    assert response.status_code == 200
+    assert [task['id'] for task in response_ds['tasks']] == [task_ids[2], task_ids[0]]
+    assert sorted(response_ds['tasks'][0].keys()) == ['id', 'title']
+    assert response_ds['missing'] == ['does-not-exist']
+    assert response_ds['unprocessed'] == []
+
+    data = json.dumps({'ids': 'not-a-list'})
+    response = self.client.open(url, method='POST', data=data,
+                                headers=self.content_type_header)
+    assert response.status_code == 400
+
+    # checked like the fields query parameter
+    for fields in [['a b'], ['f%s' % idx for idx in range(51)]]:
+      data = json.dumps({'ids': task_ids, 'fields': fields})
+      response = self.client.open(url, method='POST', data=data,
+                                  headers=self.content_type_header)
+      assert response.status_code == 400
+
+  def test_lookup_change_version_item(self):
+    ''' Test the change version item is not served as a task '''
+    url = '/todo/api/v1.0/tasks/lookup'
+    data = json.dumps({'ids': ['#change_version', '#change_version#1']})
+    response = self.client.open(url, method='POST', data=data,
+                                headers=self.content_type_header)
+    response_ds = json.loads(response.data)
+    assert response_ds['tasks'] == []
+    assert response_ds['missing'] == ['#change_version', '#change_version#1']
+
+  def test_batch_delete_change_version_item(self):
+    ''' Test the change version item can not be deleted in bulk '''
+    self._create_task('function-%s' % inspect.stack()[0][3])
+    stats = json.loads(self.client.open('/todo/api/v1.0/tasks/stats', method='GET').data)['stats']
+    etag = self.client.open('/todo/api/v1.0/tasks', method='GET').headers['ETag']
+
+    data = json.dumps({'delete': ['#change_version', '#change_version#1']})
+    response = self.client.open('/todo/api/v1.0/tasks/batch', method='POST', data=data,
+                                headers=self.content_type_header)
+    response_ds = json.loads(response.data)
+    assert response_ds['deleted'] == [{'id': counter_id, 'status': 'failed',
+                                       'error': 'Invalid task id'}
+                                      for counter_id in ('#change_version', '#change_version#1')]
+
+    response = self.client.open('/todo/api/v1.0/tasks/stats', method='GET')
+    assert json.loads(response.data)['stats'] == stats
+    assert self.client.open('/todo/api/v1.0/tasks', method='GET').headers['ETag'] == etag
+
+  def test_concurrent_requests_with_reconnect(self):
+    ''' Test threads keep working while the db connection is swapped '''
+    func_name = inspect.stack()[0][3]
+    failures = []
+
+    def create_tasks(thread_idx):
+      client = app.test_client()
+      for idx in range(5):
+        data = json.dumps({'title': 'function-%s-%s-%s' % (func_name, thread_idx, idx)})
+        response = client.open('/todo/api/v1.0/tasks', method='POST', data=data,
+                               headers=self.content_type_header)
+        if response.status_code != 201:
+          failures.append(response.status_code)
+
+    threads = [threading.Thread(target=create_tasks, args=(idx,)) for idx in range(8)]
+    for thread in threads:
+      thread.start()
+    response = self.client.open('/todo/api/v1.0/reconnect-db', method='POST')
+    for thread in threads:
+      thread.join()
+
+    assert response.status_code == 200
+    assert failures == []
+    assert len(list(db.iter_items())) == 40
+
   def test_delete_task(self):
     ''' Test task deletion '''
     # create task
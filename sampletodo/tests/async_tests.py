@@ -0,0 +1,183 @@
+''' Tests for the asyncio api against moto in server mode '''
+
+import os
+import sys
+import unittest
+
+os.environ['SAMPLETODO_CONFIG_ENV'] = 'TestLocalRunConfig'
+
+if sys.version_info < (3, 6):
+  raise unittest.SkipTest('the async api needs python 3.6+')
+
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+from moto.server import ThreadedMotoServer
+
+from sampletodo import app
+from sampletodo.async_views import create_async_app
+
+MOTO_PORT = int(os.environ.get('SAMPLETODO_TEST_MOTO_PORT', 5123))
+# any credentials pass, verify is overridden below
+AUTH_HEADER = 'Basic dGVzdDp0ZXN0'
+
+class AsyncApiTestCase(unittest.TestCase):
+  ''' Drive the aiohttp app over HTTP, DynamoDB calls go to a moto server '''
+
+  @classmethod
+  def setUpClass(cls):
+    cls.moto = ThreadedMotoServer(port=MOTO_PORT)
+    cls.moto.start()
+
+    config = dict(app.config)
+    config.update({
+      'DYNAMODB_MOCK': False,
+      'DYNAMODB_ENABLE_LOCAL': True,
+      'DYNAMODB_HOST': '127.0.0.1',
+      'DYNAMODB_PORT': MOTO_PORT,
+      'DYNAMODB_TABLE_NAME': 'SampletodoAsyncTesting',
+      'DYNAMODB_AUTO_PROVISION': True,
+    })
+
+    cls.loop = asyncio.new_event_loop()
+    async_app = create_async_app(config, verify=lambda username, password: True)
+    cls.client = TestClient(TestServer(async_app), loop=cls.loop)
+    cls.wait(cls.client.start_server())
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.wait(cls.client.close())
+    cls.loop.close()
+    cls.moto.stop()
+
+  @classmethod
+  def wait(cls, coroutine):
+    return cls.loop.run_until_complete(coroutine)
+
+  def request(self, method, url, **kwargs):
+    ''' Send a request, returns (status, json body) '''
+    headers = kwargs.pop('headers', {})
+    headers.setdefault('Authorization', AUTH_HEADER)
+    response = self.wait(self.client.request(method, url, headers=headers, **kwargs))
+    return response.status, self.wait(response.json())
+
+  def setUp(self):
+    self.request('DELETE', '/todo/api/v1.0/tasks')
+
+  def test_health(self):
+    ''' Test health '''
+    status, body = self.request('GET', '/todo/api/v1.0/health')
+    assert status == 200
+    assert body['status'] == 'good'
+
+  def test_unauthorized(self):
+    ''' Test requests without credentials are rejected '''
+    status, _ = self.request('GET', '/todo/api/v1.0/tasks', headers={'Authorization': ''})
+    assert status == 403
+
+  def test_task_lifecycle(self):
+    ''' Test create, get, update, list by status and delete '''
+    status, body = self.request('POST', '/todo/api/v1.0/tasks', json={'title': 'async task'})
+    assert status == 201
+    task_id = body['task']['id']
+
+    status, body = self.request('GET', '/todo/api/v1.0/tasks/%s' % task_id)
+    assert body['task']['title'] == 'async task'
+
+    status, body = self.request('PUT', '/todo/api/v1.0/tasks/%s' % task_id, json={'done': True})
+    assert status == 200
+    assert body['task']['done'] is True
+    assert body['task']['title'] == 'async task'
+
+    status, body = self.request('GET', '/todo/api/v1.0/tasks/status/done')
+    assert [task['id'] for task in body['tasks']] == [task_id]
+
+    status, body = self.request('DELETE', '/todo/api/v1.0/tasks/%s' % task_id)
+    assert body['deleted'] is True
+
+    status, body = self.request('GET', '/todo/api/v1.0/tasks/%s' % task_id)
+    assert body['task'] == {}
+
+  def test_conditional_get(self):
+    ''' Test a current If-None-Match gets a 304 until the next write '''
+    self.request('POST', '/todo/api/v1.0/tasks', json={'title': 'async task'})
+    headers = {'Authorization': AUTH_HEADER}
+
+    response = self.wait(self.client.get('/todo/api/v1.0/tasks', headers=headers))
+    etag = response.headers['ETag']
+    headers['If-None-Match'] = etag
+    response = self.wait(self.client.get('/todo/api/v1.0/tasks', headers=headers))
+    assert response.status == 304
+
+    self.request('POST', '/todo/api/v1.0/tasks', json={'title': 'another task'})
+    response = self.wait(self.client.get('/todo/api/v1.0/tasks', headers=headers))
+    assert response.status == 200
+    assert response.headers['ETag'] != etag
+    assert len(self.wait(response.json())['tasks']) == 2
+
+  def test_sparse_fieldsets(self):
+    ''' Test fields limits the returned attributes '''
+    status, body = self.request('POST', '/todo/api/v1.0/tasks', json={'title': 'async task'})
+    task_id = body['task']['id']
+
+    status, body = self.request('GET', '/todo/api/v1.0/tasks/%s?fields=done' % task_id)
+    assert body['task'] == {'id': task_id, 'done': False}
+    status, body = self.request('GET', '/todo/api/v1.0/tasks/status/pending?fields=title')
+    assert body['tasks'] == [{'id': task_id, 'title': 'async task'}]
+    status, body = self.request('GET', '/todo/api/v1.0/tasks?fields=a%20b')
+    assert status == 400
+
+  def test_task_stats(self):
+    ''' Test the counters follow creates, done transitions and deletes '''
+    ids = [self.request('POST', '/todo/api/v1.0/tasks', json={'title': 'task %s' % idx})[1]
+           ['task']['id'] for idx in range(3)]
+    self.request('PUT', '/todo/api/v1.0/tasks/%s' % ids[0], json={'done': True})
+    self.request('DELETE', '/todo/api/v1.0/tasks/%s' % ids[1])
+
+    status, body = self.request('GET', '/todo/api/v1.0/tasks/stats')
+    assert body['stats'] == {'pending': 1, 'done': 1, 'total': 2}
+
+  def test_batch_tasks(self):
+    ''' Test bulk creates and deletes, with the same results and counts as the flask api '''
+    status, body = self.request('POST', '/todo/api/v1.0/tasks', json={'title': 'async task'})
+    task_id = body['task']['id']
+
+    status, body = self.request('POST', '/todo/api/v1.0/tasks/batch', json={
+      'create': [{'title': 'first'}, 'not a task', {'title': 'second'}],
+      'delete': [task_id, task_id, 'missing', '#change_version']})
+    assert status == 200
+    assert [result['status'] for result in body['created']] == ['created', 'failed', 'created']
+    assert [result['status'] for result in body['deleted']] == \
+      ['deleted', 'deleted', 'deleted', 'failed']
+
+    status, body = self.request('GET', '/todo/api/v1.0/tasks/stats')
+    assert body['stats'] == {'pending': 2, 'done': 0, 'total': 2}
+
+  def test_update_missing_task(self):
+    ''' Test updating a task that does not exist '''
+    status, _ = self.request('PUT', '/todo/api/v1.0/tasks/missing', json={'done': True})
+    assert status == 400
+
+  def test_concurrent_creates_and_pagination(self):
+    ''' Test many requests in flight at once, then page through them '''
+    requests = [self.loop.create_task(
+                  self.client.post('/todo/api/v1.0/tasks', json={'title': 'task %s' % idx},
+                                   headers={'Authorization': AUTH_HEADER}))
+                for idx in range(50)]
+    responses = self.wait(asyncio.gather(*requests))
+    assert all(response.status == 201 for response in responses)
+
+    seen = set()
+    cursor = None
+    while True:
+      url = '/todo/api/v1.0/tasks?limit=20' + ('&cursor=%s' % cursor if cursor else '')
+      status, body = self.request('GET', url)
+      assert status == 200
+      seen.update(task['id'] for task in body['tasks'])
+      cursor = body['next_cursor']
+      if not cursor:
+        break
+    assert len(seen) == 50
+
+    status, body = self.request('DELETE', '/todo/api/v1.0/tasks')
+    assert body['deleted_count'] == 50
@@ -0,0 +1,349 @@
+''' Conformance tests every storage backend has to pass '''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+os.environ['SAMPLETODO_CONFIG_ENV'] = 'TestLocalRunConfig'
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+from sampletodo import app, create_db
+from sampletodo.models.base import ModelsException, new_item
+import sampletodo.common.metrics as metrics
+
+class BackendConformance(object):
+  ''' Behaviour the views rely on, mixed into one test case per backend '''
+  backend = None
+  cached = False
+
+  def setUp(self):
+    ''' set up the test environment '''
+    self.db = create_db(app, self.backend, cached=self.cached)
+    self.db.delete_all_items()
+
+  def _put(self, title, **attrs):
+    attrs['title'] = title
+    return self.db.put_item(attrs)
+
+  def _walk(self, page_func, limit):
+    ''' Follow cursors until the last page, returns the items in order '''
+    items = []
+    cursor = None
+    while True:
+      page = page_func(limit=limit, cursor=cursor)
+      assert len(page['Items']) <= limit
+      items.extend(page['Items'])
+      cursor = page.get('NextCursor')
+      if not cursor:
+        return items
+
+  def test_put_and_get(self):
+    ''' Test created items get an id, timestamps and index keys '''
+    item = self._put('Read a book', priority='high')
+    assert item['done'] == False
+    assert item['createdat'] == item['updatedat']
+
+    result = self.db.get_item_by_id(item['id'])
+    assert result['Item']['title'] == 'Read a book'
+    assert result['Item']['priority'] == 'high'
+    assert result['Item']['task_status'] == 'pending'
+
+    assert 'Item' not in self.db.get_item_by_id('does-not-exist')
+
+  def test_put_without_title(self):
+    ''' Test a title is required '''
+    self.assertRaises(ModelsException, self.db.put_item, {'done': True})
+
+  def test_list_items_paginated(self):
+    ''' Test every item is listed exactly once across pages '''
+    ids = set(self._put('task %s' % idx)['id'] for idx in range(7))
+    items = self._walk(self.db.list_items, 3)
+    assert sorted(item['id'] for item in items) == sorted(ids)
+
+    self.assertRaises(ModelsException, self.db.list_items, limit=3, cursor='not-a-cursor')
+
+  def test_items_by_status(self):
+    ''' Test status pages follow done transitions '''
+    ids = [self._put('task %s' % idx)['id'] for idx in range(5)]
+    for item_id in ids[:2]:
+      self.db.update_item(item_id, {'done': True})
+
+    done = self._walk(lambda **kwargs: self.db.get_items_by_status(True, **kwargs), 1)
+    pending = self._walk(lambda **kwargs: self.db.get_items_by_status(False, **kwargs), 2)
+    assert sorted(item['id'] for item in done) == sorted(ids[:2])
+    assert sorted(item['id'] for item in pending) == sorted(ids[2:])
+
+  def test_title_search(self):
+    ''' Test case insensitive prefix search that follows title updates '''
+    read_ids = set([self._put('Read a book')['id'], self._put('read   ANOTHER book')['id']])
+    write_id = self._put('Write a book')['id']
+
+    items = self._walk(lambda **kwargs: self.db.get_item_by_title('READ', **kwargs), 1)
+    assert set(item['id'] for item in items) == read_ids
+
+    self.db.update_item(write_id, {'title': 'Read the manual'})
+    items = self.db.get_item_by_title('read the')['Items']
+    assert [item['id'] for item in items] == [write_id]
+
+    self.assertRaises(ModelsException, self.db.get_item_by_title, 're')
+
+  def test_projection(self):
+    ''' Test reads only return the projected attributes plus the id, paging still works '''
+    ids = set(self._put('Read task %s' % idx, notes='x' * 100)['id'] for idx in range(5))
+    only = lambda items: set(tuple(sorted(item)) for item in items)
+
+    items = self._walk(lambda **kwargs: self.db.list_items(projection=['title'], **kwargs), 2)
+    assert set(item['id'] for item in items) == ids
+    assert only(items) == set([('id', 'title')])
+
+    items = self._walk(lambda **kwargs: self.db.get_items_by_status(
+      False, projection=['done', 'missing'], **kwargs), 2)
+    assert only(items) == set([('done', 'id')])
+
+    items = self._walk(lambda **kwargs: self.db.get_item_by_title(
+      'read', projection=['title'], **kwargs), 2)
+    assert len(items) == 5 and only(items) == set([('id', 'title')])
+
+    item_id = sorted(ids)[0]
+    self.db.get_item_by_id(item_id)
+    # twice, once from the table and once from the item cache when there is one
+    for _ in range(2):
+      assert self.db.get_item_by_id(item_id, projection=['notes'])['Item'] == \
+             {'id': item_id, 'notes': 'x' * 100}
+    assert 'createdat' in self.db.get_item_by_id(item_id)['Item']
+
+  def test_update_item(self):
+    ''' Test updates only touch the attributes sent '''
+    item = self._put('Read a book', priority='high')
+    result = self.db.update_item(item['id'], {'done': True, 'priority': 'ignored'})
+
+    assert result['Attributes']['done'] == True
+    assert result['Attributes']['task_status'] == 'done'
+    assert result['Attributes']['title'] == 'Read a book'
+    assert result['Attributes']['priority'] == 'high'
+    assert self.db.get_item_by_id(item['id'])['Item']['done'] == True
+
+    self.assertRaises(ModelsException, self.db.update_item, 'does-not-exist', {'done': True})
+
+  def test_delete(self):
+    ''' Test single and bulk deletes '''
+    ids = [self._put('task %s' % idx)['id'] for idx in range(4)]
+    self.db.delete_item(ids[0])
+    assert 'Item' not in self.db.get_item_by_id(ids[0])
+
+    result = self.db.delete_all_items()
+    assert result['deleted_count'] == 3
+    assert result['unprocessed_count'] == 0
+    assert self.db.list_items()['Items'] == []
+
+  def test_get_items_by_ids(self):
+    ''' Test lookups keep the requested order and report missing ids '''
+    ids = [self._put('task %s' % idx)['id'] for idx in range(3)]
+    result = self.db.get_items_by_ids([ids[2], 'does-not-exist', ids[0], ids[2]],
+                                      projection=['title'])
+
+    assert [item['id'] for item in result['Items']] == [ids[2], ids[0]]
+    assert sorted(result['Items'][0].keys()) == ['id', 'title']
+    assert result['MissingIds'] == ['does-not-exist']
+    assert result['UnprocessedIds'] == []
+
+  def test_batch_write_items(self):
+    ''' Test per item results of bulk writes '''
+    existing_id = self._put('existing')['id']
+    result = self.db.batch_write_items([{'title': 'new'}, {'no_title': True}], [existing_id])
+
+    assert [entry['status'] for entry in result['created']] == ['created', 'failed']
+    assert result['created'][1]['error'] == 'Title not provided'
+    assert result['deleted'] == [{'id': existing_id, 'status': 'deleted'}]
+    assert self.db.get_item_by_id(result['created'][0]['task']['id'])['Item']['title'] == 'new'
+    assert 'Item' not in self.db.get_item_by_id(existing_id)
+
+  def test_scans(self):
+    ''' Test full scans with projections and filters '''
+    ids = [self._put('task %s' % idx)['id'] for idx in range(3)]
+    self.db.update_item(ids[1], {'done': True})
+
+    assert sorted(item['id'] for item in self.db.iter_items(page_size=2)) == sorted(ids)
+    items = list(self.db.parallel_scan(projection=['id', 'done'],
+                                       filter_expression=Attr('done').eq(True)))
+    assert items == [{'id': ids[1], 'done': True}]
+
+    result = self.db.get_item_by_attr('title', 'task 2')
+    assert [item['id'] for item in result['Items']] == [ids[2]]
+
+  def test_change_version(self):
+    ''' Test every kind of write bumps the change version and reads do not '''
+    versions = [self.db.change_version()]
+    def changed():
+      versions.append(self.db.change_version())
+      return versions[-1] > versions[-2]
+
+    item_id = self._put('task')['id']
+    assert changed()
+    self.db.update_item(item_id, {'done': True})
+    assert changed()
+    self.db.batch_write_items([{'title': 'new'}], [])
+    assert changed()
+    self.db.list_items()
+    self.db.get_item_by_id(item_id)
+    assert not changed()
+    self.db.delete_item(item_id)
+    assert changed()
+    self.db.delete_all_items()
+    assert changed()
+
+    # the version survives deleting everything, old ETags must never match again
+    assert [item['id'] for item in self.db.iter_items()] == []
+    assert self.db.list_items()['Items'] == []
+
+  def test_long_title(self):
+    ''' Test titles longer than an index key are stored whole and still found '''
+    title = u'\u00e9t\u00e9 ' * 600
+    item = self._put(title)
+    assert self.db.get_item_by_id(item['id'])['Item']['title'] == title
+    assert len(item['title_key'].encode('utf-8')) <= 1024
+    found = self.db.get_item_by_title(title[:1500])['Items']
+    assert [found_item['id'] for found_item in found] == [item['id']]
+    self.db.update_item(item['id'], {'title': title + 'x'})
+
+  def test_put_items(self):
+    ''' Test stamped items are stored as they are and replays replace them '''
+    items = [new_item({'title': 'task %s' % idx}) for idx in range(30)]
+    assert self.db.put_items(items) == []
+    assert self.db.put_items(items[:1]) == []
+    assert self.db.get_item_by_id(items[0]['id'])['Item'] == items[0]
+    assert len(list(self.db.parallel_scan())) == 30
+    # DynamoDB counts a replayed item twice
+    assert self.db.reconcile_counts()['after'] == {'pending': 30, 'done': 0}
+
+  def test_task_counts(self):
+    ''' Test every kind of write keeps the counters in step with the items '''
+    def counts():
+      assert self.db.task_counts() == self.db.count_items()
+      return self.db.task_counts()
+
+    ids = [self._put('task %s' % idx)['id'] for idx in range(4)]
+    assert counts() == {'pending': 4, 'done': 0}
+    self.db.update_item(ids[0], {'done': True})
+    # no transition, nothing to count
+    self.db.update_item(ids[0], {'done': True, 'title': 'renamed'})
+    self.db.update_item(ids[1], {'title': 'renamed'})
+    assert counts() == {'pending': 3, 'done': 1}
+    self.db.delete_item(ids[0])
+    self.db.delete_item(ids[0])
+    assert counts() == {'pending': 3, 'done': 0}
+    self.db.batch_write_items([{'title': 'new'}], [ids[1], ids[1], 'does-not-exist'])
+    assert counts() == {'pending': 3, 'done': 0}
+
+    result = self.db.reconcile_counts()
+    assert result['before'] == result['after'] == {'pending': 3, 'done': 0}
+    self.db.delete_all_items()
+    assert counts() == {'pending': 0, 'done': 0}
+
+class MemoryBackendTestCase(BackendConformance, unittest.TestCase):
+  backend = 'memory'
+
+class SqliteBackendTestCase(BackendConformance, unittest.TestCase):
+  backend = 'sqlite'
+
+  @classmethod
+  def setUpClass(cls):
+    cls.tmp_dir = tempfile.mkdtemp()
+    cls.sqlite_path = app.config['SQLITE_PATH']
+    app.config['SQLITE_PATH'] = os.path.join(cls.tmp_dir, 'tasks.db')
+
+  @classmethod
+  def tearDownClass(cls):
+    app.config['SQLITE_PATH'] = cls.sqlite_path
+    shutil.rmtree(cls.tmp_dir)
+
+class DynamodbBackendTestCase(BackendConformance, unittest.TestCase):
+  backend = 'dynamodb'
+
+  def test_scan_fallback(self):
+    ''' Test the scans used while an index is missing match the index queries '''
+    for title in ['Alpha One', 'alpha  two', 'beta']:
+      self._put(title)
+
+    index_names = ['DYNAMODB_STATUS_INDEX_NAME', 'DYNAMODB_TITLE_INDEX_NAME']
+    saved = dict((name, app.config[name]) for name in index_names)
+    try:
+      for name in index_names:
+        app.config[name] = 'missing-index'
+      fallback = create_db(app, self.backend)
+    finally:
+      app.config.update(saved)
+
+    def titles(page):
+      return sorted(item['title'] for item in page['Items'])
+    assert titles(fallback.get_item_by_title('ALPHA')) == titles(self.db.get_item_by_title('ALPHA'))
+    assert titles(fallback.get_item_by_title('ALPHA')) == ['Alpha One', 'alpha  two']
+
+    # index cursors do not continue a scan
+    cursor = self.db.get_item_by_title('alpha', limit=1)['NextCursor']
+    self.assertRaises(ModelsException, fallback.get_item_by_title, 'alpha', cursor=cursor)
+    cursor = self.db.get_items_by_status(False, limit=1)['NextCursor']
+    self.assertRaises(ModelsException, fallback.get_items_by_status, False, cursor=cursor)
+    cursor = fallback.get_items_by_status(False, limit=1)['NextCursor']
+    self.assertRaises(ModelsException, self.db.get_items_by_status, False, cursor=cursor)
+
+  def _counter_items(self):
+    response = self.db.client.scan(TableName=app.config['DYNAMODB_TABLE_NAME'],
+                                   FilterExpression='begins_with(id, :counter)',
+                                   ExpressionAttributeValues={':counter': {'S': '#change_version'}})
+    return response['Items']
+
+  def test_counter_shards(self):
+    ''' Test writes spread over the counter shards and reads sum them up '''
+    version = self.db.change_version()
+    ids = [self._put('task %s' % idx)['id'] for idx in range(30)]
+    self.db.batch_write_items([], ids[:5])
+    assert self.db.change_version() == version + 31
+    assert self.db.task_counts() == {'pending': 25, 'done': 0}
+
+    counters = self._counter_items()
+    assert len(counters) > 1
+    assert len(counters) <= app.config['DYNAMODB_COUNTER_SHARDS']
+    # none of them shows up as a task
+    assert len(list(self.db.iter_items())) == 25
+    lookup = self.db.get_items_by_ids([item['id']['S'] for item in counters])
+    assert lookup['Items'] == []
+
+    self.db.reconcile_counts()
+    assert self.db.task_counts() == {'pending': 25, 'done': 0}
+    assert sum(int(item.get('pending_count', {'N': '0'})['N']) > 0
+               for item in self._counter_items()) == 1
+
+  def test_failed_counter_update(self):
+    ''' Test a write whose counter update fails still succeeds and changes the version '''
+    def throttle(params, **kwargs):
+      if params['Key']['id']['S'].startswith('#change_version'):
+        raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException',
+                                     'Message': 'throttled'}}, 'UpdateItem')
+
+    version = self.db.change_version()
+    failures = metrics.DYNAMODB_COUNTER_FAILURES.samples()
+    events = self.db.client.meta.events
+    events.register('provide-client-params.dynamodb.UpdateItem', throttle)
+    try:
+      item = self._put('task')
+    finally:
+      events.unregister('provide-client-params.dynamodb.UpdateItem', throttle)
+
+    assert self.db.get_item_by_id(item['id'])['Item']['title'] == 'task'
+    assert self.db.change_version() > version
+    assert metrics.DYNAMODB_COUNTER_FAILURES.samples() != failures
+    assert self.db.task_counts() == {'pending': 0, 'done': 0}
+    self.db.reconcile_counts()
+    assert self.db.task_counts() == {'pending': 1, 'done': 0}
+
+class CachedDynamodbBackendTestCase(BackendConformance, unittest.TestCase):
+  ''' DynamoDB behind the item cache, which must not change what the views see '''
+  backend = 'dynamodb'
+  cached = True
+
+if __name__ == '__main__':
+  unittest.main()
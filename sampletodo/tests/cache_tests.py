@@ -0,0 +1,97 @@
+''' Unit tests for the item cache '''
+
+import os
+import unittest
+
+os.environ['SAMPLETODO_CONFIG_ENV'] = 'TestLocalRunConfig'
+
+from sampletodo.models.cache import ItemCache
+
+class FakeClock(object):
+  ''' Manually advanced clock '''
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+class ItemCacheTestCase(unittest.TestCase):
+  ''' Test case class '''
+  def setUp(self):
+    ''' set up the test environment '''
+    self.clock = FakeClock()
+
+  def test_get_returns_copy(self):
+    ''' Test cached items can not be mutated through get '''
+    cache = ItemCache(clock=self.clock)
+    cache.set('a', {'id': 'a', 'title': 'A'})
+    item = cache.get('a')
+    item['title'] = 'changed'
+    assert cache.get('a')['title'] == 'A'
+    assert cache.stats()['hits'] == 2
+
+  def test_ttl_expiry(self):
+    ''' Test entries expire after the ttl '''
+    cache = ItemCache(ttl=10, clock=self.clock)
+    cache.set('a', {'id': 'a'})
+    self.clock.now += 11
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert stats['expirations'] == 1
+    assert stats['misses'] == 1
+    assert stats['entries'] == 0
+
+  def test_lru_eviction_by_entries(self):
+    ''' Test the least recently used entry is evicted first '''
+    cache = ItemCache(max_entries=2, clock=self.clock)
+    cache.set('a', {'id': 'a'})
+    cache.set('b', {'id': 'b'})
+    cache.get('a')
+    cache.set('c', {'id': 'c'})
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+    assert cache.stats()['evictions'] == 1
+
+  def test_eviction_by_bytes(self):
+    ''' Test the byte bound evicts and oversized items are not cached '''
+    cache = ItemCache(max_bytes=60, clock=self.clock)
+    cache.set('a', {'id': 'a', 'title': 'x' * 20})
+    cache.set('b', {'id': 'b', 'title': 'x' * 20})
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] <= 60
+
+    cache.set('c', {'id': 'c', 'title': 'x' * 100})
+    assert cache.get('c') is None
+
+  def test_invalidate_and_clear(self):
+    ''' Test explicit invalidation '''
+    cache = ItemCache(clock=self.clock)
+    cache.set('a', {'id': 'a'})
+    cache.set('b', {'id': 'b'})
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    cache.clear()
+    assert cache.stats()['entries'] == 0
+    assert cache.stats()['bytes'] == 0
+
+  def test_fill_after_write(self):
+    ''' Test a read that started before a write does not fill the cache '''
+    cache = ItemCache(clock=self.clock)
+    generation = cache.generation('a')
+    cache.set('a', {'id': 'a', 'title': 'new'})
+    cache.fill('a', {'id': 'a', 'title': 'old'}, generation)
+    assert cache.get('a')['title'] == 'new'
+
+    for write in (lambda: cache.invalidate('a'), cache.clear):
+      generation = cache.generation('a')
+      write()
+      cache.fill('a', {'id': 'a', 'title': 'old'}, generation)
+      assert cache.get('a') is None
+
+    generation = cache.generation('a')
+    cache.fill('a', {'id': 'a', 'title': 'current'}, generation)
+    assert cache.get('a')['title'] == 'current'
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,80 @@
+''' Unit tests for response compression '''
+
+import os
+import zlib
+import unittest
+
+os.environ['SAMPLETODO_CONFIG_ENV'] = 'TestLocalRunConfig'
+
+from werkzeug.http import parse_accept_header
+
+from sampletodo import app
+import sampletodo.common.compression as compression
+
+def gunzip(data):
+  return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+class CompressionTestCase(unittest.TestCase):
+  ''' Test negotiation and encoding of buffered and streamed bodies '''
+  def setUp(self):
+    self.config = dict(app.config, SAMPLETODO_COMPRESSION_MIN_SIZE=100)
+
+  def _response(self, body, **kwargs):
+    return app.response_class(body, mimetype='application/json', **kwargs)
+
+  def _compress(self, response, accept_encoding):
+    return compression.compress_response(response, parse_accept_header(accept_encoding),
+                                         self.config)
+
+  def test_negotiation(self):
+    ''' Test q values are honoured and br is preferred only when brotli is installed '''
+    body = b'{"tasks": []}' * 20
+    response = self._compress(self._response(body), 'gzip;q=0, deflate')
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data() == body
+    assert 'Accept-Encoding' in response.vary
+
+    response = self._compress(self._response(body), 'br;q=0.5, gzip')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gunzip(response.get_data()) == body
+
+    response = self._compress(self._response(body), 'gzip, br')
+    if compression.brotli is None:
+      assert response.headers['Content-Encoding'] == 'gzip'
+    else:
+      assert response.headers['Content-Encoding'] == 'br'
+      assert compression.brotli.decompress(response.get_data()) == body
+
+  def test_skipped_responses(self):
+    ''' Test small, failed and already encoded bodies are sent as they are '''
+    response = self._compress(self._response(b'{}'), 'gzip')
+    assert 'Content-Encoding' not in response.headers
+
+    response = self._compress(self._response(b'{"error": 1}' * 20, status=400), 'gzip')
+    assert 'Content-Encoding' not in response.headers
+
+    response = self._response(b'x' * 200, headers={'Content-Encoding': 'identity'})
+    assert self._compress(response, 'gzip').get_data() == b'x' * 200
+
+  def test_streamed_body(self):
+    ''' Test streamed bodies are compressed while they are iterated '''
+    produced = []
+    def chunks():
+      for idx in range(50):
+        produced.append(idx)
+        yield '{"id": "%032d"}\n' % idx
+
+    response = self._compress(self._response(chunks()), 'gzip')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+    # only enough to reach the threshold was read ahead
+    assert len(produced) < 50
+    body = gunzip(b''.join(response.response))
+    assert body == ''.join('{"id": "%032d"}\n' % idx for idx in range(50)).encode('utf-8')
+
+    response = self._compress(self._response(iter(['{}'])), 'gzip')
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data() == b'{}'
+
+if __name__ == '__main__':
+  unittest.main()
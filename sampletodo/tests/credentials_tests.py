@@ -0,0 +1,113 @@
+''' Tests for the background credentials refresher '''
+
+import os
+import re
+import threading
+import time
+import unittest
+
+os.environ['SAMPLETODO_CONFIG_ENV'] = 'TestLocalRunConfig'
+
+import boto3
+import botocore.session
+from botocore.awsrequest import AWSResponse
+
+from sampletodo.models.credentials import BackgroundRefreshCredentials, use_credentials
+
+LIFETIME = 1.0
+REFRESH_MARGIN = 0.5
+# how late the refresher thread may wake up on a busy test machine
+TOLERANCE = 0.15
+
+class EmptyBody(object):
+  ''' Raw body of the canned response '''
+  def stream(self, **kwargs):
+    yield b'{}'
+
+class BackgroundRefreshCredentialsTestCase(unittest.TestCase):
+  ''' Test case class '''
+  def setUp(self):
+    ''' set up the test environment '''
+    self.credentials = None
+    self.calls = []
+    self.sts_down = False
+    self.signed_keys = []
+
+  def fetch(self):
+    ''' A slow STS handing out new keys with a 1 second lifetime '''
+    expiry_time = self.credentials.expiry_time if self.credentials is not None else None
+    self.calls.append({'called_at': time.time(), 'expiry_time': expiry_time})
+    time.sleep(0.2)
+    if self.sts_down:
+      raise Exception('sts unavailable')
+    return {
+      'access_key': 'AKIATEST%08d' % len(self.calls),
+      'secret_key': 'secret',
+      'token': 'token',
+      'expiry_time': time.time() + LIFETIME,
+    }
+
+  def _client(self):
+    ''' DynamoDB client signing with self.credentials, requests never leave the process '''
+    botocore_session = use_credentials(botocore.session.get_session(), self.credentials)
+    session = boto3.Session(botocore_session=botocore_session, region_name='us-east-1')
+    client = session.client('dynamodb')
+    client.meta.events.register('before-send.dynamodb', self._capture)
+    return client
+
+  def _capture(self, request, **kwargs):
+    ''' Keep the access key the request was signed with and answer it '''
+    authorization = request.headers['Authorization']
+    if not isinstance(authorization, str):
+      authorization = authorization.decode('utf-8')
+    self.signed_keys.append(re.search(r'Credential=([^/]+)/', authorization).group(1))
+    return AWSResponse(request.url, 200, {}, EmptyBody())
+
+  def test_refreshes_ahead_of_expiry(self):
+    ''' Test the refresh starts refresh_margin before expiry and signing switches keys '''
+    self.credentials = BackgroundRefreshCredentials(self.fetch, refresh_margin=REFRESH_MARGIN)
+    client = self._client()
+    client.list_tables()
+    assert self.signed_keys == ['AKIATEST00000001']
+
+    self.credentials.start()
+    deadline = time.time() + 5
+    while len(self.calls) < 4 and time.time() < deadline:
+      access_key = self.credentials.get_frozen_credentials().access_key
+      start = time.time()
+      client.list_tables()
+      # signing does not wait for the slow refresh
+      assert time.time() - start < 0.1
+      assert self.signed_keys[-1] in (access_key, self.credentials.access_key)
+      time.sleep(0.02)
+    self.credentials.stop()
+
+    assert len(self.calls) >= 4
+    for call in self.calls[1:]:
+      refresh_at = call['expiry_time'] - REFRESH_MARGIN
+      assert call['called_at'] <= refresh_at + TOLERANCE
+      assert call['called_at'] >= refresh_at - TOLERANCE
+    client.list_tables()
+    assert self.signed_keys[-1] == 'AKIATEST%08d' % len(self.calls)
+    assert self.credentials.failure_count == 0
+
+  def test_failed_refresh_keeps_serving(self):
+    ''' Test a failing STS leaves the current credentials in place '''
+    self.credentials = BackgroundRefreshCredentials(self.fetch, refresh_margin=REFRESH_MARGIN)
+    client = self._client()
+    frozen = self.credentials.get_frozen_credentials()
+
+    self.sts_down = True
+    assert self.credentials.refresh() == False
+    assert self.credentials.failure_count == 1
+    assert self.credentials.get_frozen_credentials() == frozen
+    client.list_tables()
+    assert self.signed_keys == [frozen.access_key]
+
+  def tearDown(self):
+    ''' tear down the test environment '''
+    if self.credentials is not None:
+      self.credentials.stop()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+''' Tests for the logging setup '''
+
+import os
+import io
+import sys
+import json
+import logging
+import unittest
+
+os.environ['SAMPLETODO_CONFIG_ENV'] = 'TestLocalRunConfig'
+
+import structlog
+
+import sampletodo.common.utils as utils
+
+class SetupStructlogTestCase(unittest.TestCase):
+  ''' Test case class '''
+  def setUp(self):
+    ''' set up the test environment '''
+    self.stderr = sys.stderr
+    sys.stderr = self.output = io.StringIO()
+
+  def _log_lines(self, production):
+    ''' Log one event with the given mode, returns the JSON lines written '''
+    utils.setup_structlog(production=production)
+    structlog.get_logger().info('setup_structlog_test', answer=42)
+    # the production writer is a background thread, stopping it flushes the queue
+    utils.stop_queue_listener()
+    return [json.loads(line) for line in self.output.getvalue().splitlines()]
+
+  def test_production(self):
+    ''' Test production records skip the caller and thread lookups and keep the pid '''
+    record = self._log_lines(production=True)[-1]
+    assert record['event'] == 'setup_structlog_test'
+    assert record['answer'] == 42
+    assert record['process'] == os.getpid()
+    assert 'lineno' not in record and 'pathname' not in record
+    assert not logging.logThreads
+    assert not logging.logMultiprocessing
+    assert not logging.logProcesses
+
+  def test_development_restores_lookups(self):
+    ''' Test leaving production mode turns the record lookups back on '''
+    utils.setup_structlog(production=True)
+    record = self._log_lines(production=False)[-1]
+    assert record['event'] == 'setup_structlog_test'
+    assert record['process'] == os.getpid()
+    assert 'lineno' in record
+    assert logging.logThreads
+    assert logging.logProcesses
+
+  def tearDown(self):
+    ''' tear down the test environment '''
+    sys.stderr = self.stderr
+    utils.setup_structlog_wrapper()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,138 @@
+''' Unit tests for the metrics registry and its instrumentation '''
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+os.environ['SAMPLETODO_CONFIG_ENV'] = 'TestLocalRunConfig'
+
+from sampletodo import app, auth, create_db
+import sampletodo.common.metrics as metrics
+
+@auth.verify_password
+def verify_password(user, password):
+  ''' Overwrite the password check for unittesting'''
+  return True
+
+def sample(metric, *label_values):
+  ''' Current value of one label combination '''
+  for labels, value in [(s[0], s[1:]) for s in metric.samples()]:
+    if tuple(labels) == label_values:
+      return value[0] if len(value) == 1 else value
+  return None
+
+class RegistryTestCase(unittest.TestCase):
+  ''' Test the registry on its own '''
+  def setUp(self):
+    self.registry = metrics.Registry()
+    self.requests = self.registry.counter('requests_total', 'Requests', ['route'])
+    self.latency = self.registry.histogram('latency_seconds', 'Latency', ['route'],
+                                           buckets=(0.1, 1))
+    self.workers = self.registry.gauge('workers', 'Workers')
+
+  def test_render(self):
+    ''' Test the text exposition of counters, cumulative histograms and gauges '''
+    self.requests.inc(2, '/tasks')
+    self.latency.observe(0.05, '/tasks')
+    self.latency.observe(0.5, '/tasks')
+    self.latency.observe(5, '/tasks')
+    self.workers.set(1)
+
+    lines = self.registry.render().splitlines()
+    assert '# TYPE requests_total counter' in lines
+    assert 'requests_total{route="/tasks"} 2.0' in lines
+    assert 'latency_seconds_bucket{route="/tasks",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/tasks",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{route="/tasks",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{route="/tasks"} 5.55' in lines
+    assert 'latency_seconds_count{route="/tasks"} 3' in lines
+    assert 'workers 1.0' in lines
+
+  def test_counter_from_totals(self):
+    ''' Test totals kept elsewhere are exported as increments, a total that starts over adds up '''
+    for total in (3, 5, 5, 2):
+      self.requests.inc_to(total, '/tasks')
+    assert sample(self.requests, '/tasks') == 7
+
+  def test_label_escaping(self):
+    ''' Test quotes and backslashes in label values '''
+    self.requests.inc(1, 'a"b\\c')
+    assert 'requests_total{route="a\\"b\\\\c"} 1.0' in self.registry.render().splitlines()
+
+  def test_merge_across_workers(self):
+    ''' Test snapshots are summed, exited workers are folded together without their gauges '''
+    directory = tempfile.mkdtemp()
+    try:
+      self.registry.configure(directory)
+      self.requests.inc(1, '/tasks')
+      self.latency.observe(0.5, '/tasks')
+      self.workers.set(1)
+
+      # two exited workers that got the same pid, no process has it now
+      exited = self.registry.snapshot()
+      for token in ('first', 'second'):
+        with open(os.path.join(directory, 'metrics-%s-%s.json' % (2 ** 22 + 1, token)), 'w') as f:
+          json.dump(exited, f)
+
+      for _ in range(2):
+        lines = self.registry.render().splitlines()
+        assert 'requests_total{route="/tasks"} 3.0' in lines
+        assert 'latency_seconds_count{route="/tasks"} 3' in lines
+        assert 'workers 1.0' in lines
+      # folded into one snapshot, next to this process' own
+      filenames = sorted(os.listdir(directory))
+      assert filenames[0] == '.metrics-exited.lock'
+      assert filenames[1].startswith('metrics-%s-' % os.getpid())
+      assert filenames[2:] == ['metrics-exited.json']
+    finally:
+      shutil.rmtree(directory)
+
+class InstrumentationTestCase(unittest.TestCase):
+  ''' Test backend and request instrumentation '''
+  def setUp(self):
+    metrics.REGISTRY.reset()
+
+  def test_backend_methods(self):
+    ''' Test method latency and errors, generators are timed while they are iterated '''
+    db = create_db(app, 'memory')
+    db.put_item({'title': 'Read a book'})
+    self.assertRaises(Exception, db.put_item, {'done': True})
+    assert list(db.iter_items())
+
+    assert sum(sample(metrics.BACKEND_METHOD_DURATION, 'memory', 'put_item')[0]) == 2
+    assert sum(sample(metrics.BACKEND_METHOD_DURATION, 'memory', 'iter_items')[0]) == 1
+    assert sample(metrics.BACKEND_METHOD_ERRORS, 'memory', 'put_item', 'ModelsException') == 1
+
+  def test_dynamodb_calls(self):
+    ''' Test DynamoDB calls are attributed to model methods with their consumed capacity '''
+    db = create_db(app, 'dynamodb', cached=False)
+    item = db.put_item({'title': 'Read a book'})
+    result = db.table.get_item_by_id(item['id'])
+    assert 'ConsumedCapacity' not in result
+
+    assert sum(sample(metrics.DYNAMODB_CALL_DURATION, 'put_item', 'PutItem')[0]) == 1
+    assert sample(metrics.DYNAMODB_CONSUMED_CAPACITY, 'put_item', 'PutItem', 'write') > 0
+    assert sample(metrics.DYNAMODB_CONSUMED_CAPACITY, 'other', 'GetItem', 'read') > 0
+    # moto answers before anything reaches the connection pools
+    assert sorted(db.pool_stats().keys()) == ['idle', 'in_use', 'max']
+    # read by every scrape, not timed as backend calls
+    assert sample(metrics.BACKEND_METHOD_DURATION, 'dynamodb', 'pool_stats') is None
+
+  def test_metrics_endpoint(self):
+    ''' Test requests are counted by route and the endpoint serves the text format '''
+    client = app.test_client()
+    client.open('/todo/api/v1.0/health', method='GET')
+    client.open('/todo/api/v1.0/tasks/some-id', method='GET')
+
+    response = client.open('/todo/api/v1.0/metrics', method='GET')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    body = response.data.decode('utf-8')
+    assert 'sampletodo_http_request_duration_seconds_count' \
+           '{route="/todo/api/v1.0/health",method="GET",status="200"} 1' in body
+    assert 'route="/todo/api/v1.0/tasks/<string:task_id>"' in body
+
+if __name__ == '__main__':
+  unittest.main()
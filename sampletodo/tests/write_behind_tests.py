@@ -0,0 +1,154 @@
+''' Unit tests for write-behind ingestion '''
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+os.environ['SAMPLETODO_CONFIG_ENV'] = 'TestLocalRunConfig'
+
+from sampletodo.models.memory import MemoryTasksTable
+from sampletodo.models.write_behind import QueueFullException, WriteBehindTable
+
+class GatedTable(MemoryTasksTable):
+  ''' Memory backend whose put_items waits until the gate opens '''
+  def __init__(self, **kwargs):
+    MemoryTasksTable.__init__(self, **kwargs)
+    self.gate = threading.Event()
+    self.batches = []
+
+  def put_items(self, items):
+    self.gate.wait()
+    self.batches.append([item['id'] for item in items])
+    return MemoryTasksTable.put_items(self, items)
+
+class FlakyTable(MemoryTasksTable):
+  ''' Memory backend whose put_items raises until it is told the outage is over '''
+  def __init__(self, **kwargs):
+    MemoryTasksTable.__init__(self, **kwargs)
+    self.down = True
+    self.calls = 0
+
+  def put_items(self, items):
+    self.calls += 1
+    if self.down:
+      raise IOError('backend unavailable')
+    return MemoryTasksTable.put_items(self, items)
+
+class WriteBehindTestCase(unittest.TestCase):
+  ''' Test case class '''
+  def setUp(self):
+    ''' set up the test environment '''
+    self.tmp_dir = tempfile.mkdtemp()
+    self.table = GatedTable()
+
+  def tearDown(self):
+    ''' clean up the test environment '''
+    self.table.gate.set()
+    shutil.rmtree(self.tmp_dir)
+
+  def _open(self, **kwargs):
+    kwargs.setdefault('flush_interval', 0.01)
+    return WriteBehindTable(self.table, self.tmp_dir, **kwargs)
+
+  def test_put_item_is_written_in_batches(self):
+    ''' Test queued tasks are stamped up front and written together '''
+    db = self._open(batch_size=10)
+    items = [db.put_item({'title': 'task %s' % idx}) for idx in range(5)]
+    assert all(db.ingest_status(item['id']) == 'queued' for item in items)
+    assert self.table.task_counts()['pending'] == 0
+
+    self.table.gate.set()
+    db.close()
+    assert all(db.ingest_status(item['id']) == 'written' for item in items)
+    assert sum(len(batch) for batch in self.table.batches) == 5
+    assert len(self.table.batches) < 5
+    assert self.table.get_item_by_id(items[0]['id'])['Item'] == items[0]
+    assert db.ingest_stats()['written'] == 5
+    # nothing left to replay
+    assert os.listdir(self.tmp_dir) == []
+
+  def test_backpressure(self):
+    ''' Test put_item gives up once the queue stays full '''
+    db = self._open(queue_size=2, batch_size=1, enqueue_timeout=0.01)
+    db.put_item({'title': 'first'})
+    db.put_item({'title': 'second'})
+    with self.assertRaises(QueueFullException):
+      db.put_item({'title': 'third'})
+    assert db.ingest_stats()['rejected'] == 1
+
+    self.table.gate.set()
+    db.close()
+    assert self.table.task_counts()['pending'] == 2
+
+  def test_recovers_after_outage(self):
+    ''' Test tasks that outlast the attempts are written once the backend is back '''
+    table = FlakyTable()
+    db = WriteBehindTable(table, self.tmp_dir, queue_size=3, max_attempts=1,
+                          flush_interval=0.001, enqueue_timeout=0.01)
+    items = [db.put_item({'title': 'task %s' % idx}) for idx in range(3)]
+    with self.assertRaises(QueueFullException):
+      db.put_item({'title': 'queue is full'})
+    while table.calls < 2:
+      time.sleep(0.01)
+    assert db.ingest_status(items[0]['id']) == 'retrying'
+
+    table.down = False
+    # room again once the retried tasks are written
+    db.enqueue_timeout = 5
+    item = db.put_item({'title': 'after the outage'})
+    db.close()
+    assert all(db.ingest_status(task['id']) == 'written' for task in items + [item])
+    assert table.task_counts()['pending'] == 4
+    assert db.ingest_stats()['queued'] == 0
+    assert os.listdir(self.tmp_dir) == []
+
+  def test_replays_orphaned_journal(self):
+    ''' Test tasks a dead process never wrote are written by the next one '''
+    written = {'id': 'written', 'title': 'written', 'task_status': 'pending', 'done': False,
+               'createdat': 1, 'updatedat': 1}
+    pending = dict(written, id='pending', title='pending')
+    with open(os.path.join(self.tmp_dir, 'ingest-1-dead.jsonl'), 'w') as handle:
+      for record in [{'put': written}, {'put': pending}, {'written': ['written']}]:
+        handle.write(json.dumps(record) + '\n')
+      # cut off mid line by the crash
+      handle.write('{"put": {"id"')
+
+    self.table.gate.set()
+    db = self._open()
+    db.close()
+    assert self.table.batches == [['pending']]
+    assert db.ingest_stats()['replayed'] == 1
+    assert os.listdir(self.tmp_dir) == []
+
+  def test_running_journal_is_not_claimed(self):
+    ''' Test a second process leaves a live process' journal alone '''
+    first = self._open()
+    first.put_item({'title': 'queued'})
+    second = self._open()
+    assert second.ingest_stats()['replayed'] == 0
+
+    self.table.gate.set()
+    first.close()
+    second.close()
+    assert sum(len(batch) for batch in self.table.batches) == 1
+
+  def test_status_of_another_process_task(self):
+    ''' Test a task another process accepted is queued until it is written '''
+    first = self._open()
+    item = first.put_item({'title': 'queued'})
+    second = self._open()
+    assert second.ingest_status(item['id']) == 'queued'
+    assert second.ingest_status('never-accepted') is None
+
+    self.table.gate.set()
+    first.close()
+    # written, the views find it in the table
+    assert second.ingest_status(item['id']) is None
+    second.close()
+
+if __name__ == '__main__':
+  unittest.main()
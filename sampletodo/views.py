@@ -1,57 +1,90 @@
 ''' Sample flask todo app '''
 
 import os
-import json
+import time
+import logging
+import functools
 import structlog
 import traceback
 import flask
-from flask import jsonify, abort, request, make_response, url_for
+from flask import abort, request, url_for
 
-from sampletodo.models.dynamodb import ModelsException
+from sampletodo.models.dynamodb import ModelsException, fields_projection, parse_fields
+from sampletodo.models.write_behind import QueueFullException, STATUS_WRITTEN
 from sampletodo import app, db, auth
 from sampletodo.version import __version__
+import sampletodo.common.metrics as metrics
+import sampletodo.common.compression as compression
+import sampletodo.common.utils as utils
 
 logger = structlog.get_logger()
 log = logger.new()
 log = log.bind(build_version=__version__)
 
+TTY_LOGGING = os.environ.get('SAMPLETODO_TTY') == 'True'
+
+def json_response(data, http_code=200):
+  ''' Encode a response body exactly once, with the request id in the envelope '''
+  request_id = getattr(flask.g, 'request_id', None)
+  if request_id and isinstance(data, dict):
+    # a copy, callers may hand in dicts they keep using
+    data = dict(data, request_id=request_id)
+  return app.response_class(utils.dumps_json(data), status=http_code,
+                            mimetype='application/json')
+
 @app.errorhandler(Exception)
 def exceptions(e):
   ''' Handle flask exceptions '''
   tb = traceback.format_exc()
   log.error('exception', traceback=tb)
   http_code = 500
-  return make_response(jsonify({'error': 'internal_server_error'}), http_code)
+  return json_response({'error': 'internal_server_error'}, http_code)
 
 @app.after_request
 def after_request(response):
   ''' Handle flask response logging '''
   log_method = log.info
 
-  if not str(response.status_code).startswith('20'):
+  # headers are only worth their rendering cost when debugging, check before copying them
+  if logging.getLogger(__name__).isEnabledFor(logging.DEBUG):
+    log.debug('response_headers', response_headers=dict(response.headers))
+
+  if response.status_code >= 400:
     log_method = log.error
     log_method('response', response_status='error', 
-               response_headers=response.headers,
+               response_content_length=response.content_length,
                response_status_code=response.status_code)
   else:
     log_method('response', response_status='success', 
-               response_headers=response.headers,
+               response_content_length=response.content_length,
                response_status_code=response.status_code)
 
+  # the request id is already part of the body, see json_response
   if getattr(flask.g, 'request_id', None):
-    if response.headers['Content-Type'] != 'application/json':
-      response_data = json.loads(response.get_data())
-      response_data['request_id'] = flask.g.request_id
-      response.set_data(json.dumps(response_data))
+    response.headers['X-Request-Id'] = flask.g.request_id
 
-  if 'SAMPLETODO_TTY' in os.environ and os.environ['SAMPLETODO_TTY'] == 'True':
+  if TTY_LOGGING:
     print("==========================================================")
 
+  # before the latency is taken, compressing is part of serving the request
+  compression.compress_response(response, request.accept_encodings, app.config)
+
+  start = getattr(flask.g, 'request_start', None)
+  if start is not None:
+    # the rule, not the path, so task ids do not blow up the label values
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.HTTP_REQUEST_DURATION.observe(time.time() - start, route, request.method,
+                                          str(response.status_code))
+    metrics.REGISTRY.maybe_flush()
+
   return response
 
 @app.before_request
 def before_request():
   ''' Handle flask request logging '''
+  if app.config['SAMPLETODO_METRICS_ENABLED']:
+    flask.g.request_start = time.time()
+  utils.request_id()
   log.info('request',
            request_remote_addr=request.remote_addr,
            request_method=request.method,
@@ -77,25 +110,21 @@ def unauthorized():
   http_code = 403
   err = 'unauthorized_access'
   log.error(err)
-  return make_response(jsonify({'error': err}), http_code)
+  return json_response({'error': err}, http_code)
 
 @app.errorhandler(400)
 def bad_request(err):
   ''' Page Not found handler '''
   http_code = 400
   log.error('bad_request', error=str(err), http_code=http_code)
-  response = jsonify(http_code=http_code, text=str(err))
-  response.status_code = http_code
-  return response
+  return json_response({'http_code': http_code, 'text': str(err)}, http_code)
 
 @app.errorhandler(404)
 def server_not_found(err):
   ''' 404 handler '''
   http_code = 404
   log.error('server_not_found', error=str(err), http_code=http_code)
-  response = jsonify(http_code=http_code, text=str(err))
-  response.status_code = http_code
-  return response
+  return json_response({'http_code': http_code, 'text': str(err)}, http_code)
 
 @app.route('/todo/api/v1.0/reconnect-db', methods=['POST'])
 @auth.login_required
@@ -103,21 +132,60 @@ def reconnect_db():
   ''' Add task to todo list '''
   log.info('recreating_db_connection')
   result = db.refresh_aws_connection()
-  return jsonify({'status': 'done'}), 200
+  return json_response({'status': 'done'})
+
+def conditional(view):
+  ''' ETags from the table change version, 304 without a read when the client is current '''
+  @functools.wraps(view)
+  def wrapper(*args, **kwargs):
+    # read before the data, a write in between only makes the next poll a 200
+    etag = 'v%s' % db.change_version()
+    if request.if_none_match.contains_weak(etag):
+      response = app.response_class(status=304)
+    else:
+      response = view(*args, **kwargs)
+      if response.status_code != 200:
+        return response
+    # weak, the body also carries the request id
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+  return wrapper
+
+def pagination_args():
+  ''' Parse the limit and cursor query parameters '''
+  limit = request.args.get('limit', app.config['SAMPLETODO_PAGE_LIMIT'])
+  try:
+    limit = int(limit)
+  except ValueError:
+    raise ModelsException('Invalid limit - %s' % limit)
+
+  if limit < 1 or limit > app.config['SAMPLETODO_MAX_PAGE_LIMIT']:
+    raise ModelsException('Invalid limit - %s' % limit)
+
+  return limit, request.args.get('cursor')
+
+def fields_arg():
+  ''' Parse the fields query parameter into a projection, None for every attribute '''
+  return parse_fields(request.args.get('fields'))
 
 @app.route('/todo/api/v1.0/tasks', methods=['GET'])
 @auth.login_required
+@conditional
 def get_tasks():
-  ''' Get list of tasks '''
-  result = db.list_items()
-
-  if 'Items' not in result:
-    return jsonify({'tasks': []})
+  ''' Get a page of tasks '''
+  try:
+    limit, cursor = pagination_args()
+    result = db.list_items(limit=limit, cursor=cursor, projection=fields_arg())
+  except ModelsException as ex:
+    return bad_request(str(ex))
 
-  return jsonify({'tasks': result['Items']})
+  return json_response({'tasks': result.get('Items', []),
+                        'next_cursor': result.get('NextCursor')})
 
 @app.route('/todo/api/v1.0/tasks/status/<string:task_status>', methods=['GET'])
 @auth.login_required
+@conditional
 def get_tasks_by_status(task_status):
   ''' Get tasks by done status '''
   if task_status != 'pending' and task_status != 'done':
@@ -125,23 +193,94 @@ def get_tasks_by_status(task_status):
 
   attr_value = False if task_status == 'pending' else True
 
-  result = db.get_item_by_attr('done', attr_value )
+  try:
+    limit, cursor = pagination_args()
+    result = db.get_items_by_status(attr_value, limit=limit, cursor=cursor,
+                                    projection=fields_arg())
+  except ModelsException as ex:
+    return bad_request(str(ex))
+
+  return json_response({'tasks': result.get('Items', []),
+                        'next_cursor': result.get('NextCursor')})
+
+@app.route('/todo/api/v1.0/tasks/search', methods=['GET'])
+@auth.login_required
+@conditional
+def search_tasks():
+  ''' Get tasks by title prefix '''
+  title = request.args.get('title')
+  if not title:
+    return bad_request('Title prefix not provided')
+
+  try:
+    limit, cursor = pagination_args()
+    result = db.get_item_by_title(title, limit=limit, cursor=cursor, projection=fields_arg())
+  except ModelsException as ex:
+    return bad_request(str(ex))
+
+  return json_response({'tasks': result.get('Items', []),
+                        'next_cursor': result.get('NextCursor')})
+
+@app.route('/todo/api/v1.0/tasks/stats', methods=['GET'])
+@auth.login_required
+@conditional
+def task_stats():
+  ''' Task counts per status from the counters, no task is read '''
+  counts = db.task_counts()
+  return json_response({'stats': dict(counts, total=sum(counts.values()))})
+
+@app.route('/todo/api/v1.0/tasks/lookup', methods=['POST'])
+@auth.login_required
+def lookup_tasks():
+  ''' Get many tasks by id in one request '''
+  if not request.json:
+    abort(400)
+
+  task_ids = request.json.get('ids')
+  fields = request.json.get('fields')
+
+  if not isinstance(task_ids, list) or \
+     not all(isinstance(task_id, utils.string_types) and task_id for task_id in task_ids):
+    return bad_request('ids must be a list of task ids')
+
+  if fields is not None and \
+     (not isinstance(fields, list) or
+      not all(isinstance(field, utils.string_types) and field for field in fields)):
+    return bad_request('fields must be a list of attribute names')
+
+  try:
+    # the same names and limit as the fields query parameter
+    projection = None if fields is None else fields_projection(fields)
+  except ModelsException as ex:
+    return bad_request(ex)
 
-  if 'Items' not in result:
-    return jsonify({'tasks': []})
+  max_items = app.config['SAMPLETODO_BATCH_MAX_ITEMS']
+  if len(task_ids) > max_items:
+    return bad_request('Lookup is limited to %s tasks' % max_items)
+
+  try:
+    result = db.get_items_by_ids(task_ids, projection=projection)
+  except ModelsException as ex:
+    return bad_request(str(ex))
 
-  return jsonify({'tasks': result['Items']})
+  return json_response({'tasks': result['Items'],
+                        'missing': result['MissingIds'],
+                        'unprocessed': result['UnprocessedIds']})
 
 @app.route('/todo/api/v1.0/tasks/<string:task_id>', methods=['GET'])
 @auth.login_required
+@conditional
 def get_task(task_id):
   ''' Return task from todo list '''
-  result = db.get_item_by_id(task_id)
+  try:
+    result = db.get_item_by_id(task_id, projection=fields_arg())
+  except ModelsException as ex:
+    return bad_request(str(ex))
 
   if 'Item' not in result:
-    return jsonify({'task': {}})
+    return json_response({'task': {}})
 
-  return jsonify({'task': result['Item']})
+  return json_response({'task': result['Item']})
 
 @app.route('/todo/api/v1.0/tasks', methods=['POST'])
 @auth.login_required
@@ -152,10 +291,59 @@ def create_task():
 
   try:
     result = db.put_item(request.json)
+  except QueueFullException as ex:
+    log.error('write_behind_queue_full', error=str(ex))
+    response = json_response({'http_code': 503, 'text': str(ex)}, 503)
+    response.headers['Retry-After'] = '1'
+    return response
+  except ModelsException as ex:
+    return bad_request(str(ex))
+
+  if app.config['SAMPLETODO_WRITE_BEHIND_ENABLED']:
+    # accepted, the flusher writes it shortly
+    status_url = url_for('ingest_status', task_id=result['id'])
+    response = json_response({'task': result, 'status': 'queued', 'status_url': status_url}, 202)
+    response.headers['Location'] = status_url
+    return response
+
+  return json_response({'task': result}, 201)
+
+@app.route('/todo/api/v1.0/tasks/ingest/<string:task_id>', methods=['GET'])
+@auth.login_required
+def ingest_status(task_id):
+  ''' Whether a task POST /tasks accepted was written yet '''
+  # the journals first, a task leaves them only once it is in the table
+  status = db.ingest_status(task_id) if hasattr(db, 'ingest_status') else None
+  if status is None and 'Item' in db.get_item_by_id(task_id, ['id']):
+    # accepted long ago, or without write-behind
+    status = STATUS_WRITTEN
+  if status is None:
+    return json_response({'id': task_id, 'status': 'unknown'}, 404)
+
+  return json_response({'id': task_id, 'status': status})
+
+@app.route('/todo/api/v1.0/tasks/batch', methods=['POST'])
+@auth.login_required
+def batch_tasks():
+  ''' Create and delete tasks in bulk '''
+  if not request.json:
+    abort(400)
+
+  creates = request.json.get('create', [])
+  deletes = request.json.get('delete', [])
+  if not isinstance(creates, list) or not isinstance(deletes, list):
+    return bad_request('create and delete must be lists')
+
+  max_items = app.config['SAMPLETODO_BATCH_MAX_ITEMS']
+  if len(creates) + len(deletes) > max_items:
+    return bad_request('Batch is limited to %s tasks' % max_items)
+
+  try:
+    result = db.batch_write_items(creates, deletes)
   except ModelsException as ex:
     return bad_request(str(ex))
 
-  return jsonify({'task': result}), 201
+  return json_response(result)
 
 @app.route('/todo/api/v1.0/tasks/<string:task_id>', methods=['PUT'])
 @auth.login_required
@@ -169,7 +357,7 @@ def update_task(task_id):
   except ModelsException as ex:
     return bad_request(str(ex))
 
-  return jsonify({'task': result['Attributes']})
+  return json_response({'task': result['Attributes']})
 
 @app.route('/todo/api/v1.0/tasks/<string:task_id>', methods=['DELETE'])
 @auth.login_required
@@ -180,34 +368,93 @@ def delete_task(task_id):
   except ModelsException as ex:
     return bad_request(str(ex))
 
-  return jsonify({'id': task_id, 'deleted': True})
+  return json_response({'id': task_id, 'deleted': True})
 
 @app.route('/todo/api/v1.0/tasks', methods=['DELETE'])
 @auth.login_required
 def delete_all_tasks():
   ''' Delete all tasks '''
   try:
-    db.delete_all_items()
+    result = db.delete_all_items()
   except ModelsException as ex:
     return bad_request(str(ex))
 
-  return jsonify({'deleted': True})
+  return json_response(dict(result, deleted=True))
+
+@app.route('/todo/api/v1.0/cache/stats', methods=['GET'])
+@auth.login_required
+def cache_stats():
+  ''' Return item cache counters '''
+  if not hasattr(db, 'cache_stats'):
+    return json_response({'enabled': False})
+
+  return json_response(dict(db.cache_stats(), enabled=True))
+
+def collect_backend_stats():
+  ''' Mirror the item cache and connection pool stats into the metrics '''
+  obj = db.peek()
+  if obj is None:
+    return
+
+  if hasattr(obj, 'cache_stats'):
+    stats = obj.cache_stats()
+    for event in ['hits', 'misses', 'evictions', 'expirations']:
+      metrics.CACHE_EVENTS.inc_to(stats[event], event)
+    metrics.CACHE_SIZE.set(stats['entries'], 'entries')
+    metrics.CACHE_SIZE.set(stats['bytes'], 'bytes')
+
+  if hasattr(obj, 'ingest_stats'):
+    stats = obj.ingest_stats()
+    for outcome in ['accepted', 'rejected', 'replayed', 'written', 'retried']:
+      metrics.INGEST_TASKS.inc_to(stats[outcome], outcome)
+    metrics.INGEST_QUEUE.set(stats['queued'], 'queued')
+    metrics.INGEST_QUEUE.set(stats['queue_size'], 'capacity')
+
+  if hasattr(obj, 'pool_stats'):
+    for state, count in obj.pool_stats().items():
+      metrics.DYNAMODB_POOL.set(count, state)
+
+metrics.REGISTRY.add_collector(collect_backend_stats)
+
+@app.route('/todo/api/v1.0/metrics', methods=['GET'])
+@auth.login_required
+def metrics_endpoint():
+  ''' Metrics of every worker in Prometheus text format '''
+  if not app.config['SAMPLETODO_METRICS_ENABLED']:
+    abort(404)
+  return app.response_class(metrics.REGISTRY.render(), mimetype=None,
+                            content_type=metrics.CONTENT_TYPE)
 
 @app.route('/', methods=['GET'])
 def index():
   ''' Index url '''
   ds = {
     url_for('health'): url_for('health', _external=True),
+    url_for('health_db'): url_for('health_db', _external=True),
     url_for('build_version'): url_for('build_version', _external=True),
   }
-  return jsonify(ds)
+  return json_response(ds)
 
 @app.route('/todo/api/v1.0/health', methods=['GET'])
 def health():
   ''' Basic health test '''
-  return jsonify({'status': 'good'})
+  return json_response({'status': 'good'})
+
+@app.route('/todo/api/v1.0/health/db', methods=['GET'])
+def health_db():
+  ''' Table health from cached metadata '''
+  info = db.table_info()
+  if info.get('status') != 'ACTIVE':
+    return json_response({'status': 'bad', 'table_status': info.get('status')}, 503)
+  return json_response({'status': 'good', 'table_status': info['status']})
+
+@app.route('/todo/api/v1.0/table', methods=['GET'])
+@auth.login_required
+def table_info():
+  ''' Table status, size, capacity and indexes '''
+  return json_response({'table': db.table_info()})
 
 @app.route('/todo/api/v1.0/build_version', methods=['GET'])
 def build_version():
   ''' Return build_version '''
-  return jsonify({'build_version': '%s' % __version__})
+  return json_response({'build_version': '%s' % __version__})
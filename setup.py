@@ -39,7 +39,8 @@ setup(
 
     entry_points = {
       'console_scripts': [
-        'sampletodo = sampletodo.run:main'
+        'sampletodo = sampletodo.run:main',
+        'sampletodo-manage = sampletodo.manage:main'
       ]
     },
 